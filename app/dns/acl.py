@@ -0,0 +1,178 @@
+import ipaddress
+import socket
+from typing import Generic, Iterable, TypeVar
+
+T = TypeVar('T')
+
+_MISSING = object()
+
+
+class _Node:
+  __slots__ = ('key', 'length', 'value', 'children')
+
+  def __init__(self, key: int, length: int, value: object = _MISSING):
+    # the first `length` bits of the prefix, right aligned
+    self.key = key
+    self.length = length
+    self.value = value
+    self.children: list['_Node | None'] = [None, None]
+
+
+class PrefixTree(Generic[T]):
+  """
+  Longest prefix match over `bits` bit addresses with a path compressed
+  binary trie (Patricia tree). Nodes exist only where prefixes end or
+  branch, and every node visited on a lookup fixes at least one more
+  bit, so a lookup takes at most `bits` steps however many prefixes
+  the tree holds.
+  """
+
+  def __init__(self, bits: int):
+    self.bits = bits
+    self.root = _Node(0, 0)
+    self.size = 0
+
+  def __len__(self) -> int:
+    return self.size
+
+  def insert(self, prefix: int, length: int, value: T) -> None:
+    """
+    Maps the network `prefix`/`length`, `prefix` being the full width
+    address, to `value`, replacing an earlier value for it.
+    """
+
+    bits = self.bits
+    key = prefix >> (bits - length) if length else 0
+    node = self.root
+    while True:
+      if node.length == length:
+        if node.value is _MISSING:
+          self.size += 1
+        node.value = value
+        return
+      bit = (key >> (length - node.length - 1)) & 1
+      child = node.children[bit]
+      if child is None:
+        node.children[bit] = _Node(key, length, value)
+        self.size += 1
+        return
+
+      common = min(child.length, length)
+      ours = key >> (length - common)
+      theirs = child.key >> (child.length - common)
+      if ours == theirs:
+        if child.length <= length:
+          node = child
+          continue
+        # the new prefix sits between node and child
+        inner = _Node(key, length, value)
+        inner.children[(child.key >> (child.length - length - 1)) & 1] = child
+        node.children[bit] = inner
+        self.size += 1
+        return
+
+      # the prefixes part ways: branch where they stop agreeing
+      common -= (ours ^ theirs).bit_length()
+      branch = _Node(key >> (length - common), common)
+      branch.children[(child.key >> (child.length - common - 1)) & 1] = child
+      branch.children[(key >> (length - common - 1)) & 1] = _Node(
+          key, length, value)
+      node.children[bit] = branch
+      self.size += 1
+      return
+
+  def lookup(self, address: int, default: T | None = None) -> T | None:
+    """
+    Value of the longest prefix containing `address`.
+    """
+
+    bits = self.bits
+    node = self.root
+    best = node.value
+    while node.length < bits:
+      node = node.children[(address >> (bits - node.length - 1)) & 1]
+      if node is None or address >> (bits - node.length) != node.key:
+        break
+      if node.value is not _MISSING:
+        best = node.value
+    return default if best is _MISSING else best
+
+
+class AddressTree(Generic[T]):
+  """
+  Prefix trees for IPv4 and IPv6 side by side, keyed by text addresses
+  and networks. IPv4-mapped IPv6 clients match IPv4 prefixes.
+  """
+
+  def __init__(self):
+    self.v4: PrefixTree[T] = PrefixTree(32)
+    self.v6: PrefixTree[T] = PrefixTree(128)
+
+  def __len__(self) -> int:
+    return len(self.v4) + len(self.v6)
+
+  def insert(self, network: str, value: T) -> None:
+    """
+    :raises ValueError: If `network` is not an address or a network.
+    """
+
+    net = ipaddress.ip_network(network, strict=False)
+    tree = self.v4 if net.version == 4 else self.v6
+    tree.insert(int(net.network_address), net.prefixlen, value)
+
+  def lookup(self, address: str, default: T | None = None) -> T | None:
+    if ':' not in address:
+      return self.v4.lookup(
+          int.from_bytes(socket.inet_aton(address), 'big'), default)
+    value = int.from_bytes(socket.inet_pton(socket.AF_INET6, address), 'big')
+    if value >> 32 == 0xffff:
+      return self.v4.lookup(value & 0xffffffff, default)
+    return self.v6.lookup(value, default)
+
+
+# names usable in address match lists besides named ACLs
+BUILTIN_ACLS = {
+    'any': ['0.0.0.0/0', '::/0'],
+    'none': [],
+    'localhost': ['127.0.0.0/8', '::1/128'],
+    'localnets': ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16',
+                  'fc00::/7', 'fe80::/10'],
+}
+
+
+class Acl:
+  """
+  Address match list: networks and ACL names, each optionally negated
+  with a leading '!'. Unlike BIND's first-match rule the most specific
+  network decides, so an exception may be listed anywhere:
+  ['10.0.0.0/8', '!10.6.0.0/16']. Addresses nothing matches are denied.
+  """
+
+  def __init__(self, elements: Iterable[str],
+               named: dict[str, list[str]] | None = None):
+    self.tree: AddressTree[bool] = AddressTree()
+    self._add(elements, named or {}, True, ())
+
+  def _add(self, elements: Iterable[str], named: dict[str, list[str]],
+           allow: bool, seen: tuple[str, ...]) -> None:
+    for element in elements:
+      element = element.strip()
+      negated = element.startswith('!')
+      element = element.lstrip('!').strip()
+      value = allow != negated
+      nested = named.get(element, BUILTIN_ACLS.get(element))
+      if nested is not None:
+        if element in seen:
+          raise ValueError(f'ACL {element!r} includes itself')
+        self._add(nested, named, value, seen + (element,))
+        continue
+      try:
+        self.tree.insert(element, value)
+      except ValueError:
+        raise ValueError(f'Unknown ACL or invalid network {element!r}')
+
+  def __len__(self) -> int:
+    return len(self.tree)
+
+  def allows(self, address: str) -> bool:
+    return self.tree.lookup(address, False)
@@ -0,0 +1,136 @@
+import argparse
+import gc
+import socket
+import struct
+import sys
+import time
+import tracemalloc
+
+from app.dns.common import RType
+from app.dns.encoding import Encoding
+from app.dns.record import ResourceRecord
+
+# rdata for the record types a resolver cache mostly holds
+_RDATA = {
+    RType.A: socket.inet_aton('192.0.2.1'),
+    RType.AAAA: socket.inet_pton(socket.AF_INET6, '2001:db8::1'),
+    RType.CNAME: Encoding.encode_name('edge-cache.cdn.example.net'),
+}
+
+
+def _record_wire(name: str, record_type: RType) -> bytes:
+  rdata = _RDATA[record_type]
+  return (Encoding.encode_name(name)
+          + struct.pack('!HHIH', record_type.value, 1, 300, len(rdata))
+          + rdata)
+
+
+def memory(count: int = 100000, per_name: int = 1) -> dict[str, float]:
+  """
+  Bytes held per decoded record, as a cache would keep them: each
+  record has its own rdata and every `per_name` records share an owner
+  name (1 is the worst case, a name per record). The wire input is
+  built before tracing starts and the list holding the records is not
+  counted.
+  """
+
+  results = {}
+  for record_type in _RDATA:
+    names = [f'host{i}.zone{i % 100}.example.com'
+             for i in range(count // per_name + 1)]
+    wires = [_record_wire(names[i // per_name], record_type)
+             for i in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    records = [ResourceRecord.from_bytes(wire)[0] for wire in wires]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[record_type.name] = (current - sys.getsizeof(records)) / count
+    del records, wires, names
+  return results
+
+
+def _answer_heavy(count: int = 40) -> bytes:
+  """
+  Response to a query for a long name with a CNAME and `count` A
+  records, every owner name compressed against the question.
+  """
+
+  header = struct.pack('!HHHHHH', 1, 0x8180, 1, count + 1, 0, 0)
+  question = (Encoding.encode_name('www.service.region.cloud.example.com')
+              + struct.pack('!HH', 1, 1))
+  target = b'\x04edge\xc0\x10'
+  answers = (b'\xc0\x0c' + struct.pack('!HHIH', 5, 1, 300, len(target))
+             + target)
+  for i in range(count):
+    answers += (b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, 300, 4)
+                + bytes([192, 0, 2, i & 0xff]))
+  return header + question + answers
+
+
+def _pointer_chain(count: int = 40) -> bytes:
+  """
+  Adversarial response: a chain of names, each one label in front of a
+  pointer to the previous, with `count` records all pointing at the
+  longest suffix so every name expands to the maximum of 255 octets.
+  """
+
+  header = struct.pack('!HHHHHH', 1, 0x8180, 1, count, 0, 0)
+  body = bytearray(b'\x01a\x00' + struct.pack('!HH', 1, 1))
+  previous = 12
+  for _ in range(126):
+    current = 12 + len(body)
+    body += b'\x01a' + struct.pack('!H', 0xc000 | previous)
+    previous = current
+  for i in range(count):
+    body += (struct.pack('!H', 0xc000 | previous)
+             + struct.pack('!HHIH', 1, 1, 300, 4) + bytes(4))
+  return header + bytes(body)
+
+
+def _pointer_loop() -> bytes:
+  # the question name is a pointer to itself
+  return (struct.pack('!HHHHHH', 1, 0x0100, 1, 0, 0, 0)
+          + b'\xc0\x0c' + struct.pack('!HH', 1, 1))
+
+
+def names(rounds: int = 2000) -> dict[str, float]:
+  """
+  Microseconds to parse an answer-heavy response, and to reject
+  adversarial ones.
+  """
+
+  from app.dns.exceptions import FormatError
+  from app.dns.message import Message
+
+  def parse(packet: bytes) -> None:
+    try:
+      Message.from_bytes(packet)
+    except FormatError:
+      pass
+
+  results = {}
+  for name, packet in (('answer-heavy', _answer_heavy()),
+                       ('pointer-chain', _pointer_chain()),
+                       ('pointer-loop', _pointer_loop())):
+    start = time.perf_counter()
+    for _ in range(rounds):
+      parse(packet)
+    results[name] = (time.perf_counter() - start) / rounds * 1e6
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Runs micro benchmarks.')
+  parser.add_argument('benchmark', choices=['memory', 'names'])
+  parser.add_argument('--count', type=int, default=100000)
+  parser.add_argument('--per-name', type=int, default=1,
+                      help='Records sharing each owner name')
+  args = parser.parse_args()
+
+  if args.benchmark == 'memory':
+    for name, size in memory(args.count, args.per_name).items():
+      print(f'{name:<6} {size:8.1f} bytes/record')
+  elif args.benchmark == 'names':
+    for name, elapsed in names().items():
+      print(f'{name:<14} {elapsed:8.1f} us/message')
@@ -0,0 +1,273 @@
+import itertools
+import struct
+import threading
+import time
+from typing import Iterable
+
+from app.dns import metrics
+from app.dns.common import RType
+from app.dns.name import Name
+from app.dns.record import ResourceRecord
+
+_TTL = struct.Struct('!I')
+
+# longest CNAME chain followed inside the cache
+MAX_CHAIN = 8
+# keys matched, then removed, per hold of the lock by `remove`
+REMOVE_BATCH = 10000
+
+# owner, type, class and partition: entries are only ever seen by
+# lookups for the same partition (a view's clients)
+CacheKey = tuple[Name, int, int, bytes]
+
+
+def _chain(records: list[ResourceRecord], name: Name, rtype: int,
+           klass: int) -> list[ResourceRecord]:
+  """
+  The records of `records` on the CNAME chain starting at `name`, in
+  chain order.
+  """
+
+  chain = []
+  for _ in range(MAX_CHAIN):
+    found = [record for record in records
+             if isinstance(record, ResourceRecord) and record.name == name
+             and record.klass == klass
+             and record.type in (rtype, RType.CNAME.value)]
+    chain.extend(found)
+    cname = next((record for record in found
+                  if record.type == RType.CNAME.value), None)
+    if cname is None or rtype == RType.CNAME.value:
+      break
+    name = Name.from_wire(cname.rdata.wire)
+  return chain
+
+
+def _owned(owner: Name, name: Name, subtree: bool) -> bool:
+  if not subtree:
+    return owner.key == name.key
+  # the byte test rules out nearly every key before the label walk
+  return owner.key.endswith(name.key) and owner.is_subdomain(name)
+
+
+class RRset:
+  """
+  One cached RRset: its records encoded back to back (uncompressed,
+  ready to append to any message), the offsets of their TTL fields and
+  the absolute expiry. CNAME sets also keep their target for chasing.
+  """
+
+  __slots__ = ('wire', 'ttl_offsets', 'expires', 'count', 'target')
+
+  def __init__(self, wire: bytes, ttl_offsets: tuple[int, ...],
+               expires: float, target: Name | None = None):
+    self.wire = wire
+    self.ttl_offsets = ttl_offsets
+    self.expires = expires
+    self.count = len(ttl_offsets)
+    self.target = target
+
+  def render(self, now: float) -> bytes:
+    """
+    The records with every TTL set to the time left.
+    """
+
+    buf = bytearray(self.wire)
+    ttl = max(0, int(self.expires - now))
+    pack_into = _TTL.pack_into
+    for offset in self.ttl_offsets:
+      pack_into(buf, offset, ttl)
+    return bytes(buf)
+
+
+class CachedAnswer:
+  """
+  Answer section entry for a cache hit, the wire bytes of `count`
+  records. Message serializes it like a record.
+  """
+
+  __slots__ = ('wire', 'count')
+
+  def __init__(self, wire: bytes, count: int):
+    self.wire = wire
+    self.count = count
+
+  def __bytes__(self) -> bytes:
+    return self.wire
+
+  def __repr__(self) -> str:
+    return f'CACHED: {self.count} records'
+
+
+class RRsetCache:
+  """
+  Cache of RRsets keyed by owner name, type and class, stored in wire
+  form so that a hit is a copy of bytes plus a TTL patch per record
+  rather than re-encoding record objects. Least recently used sets are
+  evicted beyond `capacity`; expired ones are dropped when met.
+  Lookups are counted in `lookups` unless it is None.
+  """
+
+  def __init__(self, capacity: int = 100000, min_ttl: int = 0,
+               max_ttl: int = 86400,
+               lookups: metrics.Counter | None = metrics.CACHE_LOOKUPS):
+    self.capacity = capacity
+    self.min_ttl = min_ttl
+    self.max_ttl = max_ttl
+    self.lookups = lookups
+    # a plain dict kept in recency order by re-inserting on hit, lighter
+    # per entry than OrderedDict's linked list
+    self._entries: dict[CacheKey, RRset] = {}
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def _get(self, key: CacheKey, now: float) -> RRset | None:
+    entry = self._entries.get(key)
+    if entry is None:
+      return None
+    del self._entries[key]
+    if entry.expires <= now:
+      return None
+    self._entries[key] = entry
+    return entry
+
+  def lookup(self, name: Name, rtype: int, klass: int,
+             partition: bytes = b'') -> CachedAnswer | None:
+    """
+    Answer for a question from the cache, following cached CNAMEs.
+    Returns None unless the whole chain down to the requested type is
+    cached.
+    """
+
+    with self._lock:
+      answer = self._chase(name, rtype, klass, partition, time.time())
+    if self.lookups is not None:
+      self.lookups.inc('miss' if answer is None else 'hit')
+    return answer
+
+  def _chase(self, name: Name, rtype: int, klass: int, partition: bytes,
+             now: float) -> CachedAnswer | None:
+    parts = []
+    count = 0
+    for _ in range(MAX_CHAIN):
+      entry = self._get((name, rtype, klass, partition), now)
+      if entry is not None:
+        parts.append(entry.render(now))
+        return CachedAnswer(b''.join(parts), count + entry.count)
+      if rtype == RType.CNAME.value:
+        break
+      entry = self._get((name, RType.CNAME.value, klass, partition), now)
+      if entry is None:
+        break
+      parts.append(entry.render(now))
+      count += entry.count
+      name = entry.target
+    return None
+
+  def store(self, name: Name, rtype: int, klass: int,
+            records: list[ResourceRecord], partition: bytes = b'') -> None:
+    """
+    Caches the RRsets of an upstream answer section to the question
+    (`name`, `rtype`, `klass`). Only the sets answering the question
+    are kept: the CNAME chain from `name` and the `rtype` set it ends
+    at; anything else an upstream put in the section could poison
+    names it was never asked about. Sets with a TTL of 0 are not
+    cached, the others expire after their lowest TTL clamped to
+    [min_ttl, max_ttl].
+    """
+
+    self._insert(self._encode(_chain(records, name, rtype, klass),
+                              time.time(), partition))
+
+  def entries(self) -> Iterable[tuple[CacheKey, RRset]]:
+    """
+    The live entries, least recently used first.
+    """
+
+    now = time.time()
+    with self._lock:
+      return [(key, entry) for key, entry in self._entries.items()
+              if entry.expires > now]
+
+  def restore(self, entries: Iterable[tuple[CacheKey, RRset]]) -> int:
+    """
+    Inserts previously saved entries as they are, expiry included.
+    Returns how many were inserted.
+    """
+
+    return self._insert(entries)
+
+  def _insert(self, rrsets: Iterable[tuple[CacheKey, RRset]]) -> int:
+    inserted = 0
+    with self._lock:
+      for key, rrset in rrsets:
+        self._entries.pop(key, None)
+        self._entries[key] = rrset
+        inserted += 1
+      if len(self._entries) > self.capacity:
+        for key in list(itertools.islice(
+            self._entries, len(self._entries) - self.capacity)):
+          del self._entries[key]
+    return inserted
+
+  def _encode(self, records: list[ResourceRecord], now: float,
+              partition: bytes = b'') -> list[tuple[CacheKey, RRset]]:
+    groups: dict[CacheKey, list[ResourceRecord]] = {}
+    for record in records:
+      if (not isinstance(record, ResourceRecord)
+         or record.type == RType.OPT.value):
+        continue
+      groups.setdefault((record.name, record.type, record.klass, partition),
+                        []).append(record)
+
+    rrsets = []
+    for key, group in groups.items():
+      ttl = min(record.ttl for record in group)
+      if ttl <= 0:
+        continue
+      ttl = min(self.max_ttl, max(self.min_ttl, ttl))
+      wire = []
+      offsets = []
+      position = 0
+      for record in group:
+        encoded = bytes(record)
+        offsets.append(position + len(record.name.wire) + 4)
+        wire.append(encoded)
+        position += len(encoded)
+      target = None
+      if key[1] == RType.CNAME.value:
+        target = Name.from_wire(group[0].rdata.wire)
+      rrsets.append((key, RRset(b''.join(wire), tuple(offsets), now + ttl,
+                                target)))
+    return rrsets
+
+  def flush(self) -> None:
+    with self._lock:
+      self._entries.clear()
+
+  def remove(self, name: Name, subtree: bool = False) -> int:
+    """
+    Drops every set owned by `name`, or with `subtree` by `name` and
+    the names below it, in all partitions. Returns how many were
+    dropped.
+
+    Keys are copied once, then matched outside the lock and removed
+    REMOVE_BATCH at a time, so even a multi-million entry cache only
+    ever holds lookups up for a short while.
+    """
+
+    with self._lock:
+      keys = list(self._entries)
+    removed = 0
+    for start in range(0, len(keys), REMOVE_BATCH):
+      batch = [key for key in keys[start:start + REMOVE_BATCH]
+               if _owned(key[0], name, subtree)]
+      if not batch:
+        continue
+      with self._lock:
+        for key in batch:
+          if self._entries.pop(key, None) is not None:
+            removed += 1
+    return removed
@@ -9,6 +9,9 @@ _Address = tuple[str, int] | str
 
 
 def debug(message: str = '', *args: tuple, **kwarg: dict) -> None:
+  if not logging.getLogger().isEnabledFor(logging.DEBUG):
+    return
+
   info = caller_info()
   logger = logging.getLogger('.'.join([info[0], info[1]]))
   offset = kwarg['offset'] if 'offset' in kwarg else 0
@@ -110,48 +113,36 @@ def get_random_ttl() -> int:
   return random.choice(ttl_values)
 
 
-def setUpRootLogger(level: int = 0) -> logging.Logger:
+def setUpRootLogger(level: int = 0, queue_size: int = 10000) -> logging.Logger:
   root = logging.getLogger()
 
   if not root.hasHandlers():
-    import sys
+    from app.dns.log import create_queue_handler
 
     if level not in [logging.CRITICAL, logging.ERROR, logging.WARNING,
                      logging.INFO, logging.DEBUG,]:
-      level = logging.DEBUG
+      level = logging.INFO
 
     root.setLevel(level)
-
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(level)
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    root.addHandler(handler)
+    root.addHandler(create_queue_handler(level, maxsize=queue_size))
   return root
 
 
 def exist_in_enum(value, enum_class: enum.Enum):
-  values = set(item.value for item in enum_class)
-  if value in values:
-    return True
-  return False
+  return value in enum_class._value2member_map_
 
 
 class EnumExtension(enum.Enum):
+  # membership tests go straight to the lookup tables enum builds once
+  # at class creation instead of collecting the members on every call
+
   @classmethod
   def value_exists(cls, value) -> bool:
-    values = set(item.value for item in cls)
-    if value in values:
-      return True
-    return False
+    return value in cls._value2member_map_
 
   @classmethod
   def name_exists(cls, name) -> bool:
-    names = set(item.name for item in cls)
-    if name in names:
-      return True
-    return False
+    return name in cls._member_map_
 
   @classmethod
   def safe_get_value_by_value(cls, key, default=None):
@@ -217,6 +208,7 @@ class RType(EnumExtension):
   KX = 36
   CERT = 37
   DNAME = 39
+  OPT = 41
   APL = 42
   DS = 43
   SSHFP = 44
@@ -265,3 +257,23 @@ class ResponseCode(EnumExtension):
   NAME_ERROR = 3
   NOT_IMPLEMENTED = 4
   REFUSED = 5
+
+
+# Tables built once at import for the per-record hot paths: validation
+# is a frozenset membership test and naming a single dict lookup.
+RECORD_TYPES = frozenset(t.value for t in RType)
+QUERY_TYPES = RECORD_TYPES | frozenset(t.value for t in QType)
+RECORD_CLASSES = frozenset(c.value for c in RClass)
+QUERY_CLASSES = RECORD_CLASSES | frozenset(c.value for c in QClass)
+
+TYPE_NAMES: dict[int, str] = {t.value: t.name for t in (*RType, *QType)}
+CLASS_NAMES: dict[int, str] = {c.value: c.name for c in (*RClass, *QClass)}
+RCODE_NAMES: dict[int, str] = {r.value: r.name for r in ResponseCode}
+
+
+def type_name(value: int) -> str | int:
+  return TYPE_NAMES.get(value, value)
+
+
+def class_name(value: int) -> str | int:
+  return CLASS_NAMES.get(value, value)
@@ -0,0 +1,142 @@
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# command line sent by a client, one per connection
+MAX_COMMAND = 4096
+
+# handler(arguments) -> reply text; ValueError is reported to the client
+Handler = Callable[[list[str]], str]
+
+
+class ControlServer:
+  """
+  Local control channel in the manner of rndc: a client connects to the
+  Unix socket at `path`, sends one command line and reads the reply
+  until the server closes the connection. Commands are registered by
+  the parts of the server they act on; `help` lists them.
+
+  Only the owner of the process may connect (the socket is mode 0600).
+  Commands run one at a time on the control thread, never on the query
+  path.
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    self.commands: dict[str, tuple[Handler, str]] = {}
+    self.register('help', self._help, 'List the commands')
+    if os.path.exists(path):
+      # left behind by a crash, or held by a server handing over to us
+      os.unlink(path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # created 0600 rather than chmod-ed after binding, which would leave
+    # a window where anyone the umask allows could connect
+    umask = os.umask(0o177)
+    try:
+      self.sock.bind(path)
+    finally:
+      os.umask(umask)
+    self._inode = os.stat(path).st_ino
+    self.sock.listen(8)
+    self._thread = threading.Thread(target=self._accept, name='control',
+                                    daemon=True)
+
+  def register(self, name: str, handler: Handler, help: str) -> None:
+    self.commands[name] = (handler, help)
+
+  def start(self) -> None:
+    self._thread.start()
+    logger.info(f'Control socket listening on {self.path}')
+
+  def _help(self, args: list[str]) -> str:
+    return '\n'.join(f'{name:<12} {help}'
+                     for name, (_, help) in sorted(self.commands.items()))
+
+  def _accept(self) -> None:
+    while True:
+      try:
+        conn, _ = self.sock.accept()
+      except OSError:
+        break
+      with conn:
+        conn.settimeout(5.0)
+        try:
+          conn.sendall(self.execute(self._read(conn)).encode('utf-8'))
+        except OSError as e:
+          logger.debug(f'Control connection failed: {e}')
+
+  def _read(self, conn: socket.socket) -> str:
+    buf = b''
+    while b'\n' not in buf and len(buf) < MAX_COMMAND:
+      chunk = conn.recv(MAX_COMMAND - len(buf))
+      if not chunk:
+        break
+      buf += chunk
+    return buf.split(b'\n', 1)[0].decode('utf-8', 'replace')
+
+  def execute(self, line: str) -> str:
+    """
+    Runs a command line and returns the reply, `error: ...` when the
+    command failed.
+    """
+
+    words = line.split()
+    if not words:
+      return 'error: empty command\n'
+    entry = self.commands.get(words[0].lower())
+    if entry is None:
+      return f'error: unknown command {words[0]!r}, try help\n'
+    logger.info(f'Control command: {line.strip()}')
+    try:
+      reply = entry[0](words[1:])
+    except ValueError as e:
+      return f'error: {e}\n'
+    except Exception as e:
+      logger.exception(e)
+      return f'error: {words[0]} failed: {e!r}\n'
+    return reply if reply.endswith('\n') else reply + '\n'
+
+  def close(self) -> None:
+    self.sock.close()
+    # after a handoff the path is bound by the new process
+    try:
+      if os.stat(self.path).st_ino == self._inode:
+        os.unlink(self.path)
+    except FileNotFoundError:
+      pass
+
+
+def send_command(path: str, line: str, timeout: float = 60.0) -> str:
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+    conn.settimeout(timeout)
+    conn.connect(path)
+    conn.sendall(line.encode('utf-8') + b'\n')
+    chunks = []
+    while True:
+      chunk = conn.recv(65536)
+      if not chunk:
+        break
+      chunks.append(chunk)
+  return b''.join(chunks).decode('utf-8', 'replace')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Sends a command to a running server.')
+  parser.add_argument('socket', help='The server\'s --control-socket')
+  parser.add_argument('command', nargs='+', help='Command and arguments, '
+                      'help lists them')
+  args = parser.parse_args()
+
+  try:
+    reply = send_command(args.socket, ' '.join(args.command))
+  except OSError as e:
+    sys.exit(f'Could not reach {args.socket}: {e}')
+  sys.stdout.write(reply)
+  sys.exit(1 if reply.startswith('error:') else 0)
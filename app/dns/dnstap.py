@@ -0,0 +1,185 @@
+import argparse
+import collections
+import ipaddress
+import logging
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DNSTAP\x00\x01'
+CLIENT_QUERY = 1
+CLIENT_RESPONSE = 2
+
+# timestamp, kind, address family, address, port, payload length
+_RECORD = struct.Struct('!dBB16sHH')
+
+
+@dataclass
+class TapRecord:
+  timestamp: float
+  kind: int
+  address: str
+  port: int
+  payload: bytes
+
+  def __repr__(self) -> str:
+    kind = 'CQ' if self.kind == CLIENT_QUERY else 'CR'
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.timestamp))
+    return (f'{stamp}.{int(self.timestamp % 1 * 1e6):06d} {kind} '
+            f'{self.address}:{self.port} {len(self.payload)}b')
+
+
+class TapWriter:
+  """
+  Captures raw query/response wire data into an in-memory ring and
+  flushes it from a background thread in large batched writes to
+  rotating files. Capturing never blocks, records are dropped and
+  counted when the ring is full.
+  """
+
+  def __init__(self, directory: str, filename: str = 'dns.tap',
+               capacity: int = 65536, batch_size: int = 4096,
+               flush_interval: float = 0.5,
+               max_bytes: int = 64 * 1024 * 1024, backups: int = 8):
+    self.path = os.path.join(directory, filename)
+    self.capacity = capacity
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.max_bytes = max_bytes
+    self.backups = backups
+
+    self.captured: int = 0
+    self.dropped: int = 0
+    self.written: int = 0
+
+    self._ring: collections.deque = collections.deque()
+    self._wakeup = threading.Event()
+    self._stopping = False
+    self._file = None
+    self._size = 0
+
+    os.makedirs(directory, exist_ok=True)
+    self._thread = threading.Thread(
+        target=self._run, name='dnstap-writer', daemon=True)
+    self._thread.start()
+
+  def query(self, data: bytes, client: tuple[str, int]) -> None:
+    self.capture(CLIENT_QUERY, data, client)
+
+  def response(self, data: bytes, client: tuple[str, int]) -> None:
+    self.capture(CLIENT_RESPONSE, data, client)
+
+  def capture(self, kind: int, data: bytes, client: tuple[str, int]) -> None:
+    if len(self._ring) >= self.capacity:
+      self.dropped += 1
+      return
+    self._ring.append((time.time(), kind, client[0], client[1], data))
+    self.captured += 1
+    if len(self._ring) >= self.batch_size:
+      self._wakeup.set()
+
+  def close(self) -> None:
+    self._stopping = True
+    self._wakeup.set()
+    self._thread.join()
+
+  def _run(self) -> None:
+    while True:
+      self._wakeup.wait(self.flush_interval)
+      self._wakeup.clear()
+      try:
+        while len(self._ring) > 0:
+          self._flush()
+      except OSError as e:
+        logger.error(f'dnstap write failed: {e}')
+      if self._stopping:
+        break
+    if self._file is not None:
+      self._file.close()
+
+  def _flush(self) -> None:
+    """
+    Writes one batch from the ring. A batch that can't be written is
+    counted as dropped.
+    """
+
+    ring = self._ring
+    chunks = []
+    for _ in range(min(len(ring), self.batch_size)):
+      timestamp, kind, host, port, data = ring.popleft()
+      address = ipaddress.ip_address(host.split('%', 1)[0])
+      chunks.append(_RECORD.pack(timestamp, kind, address.version,
+                                 address.packed, port, len(data)))
+      chunks.append(data)
+
+    buf = b''.join(chunks)
+    try:
+      if self._file is None or self._size >= self.max_bytes:
+        self._rotate()
+      self._file.write(buf)
+      self._file.flush()
+    except OSError:
+      self.dropped += len(chunks) // 2
+      raise
+    self._size += len(buf)
+    self.written += len(chunks) // 2
+
+  def _rotate(self) -> None:
+    if self._file is not None:
+      self._file.close()
+      for i in range(self.backups - 1, 0, -1):
+        src = f'{self.path}.{i}'
+        if os.path.exists(src):
+          os.replace(src, f'{self.path}.{i + 1}')
+      os.replace(self.path, f'{self.path}.1')
+    self._file = open(self.path, 'ab')
+    if self._file.tell() == 0:
+      self._file.write(MAGIC)
+    self._size = self._file.tell()
+
+
+def read_records(path: str, chunk_size: int = 1 << 20) -> Iterator[TapRecord]:
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f'{path} is not a dnstap log')
+
+    buf = b''
+    offset = 0
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+      buf = buf[offset:] + chunk
+      offset = 0
+      while offset + _RECORD.size <= len(buf):
+        (timestamp, kind, version, packed, port,
+         length) = _RECORD.unpack_from(buf, offset)
+        end = offset + _RECORD.size + length
+        if end > len(buf):
+          break
+        if version == 4:
+          address = str(ipaddress.IPv4Address(packed[:4]))
+        else:
+          address = str(ipaddress.IPv6Address(packed))
+        yield TapRecord(timestamp, kind, address, port,
+                        buf[offset + _RECORD.size:end])
+        offset = end
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Dumps dnstap log files.')
+  parser.add_argument('files', nargs='+')
+  parser.add_argument('--hex', action='store_true',
+                      help='Also print the wire payload')
+  args = parser.parse_args()
+
+  for file in args.files:
+    for record in read_records(file):
+      print(repr(record))
+      if args.hex:
+        print(record.payload.hex())
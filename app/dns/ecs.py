@@ -0,0 +1,174 @@
+import ipaddress
+import struct
+from typing import TYPE_CHECKING
+
+from app.dns import metrics
+from app.dns.cache import CachedAnswer, RRsetCache
+from app.dns.common import RType
+from app.dns.name import Name
+from app.dns.record import ResourceRecord
+
+if TYPE_CHECKING:
+  from app.dns.message import Message
+
+# EDNS option code of the client subnet (RFC 7871 6)
+ECS_OPTION = 8
+# bits of the client address sent upstream, the most RFC 7871 11.1
+# recommends sharing
+SOURCE_V4 = 24
+SOURCE_V6 = 56
+
+_HEADER = struct.Struct('!HBB')
+_FAMILIES = {4: 1, 6: 2}
+_BITS = {1: 32, 2: 128}
+
+
+class ClientSubnet:
+  """
+  The network of a client as forwarded upstream: address family
+  (1 IPv4, 2 IPv6), source prefix length and the address.
+  """
+
+  __slots__ = ('family', 'source', 'address')
+
+  def __init__(self, family: int, source: int, address: int):
+    self.family = family
+    self.source = source
+    self.address = address
+
+  def __repr__(self) -> str:
+    return f'ClientSubnet({self.family}, {self.network(self.source).hex()}' \
+           f'/{self.source})'
+
+  @classmethod
+  def from_address(cls, address: str, source_v4: int = SOURCE_V4,
+                   source_v6: int = SOURCE_V6) -> 'ClientSubnet':
+    """
+    :raises ValueError: If `address` is not an IP address.
+    """
+
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+      ip = ip.ipv4_mapped
+    family = _FAMILIES[ip.version]
+    return cls(family, source_v4 if family == 1 else source_v6, int(ip))
+
+  def network(self, prefix: int) -> bytes:
+    """
+    The address cut to `prefix` bits, in as few bytes as hold them
+    (the ADDRESS field of the option, RFC 7871 6).
+    """
+
+    bits = _BITS[self.family]
+    value = self.address >> (bits - prefix) << (bits - prefix) if prefix else 0
+    return value.to_bytes(bits // 8, 'big')[:(prefix + 7) // 8]
+
+  def option(self) -> bytes:
+    return (_HEADER.pack(self.family, self.source, 0)
+            + self.network(self.source))
+
+  def edns_option(self) -> tuple[int, bytes]:
+    return ECS_OPTION, self.option()
+
+  def scope(self, additional: list) -> int:
+    """
+    Prefix length an upstream answer is valid for, from the option it
+    echoed in `additional`: 0 when it sent none (the answer is the same
+    for everyone). An echo not matching what was sent gets the source
+    prefix, the narrowest sharing. A scope longer than the source is cut
+    to it (RFC 7871 7.3.1).
+    """
+
+    for record in additional:
+      if record.type != RType.OPT.value:
+        continue
+      for code, value in record.rdata.options:
+        if code != ECS_OPTION:
+          continue
+        sent = self.option()
+        if (len(value) < _HEADER.size or value[:3] != sent[:3]
+           or value[4:] != sent[4:]):
+          return self.source
+        return min(value[3], self.source)
+    return 0
+
+
+def opted_out(message: 'Message') -> bool:
+  """
+  Whether the client asked for no subnet to be sent, with a source
+  prefix of 0 in its own option (RFC 7871 7.1.2).
+  """
+
+  for record in message.additional:
+    if record.type != RType.OPT.value:
+      continue
+    for code, value in record.rdata.options:
+      if code == ECS_OPTION and len(value) >= _HEADER.size:
+        return _HEADER.unpack_from(value)[1] == 0
+  return False
+
+
+class SubnetCache:
+  """
+  Answers an upstream tailored to a client network, kept apart from the
+  main cache in an LRU of their own: a popular name can have an entry
+  per subnet, and bounding them separately means they can neither grow
+  without limit nor push shared answers out of the main cache.
+
+  Entries live in the partition of the question plus the family and
+  the network at the scope the upstream gave. A lookup tries the scopes
+  seen so far for the family, longest first, so the most specific
+  matching answer is used.
+  """
+
+  def __init__(self, capacity: int = 20000, max_ttl: int = 86400,
+               source_v4: int = SOURCE_V4, source_v6: int = SOURCE_V6):
+    self.cache = RRsetCache(capacity=capacity, max_ttl=max_ttl, lookups=None)
+    self.source_v4 = source_v4
+    self.source_v6 = source_v6
+    # family -> scope prefix lengths stored, longest first
+    self.scopes: dict[int, list[int]] = {1: [], 2: []}
+
+  def __len__(self) -> int:
+    return len(self.cache)
+
+  def subnet(self, address: str, message: 'Message') -> ClientSubnet | None:
+    """
+    The subnet to forward for a query from `address`, None when the
+    client opted out.
+    """
+
+    if opted_out(message):
+      return None
+    try:
+      return ClientSubnet.from_address(address, self.source_v4,
+                                       self.source_v6)
+    except ValueError:
+      return None
+
+  @staticmethod
+  def _partition(partition: bytes, subnet: ClientSubnet, scope: int) -> bytes:
+    return partition + bytes([0, subnet.family, scope]) + subnet.network(scope)
+
+  def lookup(self, name: Name, rtype: int, klass: int, partition: bytes,
+             subnet: ClientSubnet) -> CachedAnswer | None:
+    answer = None
+    for scope in self.scopes[subnet.family]:
+      if scope > subnet.source:
+        continue
+      answer = self.cache.lookup(name, rtype, klass,
+                                 self._partition(partition, subnet, scope))
+      if answer is not None:
+        break
+    metrics.ECS_LOOKUPS.inc('miss' if answer is None else 'hit')
+    return answer
+
+  def store(self, name: Name, rtype: int, klass: int,
+            records: list[ResourceRecord], partition: bytes,
+            subnet: ClientSubnet, scope: int) -> None:
+    scopes = self.scopes[subnet.family]
+    if scope not in scopes:
+      # a new list, lookups on other threads iterate the old one
+      self.scopes[subnet.family] = sorted(scopes + [scope], reverse=True)
+    self.cache.store(name, rtype, klass, records,
+                     self._partition(partition, subnet, scope))
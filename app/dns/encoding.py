@@ -1,109 +1,144 @@
 import logging
-import struct
 from app.dns.exceptions import FormatError
+from app.dns.name import MAX_NAME, Name
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-  from app.dns.common import CharacterString, DomainName
+  from app.dns.common import CharacterString
 
 logger = logging.getLogger(__name__)
 
 
 class Encoding:
   @staticmethod
-  def encode_domain_name(parts: list[str]) -> bytes:
-    res = b''
-    for part in parts:
-      ascii_part = part.encode('ascii')
-      part_length = len(ascii_part)
-      if part_length >= 63:
-        raise FormatError(
-            'Part \'{}\' of \'{}\' exceeds limit of 63 chars'
-            .format(part, '.'.join(parts))
-        )
-      res += len(ascii_part).to_bytes(1, 'big') + ascii_part
-
-    res = res + b'\x00'
-    return res
+  def encode_character_string(value: 'CharacterString | bytes') -> bytes:
+    if isinstance(value, str):
+      value = value.encode('ascii')
+    if len(value) > 255:
+      raise FormatError(f'Character string exceeds 255 octets: {value!r}')
+    return len(value).to_bytes(1, 'big') + value
 
   @staticmethod
-  def encode_character_string(value: 'CharacterString') -> bytes:
-    res = b''
-    ascii_value = value.encode('ascii')
-    res += len(ascii_value).to_bytes(1, 'big') + ascii_value
-
-    res = res + b'\x00'
-    return res
+  def encode_name(name: 'Name | str') -> bytes:
+    if isinstance(name, Name):
+      return name.wire
+    return Name.from_text(name).wire
 
   @staticmethod
-  def encode_ip(parts: list[int]) -> bytes:
-    res = b''
-    for part in parts:
-      res += int(part).to_bytes(1, 'big')
-    return res
+  def decode_domain_name(data: bytes, offset: int = 0,
+                         names: dict[int, bytes] | None = None
+                         ) -> tuple['Name', int]:
+    wire, i = Encoding.expand_name(data, offset, names)
+    return Name.from_wire(wire), i
 
   @staticmethod
-  def encode(value: str) -> bytes:
-    value = value.replace('@', '.')
-    value = value.replace('-', '.')
-    value = value.replace('+', '.')
-    parts = value.split('.')
-    try:
-      if isinstance(int(parts[0]), int):
-        return Encoding.encode_ip(parts)
-    except ValueError:
-      return Encoding.encode_domain_name(parts)
+  def decode_character_string(data: bytes, offset: int = 0) -> tuple['CharacterString', int]:
+    length = data[offset]
+    res = data[offset + 1:offset + 1 + length].decode('utf-8', 'replace')
+
+    return (res, length + 1)
 
   @staticmethod
-  def decode_domain_name(data: bytes, offset: int = 0) -> tuple['DomainName', int]:
-    i = offset
+  def expand_name(data: bytes, offset: int = 0,
+                  names: dict[int, bytes] | None = None) -> tuple[bytes, int]:
+    """
+    Reads a possibly compressed name and returns it in uncompressed wire
+    form, case preserved, with the offset just past it in `data`.
+
+    Every pointer has to point before the run of labels it ends, so
+    the walk always moves backwards and terminates; names longer than
+    255 octets are rejected. `names` caches the names and suffixes
+    decoded from one message by offset, records pointing at the same
+    suffix then cost a dict lookup.
+    """
+
+    if names is not None:
+      wire = names.get(offset)
+      if wire is not None:
+        return wire, Encoding.skip_name(data, offset)
+
     parts = []
+    targets = []
+    end = None
+    start = i = offset
+    size = len(data)
+    total = 0
     while True:
-      length = int.from_bytes(data[i:i+1], 'big')
-
-      if data[i] == 0x00:
-        i += 1
-        break
-      elif (length & 0xc0 == 0xc0):
-        pointer = struct.unpack("!H", data[i:i+2])[0]
-        pointer &= 0x3fff
-        i += 2
-        name = Encoding.decode_domain_name(data, pointer)[0]
-        parts.append(name)
+      if i >= size:
+        raise FormatError('Name runs past the end of the message')
+      length = data[i]
+      if length == 0:
         break
-      else:
-        i += 1
-        if (i + length) > len(data):
-          break
-
-        payload = data[i:i + length]
-        try:
-          name = payload.decode('utf-8')
-          parts.append(name)
-        except UnicodeDecodeError:
-          pass
-        i += length
-
-    name = '.'.join(parts)
-
-    return (name, i)
+      if length >= 0xc0:
+        if i + 1 >= size:
+          raise FormatError('Truncated compression pointer')
+        target = ((length & 0x3f) << 8) | data[i + 1]
+        if target >= start:
+          raise FormatError(f'Compression pointer at {i} does not point '
+                            'backwards')
+        # copy the labels read so far in one slice and follow the pointer
+        parts.append(data[start:i])
+        if end is None:
+          end = i + 2
+        if names is not None:
+          cached = names.get(target)
+          if cached is not None:
+            if total + len(cached) > MAX_NAME:
+              raise FormatError(f'Name exceeds {MAX_NAME} octets')
+            parts.append(cached)
+            start = None
+            break
+          targets.append((target, total))
+        start = i = target
+        continue
+      if length > 63:
+        raise FormatError(f'Unsupported label type {length:#x}')
+      total += length + 1
+      if total >= MAX_NAME:
+        raise FormatError(f'Name exceeds {MAX_NAME} octets')
+      i += length + 1
+
+    if end is None:
+      wire = bytes(data[offset:i + 1])
+      end = i + 1
+    else:
+      if start is not None:
+        parts.append(data[start:i + 1])
+      wire = b''.join(parts)
+    if names is not None:
+      names[offset] = wire
+      for target, position in targets:
+        names[target] = wire[position:]
+    return wire, end
 
   @staticmethod
-  def decode_character_string(data: bytes, offset: int = 0) -> tuple['CharacterString', int]:
-    length = int.from_bytes(data[offset:1], 'big')
-    res = data[offset+1:length].decode('utf-8')
+  def skip_name(data: bytes, offset: int = 0) -> int:
+    """
+    Offset just past the (possibly compressed) name at `offset`, without
+    decoding it.
+    """
 
-    return (res, length + 1)
+    i = offset
+    size = len(data)
+    while i < size:
+      length = data[i]
+      if length == 0:
+        return i + 1
+      if length >= 0xc0:
+        return i + 2
+      i += length + 1
+    raise FormatError('Name runs past the end of the message')
 
   @staticmethod
-  def decode_ip(data: bytes, offset: int = 0) -> tuple[str, int]:
-    res = '{}.{}.{}.{}'.format(int.from_bytes(data[offset+0:offset+1], 'big'), int.from_bytes(
-        data[offset+1:offset+2], 'big'), int.from_bytes(data[offset+2:offset+3], 'big'), int.from_bytes(data[offset+3:offset+4], 'big'))
-    return (res, 4)
+  def name_text(wire: bytes, offset: int = 0) -> tuple[str, int]:
+    """
+    Presentation form of an uncompressed wire name at `offset`.
+    """
 
-  @staticmethod
-  def decode(data: bytes, offset: int = 0) -> tuple[str, int]:
-    if data[-1] == b'\x00':
-      return Encoding.decode_ip(data, offset)
-    else:
-      return Encoding.decode_domain_name(data, offset)
+    parts = []
+    i = offset
+    while wire[i] != 0:
+      length = wire[i]
+      parts.append(wire[i + 1:i + 1 + length].decode('utf-8', 'replace'))
+      i += length + 1
+    return '.'.join(parts), i + 1
@@ -23,3 +23,7 @@ class NotImplementedError(DNSError):
 
 class RefuseError(DNSError):
   rcode: ResponseCode = ResponseCode.REFUSED
+
+
+class UpstreamError(DNSError):
+  rcode: ResponseCode = ResponseCode.SERVER_FAILURE
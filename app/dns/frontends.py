@@ -0,0 +1,405 @@
+import base64
+import collections
+import logging
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qs, urlsplit
+
+from app.dns import metrics
+from app.dns.common import _Address
+from app.dns.tcp import _Waiter, frame
+
+logger = logging.getLogger(__name__)
+
+# submit(buf, source, transport, reply) -> whether the query was accepted
+Submit = Callable[[bytes, _Address, str, Callable[[bytes], None]], bool]
+
+
+def create_tls_context(cert: str, key: str,
+                       alpn: list[str] | None = None) -> ssl.SSLContext:
+  """
+  Server side TLS context. Session tickets (TLS 1.3) and the OpenSSL
+  session cache (TLS 1.2) are left on so returning clients resume
+  instead of paying for a full handshake.
+  """
+
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  context.minimum_version = ssl.TLSVersion.TLSv1_2
+  context.load_cert_chain(cert, key)
+  context.num_tickets = 2
+  if alpn:
+    context.set_alpn_protocols(alpn)
+  return context
+
+
+class _ConnectionLimit:
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.active = 0
+    self.refused = 0
+    self._lock = threading.Lock()
+
+  def acquire(self) -> bool:
+    with self._lock:
+      if self.active >= self.limit:
+        self.refused += 1
+        return False
+      self.active += 1
+      return True
+
+  def release(self) -> None:
+    with self._lock:
+      self.active -= 1
+
+
+class _DoTConnection:
+  """
+  One DoT client. A single thread owns the TLS socket and does all its
+  reads and writes (OpenSSL objects must not be read and written from
+  two threads at once). Answers arrive from the query loop through
+  `reply`, which only appends them to a bounded buffer and wakes the
+  connection thread, so a client that stops reading never blocks the
+  loop; once more than `max_pending` bytes are waiting the connection
+  is closed instead.
+  """
+
+  max_pending = 256 * 1024
+
+  def __init__(self, server: 'DoTServer', tls: ssl.SSLSocket,
+               source: _Address):
+    self.server = server
+    self.tls = tls
+    self.source = source
+    self.closed = False
+    self.pending: collections.deque[bytes] = collections.deque()
+    self.pending_bytes = 0
+    self._lock = threading.Lock()
+    self._wake_r, self._wake_w = socket.socketpair()
+    self._wake_r.setblocking(False)
+    self._wake_w.setblocking(False)
+
+  def reply(self, res: bytes) -> None:
+    """
+    Queues an answer, called from the query loop; never blocks.
+    """
+
+    with self._lock:
+      if self.closed:
+        return
+      if self.pending_bytes + len(res) + 2 > self.max_pending:
+        logger.debug(f'DoT client {self.source} is not reading, closing')
+        metrics.DROPPED.inc('slow-client')
+        self.closed = True
+      else:
+        self.pending.append(frame(res))
+        self.pending_bytes += len(res) + 2
+    try:
+      self._wake_w.send(b'\0')
+    except (BlockingIOError, OSError):
+      # a wakeup is already pending, or the connection is gone
+      pass
+
+  def serve(self) -> None:
+    tls = self.tls
+    tls.setblocking(False)
+    inbuf = bytearray()
+    outbuf = b''
+    deadline = time.monotonic() + self.server.idle_timeout
+    try:
+      while not self.closed:
+        if not outbuf:
+          outbuf = self._take()
+        # data OpenSSL already decrypted never shows up in select
+        if tls.pending():
+          readable = [tls]
+        else:
+          timeout = deadline - time.monotonic()
+          if timeout <= 0 and not outbuf:
+            break
+          readable, writable, _ = select.select(
+              [tls, self._wake_r], [tls] if outbuf else [], [],
+              max(timeout, 0.5 if outbuf else 0))
+          if self._wake_r in readable:
+            self._drain_wakeups()
+          if outbuf and tls in writable:
+            outbuf = self._write(outbuf)
+        if tls in readable:
+          data = self._read()
+          if data is None:
+            break
+          if data:
+            deadline = time.monotonic() + self.server.idle_timeout
+            inbuf += data
+            self._submit(inbuf)
+    except (OSError, ssl.SSLError) as e:
+      logger.debug(f'DoT connection {self.source} closed: {e}')
+    finally:
+      with self._lock:
+        self.closed = True
+        self.pending.clear()
+      self._wake_r.close()
+      self._wake_w.close()
+      tls.close()
+
+  def _take(self) -> bytes:
+    with self._lock:
+      if not self.pending:
+        return b''
+      data = b''.join(self.pending)
+      self.pending.clear()
+      self.pending_bytes = 0
+      return data
+
+  def _drain_wakeups(self) -> None:
+    try:
+      while self._wake_r.recv(4096):
+        pass
+    except BlockingIOError:
+      pass
+
+  def _write(self, outbuf: bytes) -> bytes:
+    try:
+      sent = self.tls.send(outbuf[:16384])
+    except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+      return outbuf
+    return outbuf[sent:]
+
+  def _read(self) -> bytes | None:
+    """
+    What the client sent so far, b'' when nothing is ready yet and None
+    once it closed the connection.
+    """
+
+    try:
+      data = self.tls.recv(16384)
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+      return b''
+    return data or None
+
+  def _submit(self, inbuf: bytearray) -> None:
+    while len(inbuf) >= 2:
+      length = struct.unpack_from('!H', inbuf)[0]
+      if len(inbuf) < 2 + length:
+        break
+      buf = bytes(inbuf[2:2 + length])
+      del inbuf[:2 + length]
+      if length < 12:
+        metrics.PARSE_FAILURES.inc()
+        metrics.DROPPED.inc('malformed')
+        continue
+      self.server.submit(buf, self.source, self.server.transport, self.reply)
+
+
+class DoTServer:
+  """
+  DNS over TLS (RFC 7858) listener. Each connection is served by its own
+  thread which reads length-prefixed queries and submits them to the
+  shared query pipeline without waiting for earlier answers; answers
+  are written back as they complete, possibly out of order (RFC 7766).
+  Idle connections are closed after `idle_timeout`.
+  """
+
+  transport = 'tls'
+
+  def __init__(self, address: _Address, context: ssl.SSLContext,
+               submit: Submit, max_connections: int = 512,
+               idle_timeout: float = 30.0,
+               sock: socket.socket | None = None):
+    self.address = address
+    self.context = context
+    self.submit = submit
+    self.idle_timeout = idle_timeout
+    self.connections = _ConnectionLimit(max_connections)
+    self.sock = sock or socket.create_server(address, reuse_port=False)
+    # after a handoff two processes poll the listener, only one of them
+    # gets each connection
+    self.sock.setblocking(False)
+    self._stopping = False
+    self._thread = threading.Thread(target=self._accept, name='dot-accept',
+                                    daemon=True)
+
+  def start(self) -> None:
+    self._thread.start()
+    logger.info(f'DoT listening on {self.address[0]}:{self.address[1]}')
+
+  def _accept(self) -> None:
+    while not self._stopping:
+      if not select.select([self.sock], [], [], 0.5)[0]:
+        continue
+      try:
+        conn, source = self.sock.accept()
+      except BlockingIOError:
+        continue
+      except OSError as e:
+        logger.error(f'DoT accept failed: {e}')
+        break
+      if not self.connections.acquire():
+        conn.close()
+        continue
+      threading.Thread(target=self._serve, args=(conn, source),
+                       name=f'dot-{source[0]}:{source[1]}', daemon=True).start()
+
+  def _serve(self, conn: socket.socket, source: _Address) -> None:
+    try:
+      conn.settimeout(self.idle_timeout)
+      tls = self.context.wrap_socket(conn, server_side=True)
+    except (OSError, ssl.SSLError) as e:
+      logger.debug(f'DoT handshake with {source} failed: {e}')
+      conn.close()
+      self.connections.release()
+      return
+    try:
+      _DoTConnection(self, tls, source).serve()
+    finally:
+      self.connections.release()
+
+  def stop(self) -> None:
+    """
+    Stops accepting, connections already open are still served.
+    """
+
+    self._stopping = True
+
+  def close(self) -> None:
+    self.sock.close()
+
+
+class _DoHHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  server: 'DoHServer'
+
+  def do_GET(self) -> None:
+    url = urlsplit(self.path)
+    if url.path != self.server.path:
+      self._error(404)
+      return
+    values = parse_qs(url.query).get('dns')
+    if not values:
+      self._error(400)
+      return
+    try:
+      value = values[0]
+      buf = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+    except ValueError:
+      self._error(400)
+      return
+    self._resolve(buf)
+
+  def do_POST(self) -> None:
+    # a rejected body is never read, the connection is closed instead
+    # of parsing it as the next request
+    if urlsplit(self.path).path != self.server.path:
+      self._error(404, close=True)
+      return
+    if self.headers.get('Content-Type') != 'application/dns-message':
+      self._error(415, close=True)
+      return
+    try:
+      length = int(self.headers.get('Content-Length', 0))
+    except ValueError:
+      length = 0
+    if length < 12 or length > 65535:
+      self._error(400, close=True)
+      return
+    self._resolve(self.rfile.read(length))
+
+  def _resolve(self, buf: bytes) -> None:
+    waiter = _Waiter()
+    if len(buf) < 12 or not self.server.submit(
+        buf, self.client_address, self.server.transport, waiter.set):
+      self._error(503)
+      return
+    res = waiter.wait(self.server.query_timeout)
+    if res is None:
+      self._error(504)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/dns-message')
+    self.send_header('Content-Length', str(len(res)))
+    self.end_headers()
+    self.wfile.write(res)
+
+  def _error(self, code: int, close: bool = False) -> None:
+    self.send_response(code)
+    self.send_header('Content-Length', '0')
+    if close:
+      self.send_header('Connection', 'close')
+      self.close_connection = True
+    self.end_headers()
+
+  def log_message(self, format: str, *args) -> None:
+    pass
+
+
+class DoHServer(ThreadingHTTPServer):
+  """
+  DNS over HTTPS (RFC 8484) listener, GET and POST with
+  application/dns-message over keep-alive HTTP/1.1. The TLS handshake
+  is deferred to the connection's thread so a slow client never stalls
+  the accept loop.
+  """
+
+  daemon_threads = True
+  transport = 'https'
+
+  def __init__(self, address: _Address, context: ssl.SSLContext,
+               submit: Submit, path: str = '/dns-query',
+               max_connections: int = 512, idle_timeout: float = 30.0,
+               query_timeout: float = 5.0,
+               sock: socket.socket | None = None):
+    super().__init__(address, _DoHHandler, bind_and_activate=sock is None)
+    if sock is not None:
+      self.socket.close()
+      self.socket = sock
+      self.server_address = sock.getsockname()
+    # see DoTServer, accept() must not block once the listener is shared
+    self.socket.setblocking(False)
+    self.context = context
+    self.submit = submit
+    self.path = path
+    self.idle_timeout = idle_timeout
+    self.query_timeout = query_timeout
+    self.connections = _ConnectionLimit(max_connections)
+    self._thread = threading.Thread(target=self.serve_forever,
+                                    name='doh-accept', daemon=True)
+
+  def start(self) -> None:
+    self._thread.start()
+    host, port = self.server_address[:2]
+    logger.info(f'DoH listening on https://{host}:{port}{self.path}')
+
+  def stop(self) -> None:
+    """
+    Stops accepting without waiting for the accept loop to notice.
+    """
+
+    threading.Thread(target=self.shutdown, daemon=True).start()
+
+  def get_request(self) -> tuple[socket.socket, _Address]:
+    conn, source = self.socket.accept()
+    conn.settimeout(self.idle_timeout)
+    return self.context.wrap_socket(
+        conn, server_side=True, do_handshake_on_connect=False), source
+
+  def process_request(self, request: socket.socket, source: _Address) -> None:
+    if not self.connections.acquire():
+      self.shutdown_request(request)
+      return
+    super().process_request(request, source)
+
+  def process_request_thread(self, request: socket.socket,
+                             source: _Address) -> None:
+    try:
+      request.do_handshake()
+      super().process_request_thread(request, source)
+    except (OSError, ssl.SSLError) as e:
+      logger.debug(f'DoH connection {source} failed: {e}')
+      self.shutdown_request(request)
+    finally:
+      self.connections.release()
@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import socket
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+TAKEOVER = b'takeover\n'
+READY = b'ready\n'
+# file descriptors passed in one message, more than a server listens on
+MAX_SOCKETS = 16
+
+
+class HandoffListener:
+  """
+  Unix socket through which a newly started server takes over the
+  listening sockets of this one. The new process connects and asks for
+  them; they are passed with SCM_RIGHTS, so both processes hold the same
+  sockets and no datagram or connection waiting in the kernel is lost.
+  `prepare` runs before the sockets are sent (to save state the new
+  process will load) and, once the new process reports it is reading,
+  `on_handoff` for this one to stop reading and drain.
+  """
+
+  def __init__(self, path: str, sockets: dict[str, socket.socket],
+               on_handoff: Callable[[], None],
+               prepare: Callable[[], None] | None = None):
+    self.path = path
+    self.sockets = sockets
+    self.on_handoff = on_handoff
+    self.prepare = prepare
+    self.handed_off = False
+    if os.path.exists(path):
+      os.unlink(path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.bind(path)
+    os.chmod(path, 0o600)
+    self.sock.listen(1)
+    self._thread = threading.Thread(target=self._accept, name='handoff',
+                                    daemon=True)
+
+  def start(self) -> None:
+    self._thread.start()
+    logger.info(f'Handing off sockets through {self.path}')
+
+  def _accept(self) -> None:
+    while True:
+      try:
+        conn, _ = self.sock.accept()
+      except OSError:
+        break
+      with conn:
+        if self._hand_off(conn):
+          break
+    self.sock.close()
+
+  def _hand_off(self, conn: socket.socket) -> bool:
+    try:
+      conn.settimeout(30.0)
+      if conn.recv(len(TAKEOVER)) != TAKEOVER:
+        return False
+      if self.prepare is not None:
+        self.prepare()
+      names = list(self.sockets)
+      socket.send_fds(conn, [json.dumps(names).encode('ascii')],
+                      [self.sockets[name].fileno() for name in names])
+      # the new process may load a large cache snapshot first; if it
+      # dies instead the connection closes
+      conn.settimeout(None)
+      if conn.recv(len(READY)) != READY:
+        logger.warning('Handoff aborted by the new process')
+        return False
+    except OSError as e:
+      logger.warning(f'Handoff failed: {e}')
+      return False
+    logger.info(f'Handed off {", ".join(names)}')
+    self.handed_off = True
+    self.on_handoff()
+    return True
+
+  def close(self) -> None:
+    self.sock.close()
+    # after a handoff the path belongs to the new process
+    if not self.handed_off and os.path.exists(self.path):
+      os.unlink(self.path)
+
+
+class Takeover:
+  """
+  Sockets received from a running server, by name. Call `ready` once
+  they are being served so the old process starts draining.
+  """
+
+  def __init__(self, conn: socket.socket, sockets: dict[str, socket.socket]):
+    self.conn = conn
+    self.sockets = sockets
+
+  def ready(self) -> None:
+    try:
+      self.conn.sendall(READY)
+    except OSError as e:
+      logger.warning(f'Could not confirm the takeover: {e}')
+    self.conn.close()
+
+
+def take_over(path: str, timeout: float = 10.0) -> Takeover | None:
+  """
+  Asks the server listening on `path` for its sockets. Returns None when
+  no server is running there.
+  """
+
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  conn.settimeout(timeout)
+  try:
+    conn.connect(path)
+  except (FileNotFoundError, ConnectionRefusedError):
+    conn.close()
+    return None
+  try:
+    conn.sendall(TAKEOVER)
+    data, fds, _, _ = socket.recv_fds(conn, 4096, MAX_SOCKETS)
+    names = json.loads(data)
+  except (OSError, ValueError) as e:
+    conn.close()
+    raise OSError(f'Taking over sockets from {path} failed: {e}')
+  sockets = {name: socket.socket(fileno=fd) for name, fd in zip(names, fds)}
+  logger.info(f'Took over {", ".join(sockets)} from {path}')
+  return Takeover(conn, sockets)
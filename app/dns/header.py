@@ -7,37 +7,59 @@ from app.dns.common import OpCode, ResponseCode, debug
 logger = logging.getLogger(__name__)
 
 
+def _flag(shift: int, mask: int) -> property:
+  """
+  Property reading and writing one field of the packed flags word.
+  """
+
+  def get(self: 'HeaderFlags') -> int:
+    return (self.value >> shift) & mask
+
+  def set(self: 'HeaderFlags', value: int) -> None:
+    self.value = (self.value & ~(mask << shift)) | ((int(value) & mask) << shift)
+
+  return property(get, set)
+
+
 class HeaderFlags:
-  qr: int
-  opcode: int
-  aa: int
-  tc: int
-  rd: int
-  ra: int
-  z: int
-  rcode: int
+  """
+  The 16 bit flags word of the header, kept packed as on the wire. The
+  fields are views on it.
+  """
+
+  __slots__ = ('value',)
+
+  qr = _flag(15, 0x1)
+  opcode = _flag(11, 0xf)
+  aa = _flag(10, 0x1)
+  tc = _flag(9, 0x1)
+  rd = _flag(8, 0x1)
+  ra = _flag(7, 0x1)
+  z = _flag(4, 0x7)
+  # the DNSSEC bits of z (RFC 4035 3.2): authentic data, checking disabled
+  ad = _flag(5, 0x1)
+  cd = _flag(4, 0x1)
+  rcode = _flag(0, 0xf)
 
   def __init__(self, qr: int = 0, opcode: int = 0, aa: int = 0, tc: int = 0, rd: int = 0, ra: int = 0, z: int = 0, rcode: int = 0):
-    self.qr: int = qr
-    self.opcode: int = opcode
-    self.aa: int = aa
-    self.tc: int = tc
-    self.rd: int = rd
-    self.ra: int = ra
-    self.z: int = z
-    self.rcode: int = rcode
+    self.value: int = (
+        ((qr & 0x1) << 15)
+        | ((opcode & 0xf) << 11)
+        | ((aa & 0x1) << 10)
+        | ((tc & 0x1) << 9)
+        | ((rd & 0x1) << 8)
+        | ((ra & 0x1) << 7)
+        | ((z & 0x7) << 4)
+        | (rcode & 0xf)
+    )
 
   def __index__(self) -> int:
-    return (
-        (self.qr << 15)
-        | (self.opcode << 11)
-        | (self.aa << 10)
-        | (self.tc << 9)
-        | (self.rd << 8)
-        | (self.ra << 7)
-        | (self.z << 4)
-        | self.rcode
-    )
+    return self.value
+
+  def __copy__(self) -> 'HeaderFlags':
+    result = HeaderFlags.__new__(HeaderFlags)
+    result.value = self.value
+    return result
 
   def __bytes__(self) -> bytes:
     return struct.pack('>H', int(self))
@@ -48,7 +70,11 @@ class HeaderFlags:
       if getattr(self, f) == 1:
         m += f' {f}'
 
-    if self.z != 0:
+    for f in ['ad', 'cd']:
+      if getattr(self, f) == 1:
+        m += f' {f}'
+
+    if self.value & 0x40:
       m += ' ZZ'
 
     return m
@@ -57,7 +83,8 @@ class HeaderFlags:
     return bytes(self)
 
   def validate(self) -> ResponseCode:
-    if self.z != 0:
+    # only the bit left of AD and CD is still reserved
+    if self.value & 0x40:
       logger.error('Header Z must be 0')
       return ResponseCode.FORMAT_ERROR
 
@@ -65,35 +92,27 @@ class HeaderFlags:
       logger.error(f'OpCode ({self.opcode}) not supported')
       return ResponseCode.NOT_IMPLEMENTED
 
-    if not ResponseCode.value_exists(self.opcode):
+    if not ResponseCode.value_exists(self.rcode):
       logger.error(f'Response Code ({self.rcode}) not supported')
       return ResponseCode.NOT_IMPLEMENTED
 
     return ResponseCode.NO_ERROR
 
   @classmethod
-  def from_bytes(cls, data: bytes) -> "HeaderFlags":
-    flag_parameters = {
-        'qr': (data & 0x8000) >> 15,
-        'opcode': (data & 0x7800) >> 11,
-        'aa': (data & 0x0400) >> 10,
-        'tc': (data & 0x0200) >> 9,
-        'rd': (data & 0x0100) >> 8,
-        'ra': (data & 0x0080) >> 7,
-        'z': (data & 0x0070) >> 4,
-        'rcode': (data & 0x000f) >> 0,
-    }
-
-    debug(**flag_parameters, data=data, offset=0)
-
-    return cls(**flag_parameters)
+  def from_bytes(cls, data: int) -> "HeaderFlags":
+    debug(data=data, offset=0)
+    result = cls.__new__(cls)
+    result.value = data & 0xffff
+    return result
 
   @classmethod
   def empty(cls) -> "HeaderFlags":
-    return cls(qr=0, opcode=0, aa=0, tc=0, rd=0, ra=0, z=0, rcode=0,)
+    result = cls.__new__(cls)
+    result.value = 0
+    return result
 
 
-@dataclass
+@dataclass(slots=True)
 class Header:
   id: int
   flags: HeaderFlags = field(default_factory=HeaderFlags.empty)
@@ -150,7 +169,7 @@ class Header:
   def empty(cls) -> "Header":
     import random
     _id = random.randint(0x0000, 0xFFFF)
-    logger.info('Creating empty Header with ID: {_id}')
+    logger.debug(f'Creating empty Header with ID: {_id}')
     return cls(
         id=_id,
         flags=HeaderFlags.empty(),
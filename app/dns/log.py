@@ -0,0 +1,121 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+QUERY_FORMAT = ('client=%s qname=%s qtype=%s rcode=%s '
+                'latency=%.3fms cache=%s')
+
+query_logger = logging.getLogger('app.query')
+
+
+class BoundedQueueHandler(QueueHandler):
+  """
+  QueueHandler that never blocks the caller: records are handed to a
+  bounded queue drained by a QueueListener thread and dropped (and
+  counted) when the writer can't keep up.
+  """
+
+  def __init__(self, maxsize: int = 10000):
+    super().__init__(queue.Queue(maxsize=maxsize))
+    self.dropped: int = 0
+    self.listener: QueueListener | None = None
+
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    # Formatting is deferred to the listener thread, the queue never
+    # leaves the process so the record does not need to be flattened.
+    return record
+
+  def enqueue(self, record: logging.LogRecord) -> None:
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+  def start(self, *handlers: logging.Handler) -> None:
+    self.listener = QueueListener(
+        self.queue, *handlers, respect_handler_level=True)
+    self.listener.start()
+    atexit.register(self.stop)
+    # worker processes are forked: the listener thread is stopped around
+    # fork() so the queue's lock is never copied while held, and started
+    # again on both sides
+    os.register_at_fork(before=self._pause, after_in_parent=self._resume,
+                        after_in_child=self._resume)
+
+  def _pause(self) -> None:
+    if self.listener is not None:
+      self.listener.stop()
+
+  def _resume(self) -> None:
+    if self.listener is not None:
+      self.listener.start()
+
+  def stop(self) -> None:
+    if self.listener is not None:
+      self.listener.stop()
+      self.listener = None
+
+
+def get_queue_handler() -> BoundedQueueHandler | None:
+  for handler in logging.getLogger().handlers:
+    if isinstance(handler, BoundedQueueHandler):
+      return handler
+  return None
+
+
+def dropped_records() -> int:
+  handler = get_queue_handler()
+  return handler.dropped if handler is not None else 0
+
+
+def create_queue_handler(level: int, maxsize: int = 10000) -> BoundedQueueHandler:
+  stream = logging.StreamHandler(sys.stdout)
+  stream.setLevel(level)
+  stream.setFormatter(logging.Formatter(
+      '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+  handler = BoundedQueueHandler(maxsize=maxsize)
+  handler.setLevel(level)
+  handler.start(stream)
+  return handler
+
+
+def log_query(client: tuple[str, int] | str, qname: str, qtype: int,
+              rcode: int, latency: float, cache: str = 'none') -> None:
+  """
+  Emits the single summary record for a handled query. The message is
+  formatted lazily by the listener thread, the fields are also attached
+  to the record for structured consumers.
+
+  :param latency: Handling time in seconds.
+  """
+
+  if not query_logger.isEnabledFor(logging.INFO):
+    return
+
+  if isinstance(client, tuple):
+    client = f'{client[0]}:{client[1]}'
+  query_logger.info(
+      QUERY_FORMAT, client, qname, qtype, rcode, latency * 1000, cache,
+      extra={
+          'client': client,
+          'qname': qname,
+          'qtype': qtype,
+          'rcode': rcode,
+          'latency': latency,
+          'cache': cache,
+      }
+  )
+
+
+def set_log_level(level: int) -> None:
+  root = logging.getLogger()
+  root.setLevel(level)
+  for handler in root.handlers:
+    handler.setLevel(level)
+    if isinstance(handler, BoundedQueueHandler) and handler.listener:
+      for h in handler.listener.handlers:
+        h.setLevel(level)
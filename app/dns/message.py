@@ -1,15 +1,51 @@
 import copy
 import logging
-import socket
 from dataclasses import dataclass, field
-from app.dns.common import debug, ResponseCode, _Address
-from app.dns.exceptions import NotImplementedError
+from typing import TYPE_CHECKING
+from app.dns import metrics
+from app.dns.common import debug, ResponseCode, RType
+from app.dns.exceptions import FormatError, NotImplementedError
 from app.dns.header import Header
+from app.dns.name import ROOT
+from app.dns.rdata import RDATA_OPT
 from app.dns.record import ResourceRecord, Query, Record, BaseRecord
+from app.dns.profiling import NULL_SAMPLE, StageSample
+
+if TYPE_CHECKING:
+  from app.dns.cache import RRsetCache
+  from app.dns.ecs import ClientSubnet, SubnetCache
+  from app.dns.nsec import NsecCache
+  from app.dns.upstream import UpstreamPool
 
 SectionResponse = dict[str, list[Record]]
 logger = logging.getLogger(__name__)
 
+# UDP payload size without EDNS (RFC 1035 4.2.1), and the most we send
+# whatever a client advertises
+UDP_PAYLOAD = 512
+MAX_UDP_PAYLOAD = 4096
+# advertised in the OPT record of queries sent upstream; larger answers
+# come back truncated and are retried over TCP
+UPSTREAM_PAYLOAD = 512
+# DO bit of the OPT record's TTL field (RFC 3225)
+DNSSEC_OK = 0x8000
+
+
+def _upstream_opt(subnet: 'ClientSubnet | None' = None,
+                  dnssec_ok: bool = False) -> ResourceRecord | None:
+  """
+  OPT record for queries sent upstream, None when they need none.
+  """
+
+  if subnet is None and not dnssec_ok:
+    return None
+  options = [subnet.edns_option()] if subnet is not None else []
+  rdata = RDATA_OPT(RDATA_OPT.encode(options=options))
+  return ResourceRecord(name=ROOT, type=RType.OPT.value,
+                        klass=UPSTREAM_PAYLOAD,
+                        ttl=DNSSEC_OK if dnssec_ok else 0,
+                        rdlength=len(rdata), rdata=rdata)
+
 
 @dataclass
 class Message:
@@ -19,6 +55,8 @@ class Message:
   answers: list[Record] = field(default_factory=list)
   authorities: list[Record] = field(default_factory=list)
   additional: list[Record] = field(default_factory=list)
+  # how the cache served a response: none, hit, miss or partial
+  cache: str = 'none'
 
   sections = {
       'queries': 'qdcount',
@@ -63,21 +101,17 @@ class Message:
 
     for key, count in Message.sections.items():
       section = getattr(self, key)
-      section_size = len(section)
+      # a cached answer entry stands for several records
+      section_size = sum(getattr(q, 'count', 1) for q in section)
       if section_size < 1:
-        logger.info(f'Section {key} has no value')
         continue
 
-      logger.info(
-          f'Assigning size of {key} ({section_size}) to Header.{count}'
-      )
       setattr(self.header, count, section_size)
 
     res = bytes(self.header)
 
     for key in Message.sections:
       section: list[Record] = getattr(self, key)
-      logger.info(f'Serializing section: {key}')
       for q in section:
         try:
           res += bytes(q)
@@ -89,6 +123,60 @@ class Message:
   def serialize(self) -> bytes:
     return bytes(self)
 
+  def dnssec_ok(self) -> bool:
+    """
+    Whether the sender of this query wants DNSSEC records (RFC 3225).
+    """
+
+    return any(record.type == RType.OPT.value and record.ttl & DNSSEC_OK
+               for record in self.additional)
+
+  def udp_payload_size(self) -> int:
+    """
+    Largest UDP response the sender of this query accepts: the size in
+    its EDNS OPT record (RFC 6891 6.2.5), 512 without one.
+    """
+
+    for record in self.additional:
+      if record.type == RType.OPT.value:
+        return min(max(UDP_PAYLOAD, record.klass), MAX_UDP_PAYLOAD)
+    return UDP_PAYLOAD
+
+  def truncated(self) -> 'Message':
+    """
+    This response without its records and with TC set, telling a UDP
+    client to retry over TCP (RFC 2181 9). An OPT record is kept.
+    """
+
+    header = copy.copy(self.header)
+    header.flags.tc = 1
+    additional = [record for record in self.additional
+                  if record.type == RType.OPT.value]
+    header.ancount = 0
+    header.nscount = 0
+    header.arcount = len(additional)
+    return Message(header=header, queries=self.queries,
+                   additional=additional, cache=self.cache)
+
+  def local_response(self, rcode: ResponseCode,
+                     answers: list[Record] | None = None,
+                     authorities: list[Record] | None = None,
+                     authoritative: bool = False) -> 'Message':
+    """
+    Response to this query made up here rather than resolved: from the
+    server's own zones or from a policy.
+    """
+
+    message = copy.copy(self)
+    message.header.flags.qr = 1
+    message.header.flags.aa = int(authoritative)
+    message.header.flags.rcode = rcode.value
+    message.answers = answers or []
+    message.authorities = authorities or []
+    message.header.ancount = len(message.answers)
+    message.header.nscount = len(message.authorities)
+    return message
+
   def validate(self) -> ResponseCode:
     header_res = self.header.validate()
 
@@ -115,63 +203,147 @@ class Message:
       raise e
     return cls(header=header, data=data, **container)
 
-  def create_response(self, resolver: _Address | None = None) -> 'Message':
+  def create_response(self, resolver: 'UpstreamPool | None' = None,
+                      sample: StageSample = NULL_SAMPLE,
+                      deadline: float | None = None,
+                      cache: 'RRsetCache | None' = None,
+                      partition: bytes = b'',
+                      subnets: 'SubnetCache | None' = None,
+                      client: str | None = None,
+                      nsec: 'NsecCache | None' = None) -> 'Message':
+    """
+    Response to this query, resolved through `resolver` when given.
+    With `subnets` the client's network (from its address `client`) is
+    sent upstream (RFC 7871) and tailored answers are cached there,
+    looked up before the shared answers of `cache`. With `nsec` DNSSEC
+    records are asked for and the NSEC ranges of validated negative
+    answers are cached there.
+    """
+
     if self.header.flags.qr == 1:
       logger.error('Can\'t create a response on a response')
       return self
     message = copy.copy(self)
     res = self.validate()
+    sample.mark('validate')
     if res != ResponseCode.NO_ERROR:
       message.header.flags.qr = 1
       message.header.flags.rcode = res.value
       return message
 
-    for query in message.queries:
+    if resolver is not None:
+      subnet = None
+      if subnets is not None and client is not None:
+        subnet = subnets.subnet(client, self)
+      cached = [None] * len(message.queries)
+      if subnet is not None:
+        cached = [subnets.lookup(query.name, query.type, query.klass,
+                                 partition, subnet)
+                  for query in message.queries]
+      if cache is not None:
+        cached = [hit or cache.lookup(query.name, query.type, query.klass,
+                                      partition)
+                  for hit, query in zip(cached, message.queries)]
+      if cache is not None or subnet is not None:
+        hits = len(cached) - cached.count(None)
+        message.cache = ('miss' if hits == 0 else
+                         'hit' if hits == len(cached) else 'partial')
+      # one upstream query per question not answered from the cache,
+      # resolved concurrently
+      misses = [i for i, hit in enumerate(cached) if hit is None]
+      edns = _upstream_opt(subnet, dnssec_ok=nsec is not None)
+      forwarded = {i: self._question_query(message.queries[i], edns)
+                   for i in misses}
+      # what the forwarded queries carry beyond header and question
+      extra = len(bytes(edns)) if edns is not None else 0
+      if misses:
+        results = dict(zip(misses, resolver.exchange_many(
+            [forwarded[i] for i in misses], deadline=deadline)))
+
+    for i, query in enumerate(message.queries):
       if resolver is None:
-        logger.info(f'Creating response for {query.name}')
+        logger.debug(f'Creating response for {query.name}')
         record = ResourceRecord.lookup(query=query)
-        message.answers.append(record)
+        if record is not None:
+          message.answers.append(record)
+      elif cached[i] is not None:
+        logger.debug(f'Cache hit for {query.name}')
+        message.answers.append(cached[i])
       else:
-        logger.info(f'Looking up {query.name}')
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(self.data, resolver)
-        _buf, _ = sock.recvfrom(512)
-        sock.close()
+        logger.debug(f'Looked up {query.name}')
+        _buf = results[i]
+        if isinstance(_buf, Exception):
+          raise _buf
 
-        if len(self.data) < len(_buf):
+        if len(forwarded[i]) - extra < len(_buf):
           resolved = Message.from_bytes(data=_buf)
+          if nsec is not None and not self.dnssec_ok():
+            # asked for on our behalf, not the client's
+            resolved.answers = [record for record in resolved.answers
+                                if record.type != RType.RRSIG.value]
           if len(resolved.answers) > 0:
             for record in resolved.answers:
               message.answers.append(record)
+            scope = 0
+            if subnet is not None:
+              scope = subnet.scope(resolved.additional)
+              metrics.ECS_ANSWERS.inc('subnet' if scope else 'global')
+            cacheable = (resolved.header.flags.rcode == 0
+                         and not resolved.header.flags.tc)
+            if cacheable and scope:
+              subnets.store(query.name, query.type, query.klass,
+                            resolved.answers, partition, subnet, scope)
+            elif cacheable and cache is not None:
+              cache.store(query.name, query.type, query.klass,
+                          resolved.answers, partition)
+          elif len(message.queries) == 1:
+            # a negative answer: its rcode and the SOA giving its TTL
+            message.header.flags.rcode = resolved.header.flags.rcode
+            message.authorities = [record for record in resolved.authorities
+                                   if record.type == RType.SOA.value]
+            if nsec is not None:
+              nsec.learn(resolved, partition)
         else:
           record = ResourceRecord.lookup(query=query)
-          message.answers.append(record)
+          if record is not None:
+            message.answers.append(record)
 
     message.header.flags.qr = 1
-    message.header.ancount = len(message.answers)
+    message.header.ancount = sum(getattr(record, 'count', 1)
+                                 for record in message.answers)
     return message
 
+  def _question_query(self, query: Record,
+                      edns: ResourceRecord | None = None) -> bytes:
+    header = copy.copy(self.header)
+    header.qdcount = 1
+    header.ancount = 0
+    header.nscount = 0
+    header.arcount = 0
+    additional = [edns] if edns is not None else []
+    return Message(header=header, queries=[query],
+                   additional=additional).serialize()
+
   @staticmethod
   def _build_sections(data: bytes, header: Header, position: int = 12) -> SectionResponse:
     container: SectionResponse = {}
+    # names decoded from this message by offset, shared by all records
+    names: dict[int, bytes] = {}
     for key, count in Message.sections.items():
       if key not in container:
         container[key] = []
       ranger = getattr(header, count)
-      logger.info(f'Header.{key} reports {ranger} record(s)')
 
       if key == 'queries' and ranger < 1:
-        raise AttributeError(
-            f'Attribute ({count}) requires a positive value',  name=count, object=header)
+        raise FormatError(f'Attribute ({count}) requires a positive value')
 
       if ranger > 0:
-        logger.info(f'Building {ranger} record(s) for Header. {key}')
         for _ in range(ranger):
           try:
             if key == 'queries':
-              record, position = Query.from_bytes(data, position)
+              record, position = Query.from_bytes(data, position, names)
             else:
-              record, position = BaseRecord.factory(data, position)
+              record, position = BaseRecord.factory(data, position, names)
             container[key].append(record)
           except NotImplementedError as e:
             setattr(header, count, ranger - 1)
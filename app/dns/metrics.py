@@ -0,0 +1,339 @@
+import bisect
+import json
+import logging
+import socket
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable
+
+from app.dns.common import RCODE_NAMES, type_name
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+Labels = tuple
+
+
+class _Metric:
+  """
+  Base for sharded metrics. Every thread updates its own shard without
+  taking a lock, shards are only merged when the registry is scraped.
+  The shard of a thread that exits is folded into a base shard, so
+  short-lived connection threads leave nothing behind.
+  """
+
+  kind = 'untyped'
+
+  def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+               format_labels: Callable[[Labels], Labels] | None = None):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.format_labels = format_labels or (lambda values: values)
+    self._local = threading.local()
+    self._base: dict = {}
+    self._shards: list[dict] = [self._base]
+    self._lock = threading.Lock()
+
+  def _shard(self) -> dict:
+    try:
+      return self._local.values
+    except AttributeError:
+      values: dict = {}
+      with self._lock:
+        self._shards.append(values)
+      self._local.values = values
+      weakref.finalize(threading.current_thread(), self._retire, values)
+      return values
+
+  def _retire(self, values: dict) -> None:
+    with self._lock:
+      self._merge(self._base, values)
+      # by identity, list.remove would drop any shard with equal counts
+      self._shards = [shard for shard in self._shards if shard is not values]
+
+  def _merge(self, total: dict, values: dict) -> None:
+    raise NotImplementedError
+
+  def _collect(self) -> dict:
+    total: dict = {}
+    with self._lock:
+      for values in self._shards:
+        self._merge(total, values)
+    return total
+
+  def _label_str(self, values: Labels, extra: str = '') -> str:
+    pairs = [f'{k}="{v}"' for k, v in
+             zip(self.labels, self.format_labels(values))]
+    if extra:
+      pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+  def render(self) -> list[str]:
+    return [f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+  kind = 'counter'
+
+  def inc(self, *labels, amount: int = 1) -> None:
+    values = self._shard()
+    values[labels] = values.get(labels, 0) + amount
+
+  def _merge(self, total: dict, values: dict) -> None:
+    for key, value in list(values.items()):
+      total[key] = total.get(key, 0) + value
+
+  def collect(self) -> dict[Labels, float]:
+    return self._collect()
+
+  def value(self, *labels) -> float:
+    return self.collect().get(labels, 0)
+
+  def render(self) -> list[str]:
+    lines = super().render()
+    for key, value in sorted(self.collect().items()):
+      lines.append(f'{self.name}{self._label_str(key)} {value}')
+    return lines
+
+
+class Histogram(_Metric):
+  kind = 'histogram'
+
+  def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+               buckets: tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+    super().__init__(name, help, labels, **kwargs)
+    self.buckets = buckets
+
+  def observe(self, value: float, *labels) -> None:
+    values = self._shard()
+    counts = values.get(labels)
+    if counts is None:
+      # one slot per bucket, +Inf, then the running sum
+      counts = values[labels] = [0] * (len(self.buckets) + 2)
+    counts[bisect.bisect_left(self.buckets, value)] += 1
+    counts[-1] += value
+
+  def _merge(self, total: dict, values: dict) -> None:
+    for key, counts in list(values.items()):
+      merged = total.setdefault(key, [0] * len(counts))
+      for i, count in enumerate(list(counts)):
+        merged[i] += count
+
+  def collect(self) -> dict[Labels, list[float]]:
+    return self._collect()
+
+  def render(self) -> list[str]:
+    lines = super().render()
+    for key, counts in sorted(self.collect().items()):
+      cumulative = 0
+      for bound, count in zip(self.buckets + (float('inf'),), counts):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        label_str = self._label_str(key, 'le="' + le + '"')
+        lines.append(f'{self.name}_bucket{label_str} {cumulative}')
+      lines.append(f'{self.name}_sum{self._label_str(key)} {counts[-1]}')
+      lines.append(f'{self.name}_count{self._label_str(key)} {cumulative}')
+    return lines
+
+
+class Gauge(_Metric):
+  """
+  Gauge read from a callback at scrape time. The callback returns a
+  number, or a mapping of label tuples to numbers for labelled gauges.
+  """
+
+  kind = 'gauge'
+
+  def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+               callback: Callable[[], float | dict] | None = None, **kwargs):
+    super().__init__(name, help, labels, **kwargs)
+    self.callbacks: list[Callable[[], float | dict]] = []
+    if callback is not None:
+      self.callbacks.append(callback)
+
+  def set_function(self, callback: Callable[[], float | dict]) -> None:
+    self.callbacks.append(callback)
+
+  def collect(self) -> dict[Labels, float]:
+    total: dict[Labels, float] = {}
+    for callback in list(self.callbacks):
+      try:
+        value = callback()
+      except Exception as e:
+        logger.warning(f'Gauge {self.name} callback failed: {e}')
+        continue
+      if not isinstance(value, dict):
+        value = {(): value}
+      for key, v in value.items():
+        total[key] = total.get(key, 0) + v
+    return total
+
+  def render(self) -> list[str]:
+    lines = super().render()
+    for key, value in sorted(self.collect().items()):
+      lines.append(f'{self.name}{self._label_str(key)} {value}')
+    return lines
+
+
+class Registry:
+  def __init__(self):
+    self.metrics: list[_Metric] = []
+
+  def register(self, metric: _Metric) -> _Metric:
+    self.metrics.append(metric)
+    return metric
+
+  def render(self) -> str:
+    lines = []
+    for metric in self.metrics:
+      lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _query_labels(values: Labels) -> Labels:
+  qtype, rcode, transport = values
+  return type_name(qtype), RCODE_NAMES.get(rcode, rcode), transport
+
+
+def _server_labels(values: Labels) -> Labels:
+  return tuple(f'{server[0]}:{server[1]}' if isinstance(server, tuple)
+               else server for server in values)
+
+
+registry = Registry()
+
+QUERIES = registry.register(Counter(
+    'dns_queries_total', 'Queries answered.',
+    labels=('qtype', 'rcode', 'transport'), format_labels=_query_labels))
+LATENCY = registry.register(Histogram(
+    'dns_query_duration_seconds', 'End-to-end query handling time.',
+    labels=('transport',)))
+UPSTREAM_RTT = registry.register(Histogram(
+    'dns_upstream_rtt_seconds', 'Round trip time to upstream resolvers.',
+    labels=('server',), format_labels=_server_labels))
+UPSTREAM_ERRORS = registry.register(Counter(
+    'dns_upstream_errors_total', 'Failed upstream exchanges.',
+    labels=('server', 'reason'), format_labels=_server_labels))
+UPSTREAM_RETRIES = registry.register(Counter(
+    'dns_upstream_retries_total',
+    'Extra upstream copies sent (retries and hedges) and those that won.',
+    labels=('result',)))
+UPSTREAM_TCP = registry.register(Counter(
+    'dns_upstream_tcp_queries_total',
+    'Queries sent upstream over TCP, by why TCP was used.',
+    labels=('reason',)))
+CACHE_LOOKUPS = registry.register(Counter(
+    'dns_cache_lookups_total', 'Cache lookups by result.',
+    labels=('result',)))
+CACHE_ENTRIES = registry.register(Gauge(
+    'dns_cache_entries', 'Entries held in the cache.'))
+ECS_LOOKUPS = registry.register(Counter(
+    'dns_ecs_cache_lookups_total',
+    'Lookups of answers tailored to a client subnet, by result.',
+    labels=('result',)))
+ECS_ENTRIES = registry.register(Gauge(
+    'dns_ecs_cache_entries', 'Entries held for client subnets.'))
+ECS_ANSWERS = registry.register(Counter(
+    'dns_ecs_answers_total',
+    'Upstream answers to queries carrying a client subnet, by whether '
+    'they were the same for every client or tailored.',
+    labels=('scope',)))
+NSEC_SYNTHESIZED = registry.register(Counter(
+    'dns_nsec_synthesized_total',
+    'Negative answers synthesized from cached NSEC ranges.',
+    labels=('result',)))
+NSEC_RANGES = registry.register(Gauge(
+    'dns_nsec_ranges', 'NSEC ranges cached for aggressive negative answers.'))
+POLICY_HITS = registry.register(Counter(
+    'dns_policy_hits_total', 'Queries matching a response policy rule.',
+    labels=('action',)))
+POLICY_RULES = registry.register(Gauge(
+    'dns_policy_rules', 'Response policy rules loaded.'))
+POLICY_BYTES = registry.register(Gauge(
+    'dns_policy_bytes', 'Memory held by the response policy index.'))
+PARSE_FAILURES = registry.register(Counter(
+    'dns_parse_failures_total', 'Packets that could not be parsed.'))
+TRUNCATED = registry.register(Counter(
+    'dns_truncated_responses_total',
+    'UDP responses truncated to the client\'s payload size.'))
+DROPPED = registry.register(Counter(
+    'dns_dropped_packets_total', 'Packets dropped without an answer.',
+    labels=('reason',)))
+STAGE_DURATION = registry.register(Gauge(
+    'dns_stage_duration_seconds', 'Sampled per-stage handling time.',
+    labels=('stage', 'quantile')))
+RRL_ACTIONS = registry.register(Counter(
+    'dns_rrl_actions_total', 'Response rate limiting decisions.',
+    labels=('action',)))
+QUEUE_DEPTH = registry.register(Gauge(
+    'dns_queue_depth', 'Queries waiting to be processed.'))
+QUEUE_SOJOURN = registry.register(Histogram(
+    'dns_queue_sojourn_seconds', 'Time queries spent in the work queue.'))
+SHED = registry.register(Counter(
+    'dns_shed_queries_total', 'Queries shed because of queue delay.',
+    labels=('policy',)))
+DROPPED_RECORDS = registry.register(Gauge(
+    'dns_dropped_log_records', 'Log and tap records dropped by writers.',
+    labels=('writer',)))
+
+
+pages: dict[str, Callable[[], dict]] = {}
+
+
+def register_page(path: str, callback: Callable[[], dict]) -> None:
+  """
+  Serves the JSON encoded result of `callback` under `path` next to
+  /metrics, for live views that don't fit the Prometheus model.
+  """
+
+  pages[path] = callback
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self) -> None:
+    path = self.path.split('?')[0]
+    if path == '/metrics':
+      body = registry.render().encode('utf-8')
+      content_type = 'text/plain; version=0.0.4'
+    elif path in pages:
+      body = json.dumps(pages[path](), indent=2).encode('utf-8')
+      content_type = 'application/json'
+    else:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format: str, *args) -> None:
+    pass
+
+
+def serve(address: tuple[str, int],
+          sock: socket.socket | None = None) -> ThreadingHTTPServer:
+  """
+  Serves the registry on `address`, or on the already bound listener
+  `sock` taken over from a previous process.
+  """
+
+  server = ThreadingHTTPServer(address, _MetricsHandler,
+                               bind_and_activate=sock is None)
+  if sock is not None:
+    server.socket.close()
+    server.socket = sock
+    server.server_address = sock.getsockname()
+  # a listener shared with another process must not block in accept()
+  server.socket.setblocking(False)
+  server.daemon_threads = True
+  thread = threading.Thread(
+      target=server.serve_forever, name='metrics', daemon=True)
+  thread.start()
+  logger.info(f'Serving metrics on http://{address[0]}:{address[1]}/metrics')
+  return server
@@ -0,0 +1,163 @@
+import weakref
+from typing import Iterator
+
+from app.dns.exceptions import FormatError
+
+MAX_LABEL = 63
+MAX_NAME = 255
+
+# names alive anywhere in the server are shared through this table; it
+# only holds weak references and stops taking new names once full
+INTERN_LIMIT = 1 << 16
+_interned: 'weakref.WeakValueDictionary[bytes, Name]' = \
+    weakref.WeakValueDictionary()
+
+
+def _split(wire: bytes) -> tuple[bytes, ...]:
+  labels = []
+  i = 0
+  while wire[i] != 0:
+    length = wire[i]
+    labels.append(wire[i + 1:i + 1 + length])
+    i += length + 1
+  return tuple(labels)
+
+
+class Name:
+  """
+  Domain name as a value. It holds the uncompressed wire form as
+  received (case preserved, ready to serialize), the labels, and the
+  case-folded wire form which hashing and comparison use, so names
+  compare case-insensitively without lowercasing strings.
+
+  Build names with `from_wire` or `from_text`, which intern them:
+  equal wire forms share one object while it is in use.
+  """
+
+  __slots__ = ('wire', 'key', '_text', '__weakref__')
+
+  def __init__(self, wire: bytes):
+    self.wire = wire
+    # length octets are at most 63, below 'A', so lower() only folds
+    # label characters; most names arrive lowercase and share the bytes
+    key = wire.lower()
+    self.key = wire if key == wire else key
+    self._text: str | None = None
+
+  @classmethod
+  def from_wire(cls, wire: bytes) -> 'Name':
+    """
+    Name for uncompressed, validated wire bytes (terminating zero
+    included).
+    """
+
+    name = _interned.get(wire)
+    if name is None:
+      name = cls(wire)
+      if len(_interned) < INTERN_LIMIT:
+        _interned[wire] = name
+    return name
+
+  @classmethod
+  def from_text(cls, text: str) -> 'Name':
+    if text in ('', '.'):
+      return ROOT
+    parts = []
+    for label in text.rstrip('.').split('.'):
+      label = label.encode('ascii')
+      if not 0 < len(label) <= MAX_LABEL:
+        raise FormatError(f'Invalid label length in \'{text}\'')
+      parts.append(bytes([len(label)]) + label)
+    parts.append(b'\x00')
+    wire = b''.join(parts)
+    if len(wire) > MAX_NAME:
+      raise FormatError(f'Name \'{text}\' exceeds {MAX_NAME} octets')
+    return cls.from_wire(wire)
+
+  def __eq__(self, other: object) -> bool:
+    if isinstance(other, Name):
+      return self.key == other.key
+    return NotImplemented
+
+  def __hash__(self) -> int:
+    # bytes cache their hash, no need to keep another int around
+    return hash(self.key)
+
+  def __len__(self) -> int:
+    return self._count()
+
+  @property
+  def labels(self) -> tuple[bytes, ...]:
+    # derived on demand, storing them would double a cached name's size
+    return _split(self.wire)
+
+  def __str__(self) -> str:
+    if self._text is None:
+      self._text = '.'.join(label.decode('utf-8', 'replace')
+                            for label in self.labels)
+    return self._text
+
+  def __repr__(self) -> str:
+    return f'Name({str(self)!r})'
+
+  def __bytes__(self) -> bytes:
+    return self.wire
+
+  def __copy__(self) -> 'Name':
+    return self
+
+  def __deepcopy__(self, memo: dict) -> 'Name':
+    return self
+
+  @property
+  def is_root(self) -> bool:
+    return len(self.wire) == 1
+
+  def parent(self) -> 'Name | None':
+    """
+    The name with its first label removed, None for the root.
+    """
+
+    if self.is_root:
+      return None
+    return Name.from_wire(self.wire[self.wire[0] + 1:])
+
+  def suffixes(self) -> Iterator['Name']:
+    """
+    The name itself followed by each ancestor down to the root, the
+    order closest-match lookups in zones and caches walk.
+    """
+
+    wire = self.wire
+    i = 0
+    while True:
+      yield self if i == 0 else Name.from_wire(wire[i:])
+      if wire[i] == 0:
+        return
+      i += wire[i] + 1
+
+  def _count(self) -> int:
+    wire = self.wire
+    count = 0
+    i = 0
+    while wire[i] != 0:
+      i += wire[i] + 1
+      count += 1
+    return count
+
+  def is_subdomain(self, other: 'Name') -> bool:
+    """
+    Whether this name equals `other` or lies below it.
+    """
+
+    skip = self._count() - other._count()
+    if skip < 0:
+      return False
+    i = 0
+    for _ in range(skip):
+      i += self.wire[i] + 1
+    return self.key[i:] == other.key
+
+
+ROOT = Name(b'\x00')
+_interned[ROOT.wire] = ROOT
@@ -0,0 +1,266 @@
+import bisect
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from app.dns import metrics
+from app.dns.common import ResponseCode, RType
+from app.dns.name import Name
+from app.dns.record import ResourceRecord
+
+if TYPE_CHECKING:
+  from app.dns.message import Message
+
+# canonical form of a name for ordering (RFC 4034 6.1): lowercase labels
+# from the top level down; tuples compare label by label and bytes
+# octet by octet, a prefix first, which is exactly the canonical order
+CanonicalKey = tuple[bytes, ...]
+
+_WILDCARD = b'*'
+
+
+def canonical_key(name: Name) -> CanonicalKey:
+  labels = [label.lower() for label in name.labels]
+  labels.reverse()
+  return tuple(labels)
+
+
+def _common(a: CanonicalKey, b: CanonicalKey) -> int:
+  n = 0
+  for x, y in zip(a, b):
+    if x != y:
+      break
+    n += 1
+  return n
+
+
+class _Range:
+  __slots__ = ('owner', 'next', 'types', 'expires')
+
+  def __init__(self, owner: CanonicalKey, next: CanonicalKey,
+               types: frozenset[int], expires: float):
+    self.owner = owner
+    self.next = next
+    self.types = types
+    self.expires = expires
+
+  def covers(self, key: CanonicalKey) -> bool:
+    """
+    Whether `key` lies strictly between owner and next, the last range
+    of the zone wrapping around to the apex.
+    """
+
+    if self.next <= self.owner:
+      return key > self.owner
+    return self.owner < key < self.next
+
+  def cut(self, key: CanonicalKey) -> bool:
+    """
+    Whether `key` is at or below a delegation or DNAME at the owner, in
+    data this zone is not authoritative for.
+    """
+
+    return (key[:len(self.owner)] == self.owner
+            and (RType.DNAME.value in self.types
+                 or (RType.NS.value in self.types
+                     and RType.SOA.value not in self.types)))
+
+
+class _ZoneRanges:
+  """
+  The NSEC ranges cached for one signed zone, sorted by owner so the one
+  a name falls in is found by bisection.
+  """
+
+  __slots__ = ('apex', 'soa', 'soa_expires', 'owners', 'ranges')
+
+  def __init__(self, apex: Name):
+    self.apex = apex
+    self.soa: ResourceRecord | None = None
+    self.soa_expires = 0.0
+    self.owners: list[CanonicalKey] = []
+    self.ranges: list[_Range] = []
+
+  def add(self, entry: _Range) -> int:
+    i = bisect.bisect_left(self.owners, entry.owner)
+    if i < len(self.owners) and self.owners[i] == entry.owner:
+      self.ranges[i] = entry
+      return 0
+    self.owners.insert(i, entry.owner)
+    self.ranges.insert(i, entry)
+    return 1
+
+  def find(self, key: CanonicalKey, now: float) -> _Range | None:
+    """
+    The live range at or before `key`: the one owned by it or the one
+    that may cover it.
+    """
+
+    i = bisect.bisect_right(self.owners, key) - 1
+    if i < 0:
+      return None
+    entry = self.ranges[i]
+    return entry if entry.expires > now else None
+
+  def purge(self, now: float) -> int:
+    live = [entry for entry in self.ranges if entry.expires > now]
+    removed = len(self.ranges) - len(live)
+    self.ranges = live
+    self.owners = [entry.owner for entry in live]
+    return removed
+
+
+class NsecCache:
+  """
+  Aggressive use of DNSSEC-validated cache (RFC 8198): the NSEC records
+  of negative answers an upstream has validated are kept as ranges per
+  zone, and names falling in a cached range get NXDOMAIN or NODATA
+  without asking upstream again. This is what stops random subdomain
+  floods (a1b2c3.example.com): after a few misses the ranges cover the
+  zone.
+
+  Only upstream answers with AD set are used, this server does not
+  validate signatures itself; that makes the upstream a validating
+  resolver it trusts. Answers are only synthesized for clients not
+  asking for DNSSEC records, as the RRSIGs proving them are not kept.
+  NSEC3 zones are left to the upstream.
+
+  At most `capacity` ranges are held; expired ones are dropped when it
+  fills, and ranges of new answers are ignored while it stays full.
+  """
+
+  def __init__(self, capacity: int = 100000):
+    self.capacity = capacity
+    self.size = 0
+    self.zones: dict[tuple[bytes, Name], _ZoneRanges] = {}
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return self.size
+
+  def learn(self, response: 'Message', partition: bytes = b'') -> int:
+    """
+    Caches the NSEC ranges of an upstream's negative `response`.
+    Returns how many were new.
+    """
+
+    if not response.header.flags.ad:
+      return 0
+    soa = next((record for record in response.authorities
+                if record.type == RType.SOA.value), None)
+    if soa is None:
+      return 0
+    nsecs = [record for record in response.authorities
+             if record.type == RType.NSEC.value
+             and record.name.is_subdomain(soa.name)]
+    if not nsecs:
+      return 0
+
+    now = time.time()
+    negative_ttl = min(soa.ttl, soa.rdata.minimum)
+    added = 0
+    with self._lock:
+      if self.size + len(nsecs) > self.capacity:
+        self._purge(now)
+        if self.size + len(nsecs) > self.capacity:
+          return 0
+      zone = self.zones.get((partition, soa.name))
+      if zone is None:
+        zone = self.zones[(partition, soa.name)] = _ZoneRanges(soa.name)
+      zone.soa = soa
+      zone.soa_expires = now + negative_ttl
+      for record in nsecs:
+        # RFC 9077: no longer than the negative TTL of the zone
+        ttl = min(record.ttl, negative_ttl)
+        added += zone.add(_Range(canonical_key(record.name),
+                                 canonical_key(record.rdata.next_name),
+                                 record.rdata.types, now + ttl))
+      self.size += added
+    return added
+
+  def _purge(self, now: float) -> None:
+    for key, zone in list(self.zones.items()):
+      self.size -= zone.purge(now)
+      if not zone.ranges:
+        del self.zones[key]
+
+  def respond(self, message: 'Message',
+              partition: bytes = b'') -> 'Message | None':
+    """
+    NXDOMAIN or NODATA for `message` when cached ranges prove it, None
+    when the query has to be resolved.
+    """
+
+    if (len(message.queries) != 1 or message.dnssec_ok()
+       or message.validate() != ResponseCode.NO_ERROR):
+      return None
+    query = message.queries[0]
+    now = time.time()
+    with self._lock:
+      zone = None
+      for suffix in query.name.suffixes():
+        zone = self.zones.get((partition, suffix))
+        if zone is not None:
+          break
+      if zone is None or zone.soa_expires <= now:
+        return None
+      rcode, expires = self._prove(zone, canonical_key(query.name),
+                                   query.type, now)
+      if rcode is None:
+        return None
+      expires = min(expires, zone.soa_expires)
+      soa = zone.soa
+
+    metrics.NSEC_SYNTHESIZED.inc(
+        'nxdomain' if rcode == ResponseCode.NAME_ERROR else 'nodata')
+    record = ResourceRecord(name=soa.name, type=soa.type, klass=soa.klass,
+                            ttl=max(0, int(expires - now)),
+                            rdlength=soa.rdlength, rdata=soa.rdata)
+    return message.local_response(rcode, authorities=[record])
+
+  def _prove(self, zone: _ZoneRanges, key: CanonicalKey, rtype: int,
+             now: float) -> tuple[ResponseCode | None, float]:
+    entry = zone.find(key, now)
+    if entry is None or (entry.cut(key) and entry.owner != key):
+      return None, 0
+    if entry.owner == key:
+      # the name exists: NODATA unless the type or a CNAME is there
+      if (rtype in entry.types or RType.CNAME.value in entry.types
+         or rtype == 255 or entry.cut(key)):
+        return None, 0
+      return ResponseCode.NO_ERROR, entry.expires
+    if not entry.covers(key):
+      return None, 0
+    if len(entry.next) > len(key) and entry.next[:len(key)] == key:
+      # names exist below it, an empty non-terminal: no data
+      return ResponseCode.NO_ERROR, entry.expires
+
+    # the name does not exist; neither may a wildcard at its closest
+    # encloser that would have answered instead (RFC 4035 5.4)
+    closest = max(_common(key, entry.owner), _common(key, entry.next))
+    wildcard = key[:closest] + (_WILDCARD,)
+    denial = zone.find(wildcard, now)
+    if denial is None or not denial.covers(wildcard):
+      return None, 0
+    return ResponseCode.NAME_ERROR, min(entry.expires, denial.expires)
+
+  def flush(self) -> None:
+    with self._lock:
+      self.zones.clear()
+      self.size = 0
+
+  def remove(self, name: Name, subtree: bool = False) -> int:
+    """
+    Drops the ranges of the zone holding `name`, or with `subtree` also
+    those of the zones below it. Returns how many were dropped.
+    """
+
+    removed = 0
+    with self._lock:
+      for key, zone in list(self.zones.items()):
+        if (name.is_subdomain(zone.apex)
+           or subtree and zone.apex.is_subdomain(name)):
+          removed += len(zone.ranges)
+          del self.zones[key]
+      self.size -= removed
+    return removed
@@ -0,0 +1,157 @@
+import collections
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('receive', 'parse', 'validate', 'resolve', 'serialize', 'send')
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class StageSample:
+  __slots__ = ('timer', 'last')
+
+  def __init__(self, timer: 'StageTimer', start: float | None = None):
+    self.timer = timer
+    self.last = time.perf_counter() if start is None else start
+
+  def mark(self, stage: str) -> None:
+    now = time.perf_counter()
+    self.timer.record(stage, now - self.last)
+    self.last = now
+
+
+class _NullSample:
+  __slots__ = ()
+
+  def mark(self, stage: str) -> None:
+    pass
+
+
+NULL_SAMPLE = _NullSample()
+
+
+class StageTimer:
+  """
+  Times the stages of 1 in `every` queries. Each stage keeps a bounded
+  reservoir of recent durations from which percentiles are computed on
+  demand, so unsampled queries only pay for a counter increment.
+
+  The receive stage spans from `recvfrom` returning to the query being
+  taken off the work queue.
+  """
+
+  def __init__(self, every: int = 100, reservoir: int = 2048):
+    self.every = every
+    self.reservoir = reservoir
+    self.samples: dict[str, collections.deque] = {
+        stage: collections.deque(maxlen=reservoir) for stage in STAGES
+    }
+    self._count = 0
+
+  def sample(self, start: float | None = None) -> StageSample | _NullSample:
+    if self.every <= 0:
+      return NULL_SAMPLE
+    self._count += 1
+    if self._count < self.every:
+      return NULL_SAMPLE
+    self._count = 0
+    return StageSample(self, start)
+
+  def record(self, stage: str, duration: float) -> None:
+    samples = self.samples.get(stage)
+    if samples is None:
+      samples = self.samples[stage] = collections.deque(maxlen=self.reservoir)
+    samples.append(duration)
+
+  def percentiles(
+      self, quantiles: tuple[float, ...] = QUANTILES
+  ) -> dict[str, dict[float, float]]:
+    res = {}
+    for stage, samples in list(self.samples.items()):
+      values = sorted(samples)
+      if len(values) == 0:
+        continue
+      res[stage] = {
+          q: values[min(len(values) - 1, int(q * len(values)))]
+          for q in quantiles
+      }
+    return res
+
+  def metric_values(self) -> dict[tuple[str, str], float]:
+    return {
+        (stage, str(q)): value
+        for stage, values in self.percentiles().items()
+        for q, value in values.items()
+    }
+
+
+class ProfilerControl:
+  """
+  Starts cProfile or tracemalloc for a fixed window on SIGUSR1/SIGUSR2
+  and writes the result to `directory` when the window expires
+  (SIGALRM). Handlers run in the main thread, which is the thread the
+  query loop runs on, so cProfile sees the hot path.
+  """
+
+  def __init__(self, directory: str, window: float = 30.0):
+    self.directory = directory
+    self.window = window
+    self.active: str | None = None
+    self._profile = None
+
+  def install(self) -> None:
+    signal.signal(signal.SIGUSR1, lambda *_: self.start('cprofile'))
+    signal.signal(signal.SIGUSR2, lambda *_: self.start('tracemalloc'))
+    signal.signal(signal.SIGALRM, lambda *_: self.stop())
+
+  def start(self, kind: str, window: float | None = None) -> bool:
+    if self.active is not None:
+      logger.warning(f'{self.active} already running, ignoring {kind}')
+      return False
+
+    if kind == 'cprofile':
+      import cProfile
+      self._profile = cProfile.Profile()
+      self._profile.enable()
+    elif kind == 'tracemalloc':
+      import tracemalloc
+      tracemalloc.start(25)
+    else:
+      raise ValueError(f'Unknown profiler: {kind}')
+
+    self.active = kind
+    window = self.window if window is None else window
+    signal.setitimer(signal.ITIMER_REAL, window)
+    logger.warning(f'Started {kind} for {window}s')
+    return True
+
+  def stop(self) -> str | None:
+    if self.active is None:
+      return None
+
+    os.makedirs(self.directory, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    prefix = os.path.join(self.directory, f'{self.active}-{os.getpid()}-{stamp}')
+
+    if self.active == 'cprofile':
+      self._profile.disable()
+      path = prefix + '.prof'
+      self._profile.dump_stats(path)
+      self._profile = None
+    else:
+      import tracemalloc
+      snapshot = tracemalloc.take_snapshot()
+      tracemalloc.stop()
+      path = prefix + '.tracemalloc'
+      snapshot.dump(path)
+      with open(prefix + '.txt', 'w') as f:
+        for stat in snapshot.statistics('lineno')[:50]:
+          f.write(f'{stat}\n')
+
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    logger.warning(f'Stopped {self.active}, wrote {path}')
+    self.active = None
+    return path
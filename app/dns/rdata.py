@@ -1,255 +1,549 @@
 import logging
 import struct
-import enum
-from abc import ABC, abstractmethod
+import socket
+from typing import Callable, Iterable
 from app.dns.encoding import Encoding
-from app.dns.exceptions import NotImplementedError
-from app.dns.common import RType, DomainName, CharacterString
+from app.dns.name import Name
+from app.dns.common import (RType, DomainName, CharacterString, RECORD_TYPES,
+                            TYPE_NAMES, type_name)
 
 logger = logging.getLogger(__name__)
 
 
-class RDATA(ABC):
-  __annotations__: dict[str, str] = dict()
+class RDATA:
+  """
+  Record data kept in its uncompressed wire form. Decoding copies the
+  bytes (expanding compressed names) and serializing returns them as
+  they are; text fields are only derived on access, for logging or
+  zone output.
 
-  def __init__(self, **kwargs) -> None:
-    super().__init__()
-    self._annotate(kwargs)
+  The base class is itself the codec of types without a registered
+  one: their data is carried as opaque bytes (RFC 3597), which is safe
+  since such types never compress names.
+  """
 
-  @staticmethod
-  def get_callable(record_type: int) -> tuple['RDATA', RType]:
-    if not RType.value_exists(record_type):
-      raise NotImplementedError(f'Unsupported Record Type: {record_type}')
-    t = RType(record_type)
+  __slots__ = ('wire',)
+
+  # type code -> codec class, filled by `RDATA.register` as the codec
+  # classes below are defined
+  codecs = {}
+
+  def __init__(self, wire: bytes = b'') -> None:
+    self.wire = wire
 
-    if t == RType.CNAME or t == RType.MB or t == RType.MD or t == RType.MF or t == RType.MG or t == RType.MR or t == RType.NS or t == RType.PTR:
-      name = 'DOMAIN'
-    else:
-      name = t.name.upper()
+  @staticmethod
+  def register(*record_types: RType | int
+               ) -> Callable[[type['RDATA']], type['RDATA']]:
+    """
+    Class decorator registering an RDATA codec for `record_types`, the
+    only step needed to support a new type:
+
+      @RDATA.register(RType.AAAA)
+      class RDATA_AAAA(RDATA): ...
+    """
+
+    def decorator(codec: type['RDATA']) -> type['RDATA']:
+      for record_type in record_types:
+        code = getattr(record_type, 'value', record_type)
+        if code not in RECORD_TYPES:
+          raise ValueError(f'Unknown Record Type: {record_type}')
+        RDATA.codecs[code] = codec
+      return codec
+    return decorator
 
-    from importlib import import_module
-    obj = getattr(import_module('app.dns.rdata'), 'RDATA_' + name)
-    return obj, t
+  @staticmethod
+  def get_callable(record_type: int) -> tuple[type['RDATA'], int]:
+    return RDATA.codecs.get(record_type, RDATA), record_type
 
   @staticmethod
   def factory(record_type: int, **kwargs) -> 'RDATA':
+    """
+    Builds RDATA for `record_type` from its text fields, encoding them
+    once.
+    """
+
     obj_path, t = RDATA.get_callable(record_type)
-    obj: RDATA = obj_path()
-    logger.info(f'Matched \'RType.{t.name}\' to \'{obj_path.__name__}\'')
-    obj._annotate(kwargs)
-    return obj
-
-  def _annotate(self, annotations: dict = {}) -> None:
-    if len(annotations) > 0:
-      for name, value in annotations.items():
-        if isinstance(value, enum.Enum):
-          value = value.value
-        self.__annotations__[name] = value
-
-  def __getattr__(self, instance, owner=None):
-    annotation = object.__getattribute__(self, '__annotations__')
-    if instance in annotation:
-      return annotation[instance]
-    else:
-      raise AttributeError('Could not find {instance}')
-
-  def __setattr__(self, instance, value):
-    annotation = object.__getattribute__(self, '__annotations__')
-    if instance in annotation:
-      annotation[instance] = value
-      object.__setattr__(self, '__annotations__', annotation)
-    else:
-      raise AttributeError('Could not find {instance}')
-
-  def __delattr__(self, instance):
-    annotation = object.__getattribute__(self, '__annotations__')
-    if instance in annotation:
-      del annotation[instance]
-      object.__setattr__(self, '__annotations__', annotation)
-    else:
-      raise AttributeError('Could not find {instance}')
-
-  @abstractmethod
+    logger.debug(f'Matched \'RType.{type_name(t)}\' to \'{obj_path.__name__}\'')
+    return obj_path(obj_path.encode(**kwargs))
+
   def __bytes__(self) -> bytes:
-    return b''
+    return self.wire
+
+  def __len__(self) -> int:
+    return len(self.wire)
+
+  def __eq__(self, other: object) -> bool:
+    return (isinstance(other, RDATA) and type(self) is type(other)
+            and self.wire == other.wire)
+
+  def __hash__(self) -> int:
+    return hash(self.wire)
+
+  def __repr__(self) -> str:
+    return f'{self.__class__.__name__}({self.to_text()})'
+
+  def __copy__(self) -> 'RDATA':
+    # the wire bytes are immutable, copies share them
+    return self.__class__(self.wire)
 
-  def __copy__(self):
-    cls = self.__class__
-    result = cls.__new__(cls)
+  @classmethod
+  def decode(cls, data: bytes, offset: int = 0, length: int | None = None,
+             names: dict[int, bytes] | None = None) -> 'RDATA':
+    """
+    Decodes RDATA at `offset` in `data`, which may be the whole message
+    so that compressed names can be resolved; `names` is the message's
+    cache of decoded names.
+    """
+
+    if length is None:
+      length = len(data) - offset
+    return cls(bytes(data[offset:offset + length]))
+
+  @classmethod
+  def encode(cls, data: bytes = b'') -> bytes:
+    return bytes(data)
+
+  def to_text(self) -> str:
+    # RFC 3597 generic presentation
+    return f'\\# {len(self.wire)} {self.wire.hex()}'
+
+
+class _NamesRDATA(RDATA):
+  """
+  RDATA starting with `names` domain names, possibly compressed on the
+  wire, followed by fixed size fields.
+  """
 
-    obj_annotations = getattr(self, '__annotations__')
-    result._annotate(obj_annotations)
-    return result
+  __slots__ = ()
+
+  names = 1
 
   @classmethod
-  @abstractmethod
-  def decode(cls, data: bytes) -> 'RDATA':
-    return cls()
+  def decode(cls, data: bytes, offset: int = 0, length: int | None = None,
+             names: dict[int, bytes] | None = None) -> '_NamesRDATA':
+    if length is None:
+      length = len(data) - offset
+    end = offset + length
+    wire = []
+    i = offset
+    for _ in range(cls.names):
+      name, i = Encoding.expand_name(data, i, names)
+      wire.append(name)
+    wire.append(bytes(data[i:end]))
+    return cls(b''.join(wire))
+
+  def _names(self) -> tuple[list[str], int]:
+    names = []
+    i = 0
+    for _ in range(self.names):
+      name, i = Encoding.name_text(self.wire, i)
+      names.append(name)
+    return names, i
 
 
+@RDATA.register(RType.A)
 class RDATA_A(RDATA):
-  data: DomainName
+  __slots__ = ()
 
-  def __bytes__(self) -> bytes:
-    return Encoding.encode(self.data)
+  @property
+  def data(self) -> str:
+    return socket.inet_ntoa(self.wire)
 
   @classmethod
-  def decode(cls, data: bytes) -> "RDATA_A":
-    name, _ = Encoding.decode_ip(data)
-    return cls(data=name)
+  def encode(cls, data: str) -> bytes:
+    return socket.inet_aton(data)
 
+  def to_text(self) -> str:
+    return self.data
 
-class RDATA_DOMAIN(RDATA):
-  data: DomainName
 
-  def __bytes__(self) -> bytes:
-    return Encoding.encode(self.data)
+@RDATA.register(RType.CNAME, RType.MB, RType.MD, RType.MF, RType.MG,
+               RType.MR, RType.NS, RType.PTR)
+class RDATA_DOMAIN(_NamesRDATA):
+  __slots__ = ()
+
+  @property
+  def data(self) -> DomainName:
+    return Encoding.name_text(self.wire)[0]
 
   @classmethod
-  def decode(cls, data: bytes) -> "RDATA_DOMAIN":
-    name, _ = Encoding.decode_domain_name(data)
-    return cls(data=name)
+  def encode(cls, data: DomainName) -> bytes:
+    return Encoding.encode_name(data)
+
+  def to_text(self) -> str:
+    return self.data + '.'
 
 
+@RDATA.register(RType.HINFO)
 class RDATA_HINFO(RDATA):
-  cpu: CharacterString = ''
-  os: CharacterString = ''
+  __slots__ = ()
 
-  def __bytes__(self) -> bytes:
-    res = b''
-    res += Encoding.encode_character_string(self.cpu)
-    res += Encoding.encode_character_string(self.os)
-    return res
+  @property
+  def cpu(self) -> CharacterString:
+    return Encoding.decode_character_string(self.wire)[0]
+
+  @property
+  def os(self) -> CharacterString:
+    _, i = Encoding.decode_character_string(self.wire)
+    return Encoding.decode_character_string(self.wire, i)[0]
 
   @classmethod
-  def decode(cls, data: bytes) -> "RDATA_HINFO":
-    cpu, cpu_length = Encoding.decode_character_string(data)
-    os, _ = Encoding.decode_character_string(
-        data[cpu_length:]
-    )
-    return cls(cpu=cpu, os=os)
+  def encode(cls, cpu: CharacterString = '',
+             os: CharacterString = '') -> bytes:
+    return (Encoding.encode_character_string(cpu)
+            + Encoding.encode_character_string(os))
 
+  def to_text(self) -> str:
+    return f'"{self.cpu}" "{self.os}"'
 
-class RDATA_MINFO(RDATA):
-  rmailbx: DomainName = ''
-  emailbx: DomainName = ''
 
-  def __bytes__(self) -> bytes:
-    res = b''
-    res += Encoding.encode_domain_name(self.rmailbx)
-    res += Encoding.encode_domain_name(self.emailbx)
+@RDATA.register(RType.MINFO)
+class RDATA_MINFO(_NamesRDATA):
+  __slots__ = ()
 
-    return res
+  names = 2
+
+  @property
+  def rmailbx(self) -> DomainName:
+    return self._names()[0][0]
+
+  @property
+  def emailbx(self) -> DomainName:
+    return self._names()[0][1]
 
   @classmethod
-  def decode(cls, data: bytes) -> "RDATA_MINFO":
-    rmailbx, _len = Encoding.decode_domain_name(data)
-    emailbx, _ = Encoding.decode_domain_name(data[_len:])
-    return cls(rmailbx=rmailbx, emailbx=emailbx)
+  def encode(cls, rmailbx: DomainName = '', emailbx: DomainName = '') -> bytes:
+    return Encoding.encode_name(rmailbx) + Encoding.encode_name(emailbx)
+
+  def to_text(self) -> str:
+    return ' '.join(name + '.' for name in self._names()[0])
 
 
+@RDATA.register(RType.MX)
 class RDATA_MX(RDATA):
-  preference: int = 0
-  exchange: DomainName = ''
+  __slots__ = ()
 
-  def __bytes__(self) -> bytes:
-    res = b''
-    res += struct.pack("!H", self.preference)
-    res += Encoding.encode_domain_name(self.exchange)
-    return res
+  @property
+  def preference(self) -> int:
+    return struct.unpack('!H', self.wire[:2])[0]
+
+  @property
+  def exchange(self) -> DomainName:
+    return Encoding.name_text(self.wire, 2)[0]
 
   @classmethod
-  def decode(cls, data: bytes) -> "RDATA_MX":
-    preference = int.from_bytes(data[0:2], 'big')
-    exchange = Encoding.decode_domain_name(data[2:])
-    return cls(preference=preference, exchange=exchange, data=data)
+  def decode(cls, data: bytes, offset: int = 0, length: int | None = None,
+             names: dict[int, bytes] | None = None) -> "RDATA_MX":
+    exchange, _ = Encoding.expand_name(data, offset + 2, names)
+    return cls(bytes(data[offset:offset + 2]) + exchange)
 
+  @classmethod
+  def encode(cls, preference: int = 0, exchange: DomainName = '') -> bytes:
+    return struct.pack('!H', preference) + Encoding.encode_name(exchange)
 
-class RDATA_SOA(RDATA):
-  mname: DomainName = ''
-  rname: DomainName = ''
-  serial: int = 0
-  refresh: int = 0
-  retry: int = 0
-  expire: int = 0
-  minimum: int = 0
+  def to_text(self) -> str:
+    return f'{self.preference} {self.exchange}.'
 
-  def __bytes__(self) -> bytes:
-    import struct
-
-    res = b''
-    res += Encoding.encode_domain_name(self.mname)
-    res += Encoding.encode_domain_name(self.rname)
-    res += struct.pack(
-        '!LLLLL',
-        self.serial,
-        self.refresh,
-        self.retry,
-        self.expire,
-        self.minimum,
-    )
-    return res
-
-  @classmethod
-  def decode(cls, data: bytes) -> "RDATA_SOA":
-    len = 0
-    mname, _len = Encoding.decode_domain_name(data[len:])
-    len += _len
-    rname, _len = Encoding.decode_domain_name(data[len:])
-    len += _len
-    serial = int.from_bytes(data[len:4], 'big')
-    len += 4
-    refresh = int.from_bytes(data[len:4], 'big')
-    len += 4
-    retry = int.from_bytes(data[len:4], 'big')
-    len += 4
-    expire = int.from_bytes(data[len:4], 'big')
-    len += 4
-    minimum = int.from_bytes(data[len:4], 'big')
-    len += 4
-    return cls(mname=mname, rname=rname, serial=serial, refresh=refresh, retry=retry, expire=expire, minimum=minimum)
 
+@RDATA.register(RType.SOA)
+class RDATA_SOA(_NamesRDATA):
+  __slots__ = ()
 
-class RDATA_TXT(RDATA):
-  data: CharacterString = ''
+  names = 2
 
-  def __bytes__(self) -> bytes:
-    return Encoding.encode_character_string(self.data)
+  @property
+  def mname(self) -> DomainName:
+    return self._names()[0][0]
+
+  @property
+  def rname(self) -> DomainName:
+    return self._names()[0][1]
+
+  def _counters(self) -> tuple[int, int, int, int, int]:
+    return struct.unpack('!LLLLL', self.wire[-20:])
+
+  @property
+  def serial(self) -> int:
+    return self._counters()[0]
+
+  @property
+  def refresh(self) -> int:
+    return self._counters()[1]
+
+  @property
+  def retry(self) -> int:
+    return self._counters()[2]
+
+  @property
+  def expire(self) -> int:
+    return self._counters()[3]
+
+  @property
+  def minimum(self) -> int:
+    return self._counters()[4]
 
   @classmethod
-  def decode(cls, data: bytes) -> "RDATA_TXT":
+  def encode(cls, mname: DomainName = '', rname: DomainName = '',
+             serial: int = 0, refresh: int = 0, retry: int = 0,
+             expire: int = 0, minimum: int = 0) -> bytes:
+    return (Encoding.encode_name(mname) + Encoding.encode_name(rname)
+            + struct.pack('!LLLLL', serial, refresh, retry, expire, minimum))
+
+  def to_text(self) -> str:
+    names, _ = self._names()
+    counters = ' '.join(str(value) for value in self._counters())
+    return f'{names[0]}. {names[1]}. {counters}'
+
+
+@RDATA.register(RType.TXT)
+class RDATA_TXT(RDATA):
+  __slots__ = ()
+
+  @property
+  def strings(self) -> list[CharacterString]:
+    strings = []
     i = 0
-    rdata: CharacterString = ''
-    while i < len(data):
-      _data, _i = Encoding.decode_character_string(data[i:])
-      rdata += _data
-      i += _i
-    return cls(rdata)
+    while i < len(self.wire):
+      value, length = Encoding.decode_character_string(self.wire, i)
+      strings.append(value)
+      i += length
+    return strings
 
+  @property
+  def data(self) -> CharacterString:
+    return ''.join(self.strings)
 
+  @classmethod
+  def encode(cls, data: CharacterString = '') -> bytes:
+    value = data.encode('ascii')
+    return b''.join(Encoding.encode_character_string(value[i:i + 255])
+                    for i in range(0, max(len(value), 1), 255))
+
+  def to_text(self) -> str:
+    return ' '.join(f'"{value}"' for value in self.strings)
+
+
+@RDATA.register(RType.NULL)
 class RDATA_NULL(RDATA):
-  data: str = ''
+  __slots__ = ()
 
-  def __bytes__(self) -> bytes:
-    return Encoding.encode_character_string(self.data)
+  @property
+  def data(self) -> bytes:
+    return self.wire
 
   @classmethod
-  def decode(cls, data: bytes) -> "RDATA_NULL":
-    rdata = data[:65535].decode('utf-8')
-    return cls(rdata)
+  def encode(cls, data: bytes | str = b'') -> bytes:
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    return data[:65535]
 
 
+@RDATA.register(RType.WKS)
 class RDATA_WKS(RDATA):
-  address: DomainName
-  protocol: int
+  __slots__ = ()
 
-  def __bytes__(self) -> bytes:
-    res = b''
-    res += struct.pack("!H", self.preference)
-    res += Encoding.encode_domain_name(self.exchange)
-    return res
+  @property
+  def address(self) -> str:
+    return socket.inet_ntoa(self.wire[:4])
+
+  @property
+  def protocol(self) -> int:
+    return self.wire[4]
+
+  @property
+  def bitmap(self) -> bytes:
+    return self.wire[5:]
+
+  @classmethod
+  def encode(cls, address: str = '0.0.0.0', protocol: int = 0,
+             bitmap: bytes = b'') -> bytes:
+    return socket.inet_aton(address) + bytes([protocol]) + bitmap
+
+  def to_text(self) -> str:
+    return f'{self.address} {self.protocol} {self.bitmap.hex()}'
+
+
+@RDATA.register(RType.AAAA)
+class RDATA_AAAA(RDATA):
+  __slots__ = ()
+
+  @property
+  def data(self) -> str:
+    return socket.inet_ntop(socket.AF_INET6, self.wire)
+
+  @classmethod
+  def encode(cls, data: str) -> bytes:
+    return socket.inet_pton(socket.AF_INET6, data)
+
+  def to_text(self) -> str:
+    return self.data
+
+
+@RDATA.register(RType.SRV)
+class RDATA_SRV(RDATA):
+  __slots__ = ()
+
+  @property
+  def priority(self) -> int:
+    return struct.unpack('!H', self.wire[0:2])[0]
+
+  @property
+  def weight(self) -> int:
+    return struct.unpack('!H', self.wire[2:4])[0]
+
+  @property
+  def port(self) -> int:
+    return struct.unpack('!H', self.wire[4:6])[0]
+
+  @property
+  def target(self) -> DomainName:
+    return Encoding.name_text(self.wire, 6)[0]
+
+  @classmethod
+  def decode(cls, data: bytes, offset: int = 0, length: int | None = None,
+             names: dict[int, bytes] | None = None) -> "RDATA_SRV":
+    # RFC 2782 forbids compressing the target, expanding is harmless
+    target, _ = Encoding.expand_name(data, offset + 6, names)
+    return cls(bytes(data[offset:offset + 6]) + target)
+
+  @classmethod
+  def encode(cls, priority: int = 0, weight: int = 0, port: int = 0,
+             target: DomainName = '') -> bytes:
+    return (struct.pack('!HHH', priority, weight, port)
+            + Encoding.encode_name(target))
+
+  def to_text(self) -> str:
+    return f'{self.priority} {self.weight} {self.port} {self.target}.'
+
+
+@RDATA.register(RType.CAA)
+class RDATA_CAA(RDATA):
+  __slots__ = ()
+
+  @property
+  def flags(self) -> int:
+    return self.wire[0]
+
+  @property
+  def tag(self) -> str:
+    return self.wire[2:2 + self.wire[1]].decode('ascii')
+
+  @property
+  def value(self) -> bytes:
+    return self.wire[2 + self.wire[1]:]
+
+  @classmethod
+  def encode(cls, flags: int = 0, tag: str = '', value: bytes = b'') -> bytes:
+    tag = tag.encode('ascii')
+    return struct.pack('!BB', flags, len(tag)) + tag + value
+
+  def to_text(self) -> str:
+    return f'{self.flags} {self.tag} "{self.value.decode("utf-8", "replace")}"'
+
+
+@RDATA.register(RType.DS, RType.CDS, RType.DLV)
+class RDATA_DS(RDATA):
+  __slots__ = ()
+
+  @property
+  def key_tag(self) -> int:
+    return struct.unpack('!H', self.wire[:2])[0]
+
+  @property
+  def algorithm(self) -> int:
+    return self.wire[2]
+
+  @property
+  def digest_type(self) -> int:
+    return self.wire[3]
+
+  @property
+  def digest(self) -> bytes:
+    return self.wire[4:]
 
   @classmethod
-  def decode(cls, data: bytes) -> "RDATA_WKS":
-    name, i = Encoding.decode_ip(data)
-    return cls(data=name)
+  def encode(cls, key_tag: int = 0, algorithm: int = 0, digest_type: int = 0,
+             digest: bytes = b'') -> bytes:
+    return struct.pack('!HBB', key_tag, algorithm, digest_type) + digest
+
+  def to_text(self) -> str:
+    return (f'{self.key_tag} {self.algorithm} {self.digest_type} '
+            f'{self.digest.hex().upper()}')
+
+
+@RDATA.register(RType.NSEC)
+class RDATA_NSEC(_NamesRDATA):
+  """
+  Next owner name in the zone's canonical order and the types present
+  at the owner (RFC 4034 4), which together deny every name between the
+  two and every other type at the owner.
+  """
+
+  __slots__ = ()
+
+  @property
+  def next_name(self) -> Name:
+    _, i = Encoding.name_text(self.wire)
+    return Name.from_wire(self.wire[:i])
+
+  @property
+  def types(self) -> frozenset[int]:
+    _, i = Encoding.name_text(self.wire)
+    wire = self.wire
+    types = set()
+    # windows of 256 types: number, bitmap length, bitmap (4.1.2)
+    while i + 2 <= len(wire):
+      window, length = wire[i], wire[i + 1]
+      for octet, bits in enumerate(wire[i + 2:i + 2 + length]):
+        for bit in range(8):
+          if bits & (0x80 >> bit):
+            types.add(window * 256 + octet * 8 + bit)
+      i += 2 + length
+    return frozenset(types)
+
+  @classmethod
+  def encode(cls, next_name: DomainName = '', types: Iterable[int] = ()) -> bytes:
+    windows: dict[int, bytearray] = {}
+    for rtype in sorted(set(types)):
+      bitmap = windows.setdefault(rtype >> 8, bytearray())
+      octet = (rtype & 0xff) >> 3
+      bitmap.extend(bytes(octet + 1 - len(bitmap)))
+      bitmap[octet] |= 0x80 >> (rtype & 0x7)
+    return Encoding.encode_name(next_name) + b''.join(
+        bytes([window, len(bitmap)]) + bytes(bitmap)
+        for window, bitmap in sorted(windows.items()))
+
+  def to_text(self) -> str:
+    # unnamed types as TYPEnnn (RFC 3597 5)
+    return f'{self.next_name}. ' + ' '.join(
+        type_name(rtype) if rtype in TYPE_NAMES else f'TYPE{rtype}'
+        for rtype in sorted(self.types))
+
+
+@RDATA.register(RType.OPT)
+class RDATA_OPT(RDATA):
+  """
+  EDNS(0) pseudo record (RFC 6891), options as (code, value) pairs. The
+  record's class carries the UDP payload size and its TTL the extended
+  RCODE and flags.
+  """
+
+  __slots__ = ()
+
+  @property
+  def options(self) -> list[tuple[int, bytes]]:
+    options = []
+    i = 0
+    while i + 4 <= len(self.wire):
+      code, length = struct.unpack('!HH', self.wire[i:i + 4])
+      options.append((code, self.wire[i + 4:i + 4 + length]))
+      i += 4 + length
+    return options
+
+  @classmethod
+  def encode(cls, options: list[tuple[int, bytes]] = []) -> bytes:
+    return b''.join(struct.pack('!HH', code, len(value)) + value
+                    for code, value in options)
+
+  def to_text(self) -> str:
+    return ' '.join(f'{code}:{value.hex()}' for code, value in self.options)
@@ -1,24 +1,42 @@
 import struct
-import copy
 import enum
 import logging
 from typing import TypeVar
-from app.dns.common import RType, QType, RClass, QClass, ResponseCode, debug, get_random_ttl
+from app.dns.common import (RType, ResponseCode, debug, get_random_ttl,
+                            RECORD_TYPES, RECORD_CLASSES, QUERY_TYPES,
+                            QUERY_CLASSES, type_name, class_name)
 from app.dns.rdata import RDATA
 from app.dns.encoding import Encoding
+from app.dns.name import Name
 
 RDATA_ARG = TypeVar('RDATA_ARG', RDATA, tuple[str | int, ...], str, int)
+
+# RDATA fields of the answers made up when running without a resolver
+PLACEHOLDERS: dict[int, dict[str, str | int]] = {
+    RType.A.value: {'data': '8.8.8.8'},
+    RType.AAAA.value: {'data': '2001:4860:4860::8888'},
+    RType.CNAME.value: {'data': 'dns.google'},
+    RType.NS.value: {'data': 'ns1.google.com'},
+    RType.PTR.value: {'data': 'dns.google'},
+    RType.MX.value: {'preference': 10, 'exchange': 'smtp.google.com'},
+    RType.TXT.value: {'data': 'v=spf1 -all'},
+}
 logger = logging.getLogger(__name__)
 
 
 class BaseRecord:
-  name: str
+  # fixed layout, a cache holds millions of these
+  __slots__ = ('name', 'type', 'bytes_read', 'bytes_written')
+
+  name: Name
   type: int
 
-  bytes_read: int = 0
-  bytes_written: int = 0
+  bytes_read: int
+  bytes_written: int
 
   def __init__(self, *args, **kwargs):
+    self.bytes_read = 0
+    self.bytes_written = 0
     total = len(args) + len(kwargs)
     if total < 2:
       cname = str(self.__class__)
@@ -29,6 +47,8 @@ class BaseRecord:
         kwargs['name'] = args[0]
       if 'type' not in kwargs:
         kwargs['type'] = args[1]
+    if isinstance(kwargs.get('name'), str):
+      kwargs['name'] = Name.from_text(kwargs['name'])
     if len(kwargs) > 0:
       for name, value in kwargs.items():
         if isinstance(value, enum.Enum):
@@ -47,21 +67,19 @@ class BaseRecord:
     return len(bytes(self))
 
   def __bytes__(self) -> bytes:
-    res = (Encoding.encode(self.name)
+    res = (self.name.wire
            + struct.pack('!H', self.type))
     self.bytes_written = len(res)
     return res
 
   def __repr__(self) -> str:
-    type = RType.safe_get_name_by_value(self.type)
-
-    return f'BASE: {self.name} {type}'
+    return f'BASE: {self.name} {type_name(self.type)}'
 
   def serialize(self) -> bytes:
     return bytes(self)
 
   def validate(self) -> ResponseCode:
-    if not RType.value_exists(self.type):
+    if self.type not in RECORD_TYPES:
       logger.error('Record Type not supported')
       return ResponseCode.NOT_IMPLEMENTED
 
@@ -69,11 +87,12 @@ class BaseRecord:
 
   @classmethod
   def from_bytes(
-      cls, data: bytes, offset: int = 0
+      cls, data: bytes, offset: int = 0,
+      names: dict[int, bytes] | None = None
   ) -> tuple["BaseRecord", int]:
     debug('Base Payload', data=data)
 
-    name, i = Encoding.decode_domain_name(data, offset=offset)
+    name, i = Encoding.decode_domain_name(data, offset=offset, names=names)
 
     _type = int.from_bytes(data[i:i + 2], 'big')
     i += 2
@@ -85,29 +104,21 @@ class BaseRecord:
     return obj, i
 
   @classmethod
-  def factory(cls, data: bytes, offset: int = 0) -> tuple['BaseRecord', int]:
-    name, i = Encoding.decode_domain_name(data, offset=offset)
+  def factory(cls, data: bytes, offset: int = 0,
+              names: dict[int, bytes] | None = None
+              ) -> tuple['BaseRecord', int]:
+    """
+    Decodes a record of the answer, authority or additional section.
+    All of them have a class, TTL and RDLENGTH, whether or not their
+    type has a codec, so the next record starts where RDLENGTH says.
+    """
 
-    _type = int.from_bytes(data[i:i + 2], 'big')
-    i += 2
-
-    if not RType.value_exists(_type):
-      obj = cls.__new__(cls)
-      obj.name = name
-      obj.type = _type
-      obj.bytes_read = i - offset
-      return obj, i
-
-    t = RType(_type)
-    if t == RType.A or t == RType.NS or t == RType.MD or t == RType.MF or t == RType.CNAME or t == RType.SOA or t == RType.MB or t == RType.MG or t == RType.MR or t == RType.NULL or t == RType.WKS or t == RType.PTR or t == RType.HINFO or t == RType.MINFO or t == RType.MX or t == RType.TXT:
-      resource = ResourceRecord
-    else:
-      resource = BaseRecord
-
-    return resource.from_bytes(data, offset=offset)
+    return ResourceRecord.from_bytes(data, offset=offset, names=names)
 
 
 class Record(BaseRecord):
+  __slots__ = ('klass',)
+
   klass: int
 
   def __init__(self, *args, **kwargs):
@@ -138,20 +149,10 @@ class Record(BaseRecord):
     return result
 
   def __repr__(self) -> str:
-    if RType.value_exists(self.type):
-      type = RType.safe_get_name_by_value(self.type)
-    else:
-      type = self.type
-
-    if RClass.value_exists(self.klass):
-      klass = RClass.safe_get_name_by_value(self.klass)
-    else:
-      klass = self.klass
-
-    return f'R: {self.name} {klass} {type}'
+    return f'R: {self.name} {class_name(self.klass)} {type_name(self.type)}'
 
   def __bytes__(self) -> bytes:
-    res = (Encoding.encode(self.name)
+    res = (self.name.wire
            + struct.pack('!HH', self.type, self.klass))
     self.bytes_written = len(res)
     return res
@@ -161,15 +162,19 @@ class Record(BaseRecord):
     if pre != ResponseCode.NO_ERROR:
       return pre
 
-    if not RClass.value_exists(self.klass):
+    if self.klass not in RECORD_CLASSES and self.type != RType.OPT.value:
+      # an OPT record's class is the requester's UDP payload size
       logger.error('Class not supported')
       return ResponseCode.NOT_IMPLEMENTED
 
     return ResponseCode.NO_ERROR
 
   @classmethod
-  def from_bytes(cls, data: bytes, offset: int = 0) -> tuple['Record', int]:
-    new_class, i = super(Record, cls).from_bytes(data, offset=offset)
+  def from_bytes(cls, data: bytes, offset: int = 0,
+                 names: dict[int, bytes] | None = None
+                 ) -> tuple['Record', int]:
+    new_class, i = super(Record, cls).from_bytes(data, offset=offset,
+                                                 names=names)
 
     klass = int.from_bytes(data[i:i + 2], 'big')
     i += 2
@@ -185,43 +190,33 @@ class Record(BaseRecord):
 
 
 class Query(Record):
+  __slots__ = ()
+
   def __repr__(self) -> str:
-    if RClass.value_exists(self.klass):
-      klass = RClass.safe_get_name_by_value(self.klass)
-    elif QClass.value_exists(self.klass):
-      klass = QClass.safe_get_name_by_value(self.klass)
-    else:
-      klass = self.klass
-
-    if RType.value_exists(self.type):
-      type = RType.safe_get_name_by_value(self.type)
-    elif QType.value_exists(self.type):
-      type = QType.safe_get_name_by_value(self.type)
-    else:
-      type = self.type
-
-    return f'Q: {self.name} {klass} {type}'
+    return f'Q: {self.name} {class_name(self.klass)} {type_name(self.type)}'
 
   def validate(self) -> ResponseCode:
-    if (not RType.value_exists(self.type)
-       and not QType.value_exists(self.type)):
+    if self.type not in QUERY_TYPES:
       logger.error(f'Query Type ({self.type}) not supported')
       return ResponseCode.NOT_IMPLEMENTED
-    if (not RClass.value_exists(self.klass)
-       and not QClass.value_exists(self.klass)):
+    if self.klass not in QUERY_CLASSES:
       logger.error(f'Query Class ({self.klass}) not supported')
       return ResponseCode.NOT_IMPLEMENTED
     return ResponseCode.NO_ERROR
 
 
 class ResourceRecord(Record):
-  ttl: int = 0
-  rdlength: int = 0
-  rdata: RDATA | None = None
+  __slots__ = ('ttl', 'rdlength', 'rdata')
+
+  ttl: int
+  rdlength: int
+  rdata: RDATA | None
 
   def __init__(self, *args, **kwargs):
-    super(Record, self).__init__(*args, **kwargs)
+    self.ttl = 0
+    self.rdlength = 0
     self.rdata = None
+    super(Record, self).__init__(*args, **kwargs)
 
     total = len(args) + len(kwargs)
     if total < 6:
@@ -240,7 +235,7 @@ class ResourceRecord(Record):
           value = value.value
         setattr(self, name, value)
 
-    if self.rdata is not None:
+    if self.rdata is not None and not isinstance(self.rdata, RDATA):
       self.rdata = RDATA.factory(record_type=self.type, data=self.rdata)
 
   def __copy__(self) -> 'ResourceRecord':
@@ -251,27 +246,29 @@ class ResourceRecord(Record):
     result.klass = self.klass
     result.ttl = self.ttl
     result.rdlength = self.rdlength
-    result.rdata = copy.copy(self.rdata)
+    # RDATA is immutable wire bytes, the copy shares it
+    result.rdata = self.rdata
     return result
 
   def __repr__(self) -> str:
-    klass = RClass.safe_get_name_by_value(self.klass)
-    type = RType.safe_get_name_by_value(self.type)
-    return f'R: {self.name} {klass} {type}'
+    return f'R: {self.name} {class_name(self.klass)} {type_name(self.type)}'
 
   def __bytes__(self) -> bytes:
     rdlength, rdata = self.encode_rdata()
     debug(type=self.type, klass=self.klass,
           ttl=self.ttl, rdlength=rdlength, rdata=rdata)
-    res = Encoding.encode(self.name)
+    res = self.name.wire
     res += struct.pack("!HHIH", self.type, self.klass, self.ttl, rdlength)
     res += rdata
     self.bytes_written = len(res)
     return res
 
   @classmethod
-  def from_bytes(cls, data: bytes, offset: int = 0) -> tuple['ResourceRecord', int]:
-    new_class, i = super(ResourceRecord, cls).from_bytes(data, offset=offset)
+  def from_bytes(cls, data: bytes, offset: int = 0,
+                 names: dict[int, bytes] | None = None
+                 ) -> tuple['ResourceRecord', int]:
+    new_class, i = super(ResourceRecord, cls).from_bytes(data, offset=offset,
+                                                         names=names)
     length = len(data)
     ttl = int.from_bytes(data[i:i + 4], 'big')
     i += 4
@@ -288,26 +285,34 @@ class ResourceRecord(Record):
     obj.rdata = None
 
     if (i + rdlength) <= length:
-      d = data[i:i + rdlength]
-      obj.rdata = obj.decode_rdata(d)
+      obj.rdata = obj.decode_rdata(data, i, rdlength, names)
       i += rdlength
 
     obj.bytes_read = i - offset
     return obj, i
 
   @classmethod
-  def lookup(cls, query: Query) -> 'ResourceRecord':
-    return cls(name=query.name, type=query.type,  klass=query.klass,   ttl=get_random_ttl(),   rdlength=4,  rdata='8.8.8.8')
-
-  def decode_rdata(self, data: bytes) -> RDATA:
-    if len(data) < 1:
-      return RDATA()
-    if not isinstance(self.rdata, RDATA):
-      self.rdata, _ = RDATA.get_callable(self.type)
-    return self.rdata.decode(data)
+  def lookup(cls, query: Query) -> 'ResourceRecord | None':
+    """
+    Placeholder answer for `query` when no resolver is configured, None
+    (an empty answer) for types without placeholder data.
+    """
+
+    fields = PLACEHOLDERS.get(query.type)
+    if fields is None:
+      return None
+    rdata = RDATA.factory(query.type, **fields)
+    return cls(name=query.name, type=query.type, klass=query.klass,
+               ttl=get_random_ttl(), rdlength=len(rdata), rdata=rdata)
+
+  def decode_rdata(self, data: bytes, offset: int = 0,
+                   length: int | None = None,
+                   names: dict[int, bytes] | None = None) -> RDATA:
+    codec, _ = RDATA.get_callable(self.type)
+    return codec.decode(data, offset, length, names)
 
   def encode_rdata(self) -> tuple[int, bytes]:
     if not isinstance(self.rdata, RDATA):
-      self.rdata = RDATA.factory(self.type, self.rdata)
-    res = bytes(self.rdata)
+      self.rdata = RDATA.factory(self.type, data=self.rdata)
+    res = self.rdata.wire
     return len(res), res
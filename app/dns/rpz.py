@@ -0,0 +1,248 @@
+import array
+import bisect
+import enum
+import ipaddress
+import logging
+import operator
+import re
+import sys
+import time
+
+from app.dns import metrics
+from app.dns.common import ResponseCode
+from app.dns.exceptions import FormatError
+from app.dns.message import Message
+from app.dns.name import ROOT, Name
+from app.dns.record import ResourceRecord
+from app.dns.zone import DEFAULT_TTL, parse_record
+
+logger = logging.getLogger(__name__)
+
+# a line holding nothing but a name, what most of a feed is made of
+_BARE = re.compile(rb'^([^\s#;]+?)\.?$', re.M)
+# every other line: rules with an action, hosts lines and comments
+_OTHER = re.compile(rb'^(?=[^\n]*[ \t#;])[^\n]+$', re.M)
+_group = operator.itemgetter(1)
+
+# names the header of a hosts file maps for the machine itself, next to
+# those without a dot (localhost, broadcasthost, ip6-allnodes, ...)
+_HOSTS_LOCAL = {b'localhost.localdomain', b'localhost.local'}
+
+
+class Action(enum.IntEnum):
+  # the lowest wins between action rules for the same name, and any of
+  # them over a bare listing of it
+  PASSTHRU = 0
+  NXDOMAIN = 1
+  NODATA = 2
+  REWRITE = 3
+
+
+_ACTIONS = {action.name.encode('ascii'): action for action in Action
+            if action != Action.REWRITE}
+# the RPZ spelling of the actions: CNAME to '.', '*.' or rpz-passthru.
+_RPZ_TARGETS = {b'.': Action.NXDOMAIN, b'*.': Action.NODATA,
+                b'rpz-passthru.': Action.PASSTHRU}
+
+
+class ResponsePolicy:
+  """
+  Block and rewrite rules for millions of names, matched before a query
+  is resolved. A rule names a domain exactly or, written '*.domain', all
+  names below it; the exact rule wins, then the wildcard of the closest
+  ancestor.
+
+  The bulk of a feed are names to answer NXDOMAIN. Those are kept as a
+  sorted array of 64-bit hashes, 8 bytes a name, which bisect searches
+  in C: a miss costs a few comparisons and no Python object is kept per
+  name. Two names sharing a hash is about as likely as a cosmic ray
+  flipping the answer. The few rules with another action are a dict.
+  """
+
+  def __init__(self, hashes: array.array,
+               rules: dict[bytes, Action] | None = None,
+               rewrites: dict[bytes, list[ResourceRecord]] | None = None,
+               source: str = '<policy>'):
+    self.hashes = hashes
+    self.rules = rules or {}
+    self.rewrites = rewrites or {}
+    self.source = source
+
+  def __len__(self) -> int:
+    return len(self.hashes) + len(self.rules)
+
+  def memory(self) -> int:
+    """
+    Bytes held by the rules.
+    """
+
+    return (self.hashes.itemsize * len(self.hashes)
+            + sys.getsizeof(self.rules)
+            + sum(sys.getsizeof(key) for key in self.rules))
+
+  def describe(self) -> str:
+    per_rule = self.memory() / len(self) if len(self) else 0
+    return (f'{len(self)} rules from {self.source}, {self.memory()} bytes '
+            f'({per_rule:.1f} per rule), {len(self.rewrites)} rewrites')
+
+  def _find(self, key: bytes) -> Action | None:
+    action = self.rules.get(key)
+    if action is not None:
+      return action
+    hashes = self.hashes
+    h = hash(key)
+    i = bisect.bisect_left(hashes, h)
+    if i < len(hashes) and hashes[i] == h:
+      return Action.NXDOMAIN
+    return None
+
+  def match(self, name: Name) -> tuple[Action, bytes] | None:
+    """
+    The action of the rule matching `name` and the rule's key, the
+    lowercase text of the name or of the wildcard.
+    """
+
+    if name.is_root:
+      return None
+    key = str(name).lower().encode('ascii', 'replace')
+    action = self._find(key)
+    if action is not None:
+      return action, key
+    dot = key.find(b'.')
+    while dot >= 0:
+      wildcard = b'*' + key[dot:]
+      action = self._find(wildcard)
+      if action is not None:
+        return action, wildcard
+      dot = key.find(b'.', dot + 1)
+    return None
+
+  def respond(self, message: Message) -> Message | None:
+    """
+    Response the policy gives to `message`, None when no rule applies
+    and the query is resolved as usual.
+    """
+
+    if len(message.queries) != 1 or message.validate() != ResponseCode.NO_ERROR:
+      return None
+    query = message.queries[0]
+    found = self.match(query.name)
+    if found is None:
+      return None
+    action, key = found
+    metrics.POLICY_HITS.inc(action.name.lower())
+    if action == Action.PASSTHRU:
+      return None
+    if action == Action.NXDOMAIN:
+      return message.local_response(ResponseCode.NAME_ERROR)
+    answers = []
+    if action == Action.REWRITE:
+      # local data in place of the real answer; a CNAME answers any type
+      answers = [ResourceRecord(name=query.name, type=record.type,
+                                klass=record.klass, ttl=record.ttl,
+                                rdlength=record.rdlength, rdata=record.rdata)
+                 for record in self.rewrites.get(key, ())
+                 if record.type in (query.type, 5) or query.type == 255]
+    return message.local_response(ResponseCode.NO_ERROR, answers)
+
+
+def _key(word: bytes) -> bytes:
+  """
+  :raises FormatError: If `word` is not a name or wildcard.
+  """
+
+  key = word.lower().rstrip(b'.')
+  if not key or len(key) > 253 or b'..' in key or b'*' in key[1:]:
+    raise FormatError(f'Invalid name {word!r}')
+  return key
+
+
+def _is_address(word: bytes) -> bool:
+  try:
+    ipaddress.ip_address(word.split(b'%', 1)[0].decode('ascii'))
+  except (ValueError, UnicodeError):
+    return False
+  return True
+
+
+def _is_local(key: bytes) -> bool:
+  return (b'.' not in key or key in _HOSTS_LOCAL
+          or key.endswith(b'.localhost') or _is_address(key))
+
+
+def parse_rule(words: list[bytes]
+               ) -> list[tuple[bytes, Action, ResourceRecord | None]]:
+  """
+  Keys, actions and rewrite records of a rule line:
+
+    ads.example               NXDOMAIN for the name
+    *.ads.example             ... and for the names below it
+    tracker.example NODATA    NXDOMAIN, NODATA or PASSTHRU
+    login.example CNAME .     the RPZ forms: '.', '*.', 'rpz-passthru.'
+    portal.example A 192.0.2.1  rewrite, any record zone data may hold
+    0.0.0.0 ads.example ...   a hosts file line, NXDOMAIN for every name
+
+  Hosts lines are told apart by their address; the names of the machine
+  itself they list (localhost, broadcasthost, ...) are skipped, whatever
+  the address. Returns no rules for lines to skip.
+
+  :raises FormatError: If the line is not a rule.
+  """
+
+  if _is_address(words[0]):
+    return [(key, Action.NXDOMAIN, None)
+            for key in map(_key, words[1:]) if not _is_local(key)]
+  key = _key(words[0])
+
+  if len(words) == 1:
+    return [(key, Action.NXDOMAIN, None)]
+  if len(words) == 2:
+    action = _ACTIONS.get(words[1].upper())
+    if action is not None:
+      return [(key, action, None)]
+  if len(words) == 3 and words[1].upper() == b'CNAME':
+    action = _RPZ_TARGETS.get(words[2].lower())
+    if action is not None:
+      return [(key, action, None)]
+  text = [word.decode('ascii', 'replace') for word in words[1:]]
+  record = parse_record(text, ROOT, DEFAULT_TTL, owner=ROOT)
+  return [(key, Action.REWRITE, record)]
+
+
+def load_policy(path: str) -> ResponsePolicy:
+  """
+  Reads a rule file, one rule per line (see `parse_rule`), comments
+  starting with '#' or ';'. A name with several rewrite lines answers
+  with all of their records.
+
+  :raises OSError: If the file can't be read.
+  :raises FormatError: Naming the first line that is not a rule.
+  """
+
+  started = time.monotonic()
+  with open(path, 'rb') as f:
+    data = f.read().replace(b'\r', b'')
+  # bare names never reach Python code one by one: the regex finds
+  # them, hash() and sorted() run over the matches in C
+  hashes = array.array('q', sorted(map(hash, map(
+      _group, _BARE.finditer(data.lower())))))
+
+  rules: dict[bytes, Action] = {}
+  rewrites: dict[bytes, list[ResourceRecord]] = {}
+  for line in _OTHER.findall(data):
+    words = line.split(b'#', 1)[0].split(b';', 1)[0].split()
+    if not words:
+      continue
+    try:
+      parsed = parse_rule(words)
+    except FormatError as e:
+      raise FormatError(f'{path}: {line.decode("ascii", "replace")!r}: {e}')
+    for key, action, record in parsed:
+      if record is not None:
+        rewrites.setdefault(key, []).append(record)
+      if action < rules.get(key, Action.REWRITE + 1):
+        rules[key] = action
+  policy = ResponsePolicy(hashes, rules, rewrites, source=path)
+  logger.info(f'Loaded {policy.describe()} in '
+              f'{time.monotonic() - started:.2f}s')
+  return policy
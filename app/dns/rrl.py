@@ -0,0 +1,154 @@
+import enum
+import socket
+import time
+from array import array
+
+from app.dns.common import ResponseCode
+
+
+class Action(enum.Enum):
+  ALLOW = 0
+  SLIP = 1
+  DROP = 2
+
+
+CATEGORY_ANSWER = 0
+CATEGORY_NXDOMAIN = 1
+CATEGORY_ERROR = 2
+
+
+def client_prefix(address: str) -> bytes | str:
+  """
+  Returns the /24 (IPv4) or /56 (IPv6) network of `address` as a
+  hashable key.
+  """
+
+  if ':' in address:
+    return socket.inet_pton(socket.AF_INET6, address)[:7]
+  return address.rpartition('.')[0]
+
+
+def question_key(data: bytes) -> bytes | None:
+  """
+  Returns the case-folded wire qname and qtype of the first question
+  without decoding the message, or None when the packet is not a
+  well-formed query.
+  """
+
+  if len(data) < 17 or data[2] & 0x80 or data[4:6] == b'\x00\x00':
+    return None
+  i = 12
+  end = len(data)
+  while i < end and data[i] != 0:
+    if data[i] & 0xc0:
+      return None
+    i += data[i] + 1
+  if i + 3 > end:
+    return None
+  return data[12:i + 3].lower()
+
+
+def truncated_response(data: bytes) -> bytes:
+  """
+  Builds a minimal TC=1 response echoing the question, without parsing
+  the query.
+  """
+
+  key = question_key(data)
+  question = data[12:12 + len(key) + 2] if key is not None else b''
+  header = bytearray(data[:12])
+  header[2] = (header[2] & 0x79) | 0x82
+  header[3] = 0
+  header[4:12] = (b'\x00\x01' if question else b'\x00\x00') + bytes(6)
+  return bytes(header) + question
+
+
+class ResponseRateLimiter:
+  """
+  Response Rate Limiting with token buckets keyed by client prefix and
+  response category, held in a fixed-size table. Buckets refill lazily
+  on access so there is no aging sweep; a slot whose bucket is full
+  again is free to be taken over by another key.
+
+  `check` runs on the raw datagram before any parsing, `account`
+  charges NXDOMAIN and error responses to the prefix once they are
+  known, and a prefix in debt on either is limited up front.
+  """
+
+  def __init__(self, rate: float = 5.0, burst: float | None = None,
+               slip: int = 2, size: int = 1 << 16,
+               errors_rate: float | None = None):
+    self.rate = rate
+    self.burst = burst if burst is not None else rate
+    self.errors_rate = errors_rate if errors_rate is not None else rate
+    self.slip = slip
+    self.size = size
+    self._mask = size - 1
+    if size & self._mask:
+      raise ValueError('RRL table size must be a power of two')
+
+    self._keys = array('q', bytes(8 * size))
+    self._tokens = array('d', bytes(8 * size))
+    self._stamps = array('d', bytes(8 * size))
+    self._slipped = 0
+
+    self.allowed = 0
+    self.slipped = 0
+    self.dropped = 0
+
+  def _take(self, key: int, rate: float, now: float, cost: float = 1.0) -> float:
+    slot = key & self._mask
+    tokens = self._tokens[slot] + (now - self._stamps[slot]) * rate
+    if tokens > self.burst:
+      tokens = self.burst
+    if self._keys[slot] != key and tokens >= self.burst:
+      # the previous owner has fully refilled, take the slot over;
+      # otherwise the colliding keys share one bucket
+      self._keys[slot] = key
+    tokens -= cost
+    self._tokens[slot] = tokens if tokens > -self.burst else -self.burst
+    self._stamps[slot] = now
+    return tokens
+
+  def _peek(self, key: int, rate: float, now: float) -> float:
+    slot = key & self._mask
+    if self._keys[slot] != key:
+      return self.burst
+    return self._tokens[slot] + (now - self._stamps[slot]) * rate
+
+  def check(self, data: bytes, address: str) -> Action:
+    now = time.monotonic()
+    prefix = client_prefix(address)
+    question = question_key(data)
+
+    if question is None:
+      tokens = self._take(hash((prefix, CATEGORY_ERROR)), self.errors_rate, now)
+    else:
+      tokens = self._take(hash((prefix, CATEGORY_ANSWER, question)),
+                          self.rate, now)
+      if tokens >= 0:
+        tokens = min(
+            self._peek(hash((prefix, CATEGORY_NXDOMAIN)), self.errors_rate, now),
+            self._peek(hash((prefix, CATEGORY_ERROR)), self.errors_rate, now),
+        )
+
+    if tokens >= 0:
+      self.allowed += 1
+      return Action.ALLOW
+
+    if self.slip > 0:
+      self._slipped += 1
+      if self._slipped >= self.slip:
+        self._slipped = 0
+        self.slipped += 1
+        return Action.SLIP
+    self.dropped += 1
+    return Action.DROP
+
+  def account(self, address: str, rcode: int) -> None:
+    if rcode == ResponseCode.NO_ERROR.value:
+      return
+    category = (CATEGORY_NXDOMAIN if rcode == ResponseCode.NAME_ERROR.value
+                else CATEGORY_ERROR)
+    self._take(hash((client_prefix(address), category)),
+               self.errors_rate, time.monotonic())
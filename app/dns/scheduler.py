@@ -0,0 +1,71 @@
+import collections
+import threading
+from typing import Any, Hashable
+
+
+class FairQueue:
+  """
+  Bounded work queue between the receive thread and the query loop.
+  Items are queued per client and served round-robin, so one noisy
+  client only delays its own queries. `put` never blocks: when the
+  queue (or the client's share of it) is full the item is rejected.
+  """
+
+  def __init__(self, capacity: int = 4096, per_client: int = 256):
+    self.capacity = capacity
+    self.per_client = per_client
+    self.rejected = 0
+
+    self._queues: dict[Hashable, collections.deque] = {}
+    self._active: collections.deque = collections.deque()
+    self._size = 0
+    self._closed = False
+    self._cond = threading.Condition(threading.Lock())
+
+  def __len__(self) -> int:
+    return self._size
+
+  def put(self, key: Hashable, item: Any) -> bool:
+    with self._cond:
+      queue = self._queues.get(key)
+      if self._size >= self.capacity or (
+          queue is not None and len(queue) >= self.per_client):
+        self.rejected += 1
+        return False
+
+      if queue is None:
+        queue = self._queues[key] = collections.deque()
+        self._active.append(key)
+      queue.append(item)
+      self._size += 1
+      self._cond.notify()
+      return True
+
+  def get(self, timeout: float | None = None) -> Any | None:
+    """
+    Returns the next item in round-robin order, or None once the queue
+    is closed and drained (or `timeout` expires).
+    """
+
+    with self._cond:
+      while self._size == 0:
+        if self._closed or not self._cond.wait(timeout):
+          return None
+
+      key = self._active.popleft()
+      queue = self._queues[key]
+      item = queue.popleft()
+      self._size -= 1
+      if len(queue) > 0:
+        self._active.append(key)
+      else:
+        del self._queues[key]
+      return item
+
+  def close(self) -> None:
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def clients(self) -> int:
+    return len(self._queues)
@@ -0,0 +1,367 @@
+import fcntl
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from typing import Iterable, Iterator
+from multiprocessing import resource_tracker, shared_memory
+
+from app.dns import metrics
+from app.dns.cache import CacheKey, CachedAnswer, RRset, RRsetCache
+from app.dns.name import Name
+
+_MAGIC = b'DNSC'
+# magic, slot size, buckets, ways, stripes
+_TABLE = struct.Struct('<4sIIII')
+_TABLE_SIZE = 64
+# sequence, key hash, expiry, key length, target length, records, wire length
+_SLOT = struct.Struct('<IIdHHHH')
+_U32 = struct.Struct('<I')
+_KEY = struct.Struct('!HH')
+
+
+def _key_bytes(key: CacheKey) -> bytes:
+  name, rtype, klass, partition = key
+  return name.key + _KEY.pack(rtype, klass) + partition
+
+
+def _name_end(body: bytes) -> int:
+  """
+  Length of the owner name a slot's key starts with.
+  """
+
+  i = 0
+  while body[i]:
+    i += body[i] + 1
+  return i + 1
+
+
+def _rrset(body: bytes, expires: float, klen: int, tlen: int,
+           count: int) -> RRset:
+  target = None
+  if tlen:
+    target = Name.from_wire(body[klen:klen + tlen])
+  position = klen + tlen + 2 * count
+  return RRset(body[position:],
+               struct.unpack_from(f'<{count}H', body, klen + tlen),
+               expires, target)
+
+
+class SharedRRsetCache(RRsetCache):
+  """
+  RRset cache in a `multiprocessing.shared_memory` block, shared by
+  worker processes. It is a fixed size table of `buckets` x `ways`
+  slots: a key hashes to one bucket and may sit in any of its ways,
+  the least useful of which (empty, expired, then soonest to expire) is
+  replaced on insert.
+
+  Every slot starts with a sequence number (a seqlock). A writer makes
+  it odd, rewrites the slot and makes it even again; readers take no
+  lock at all, they copy the slot and discard it when the sequence was
+  odd or moved meanwhile. Writers of a bucket are serialized by one of
+  `stripes` fcntl record locks, which the kernel releases when a process
+  dies, so a worker crashing mid-write leaves an odd sequence (a slot
+  readers skip) that the next writer simply overwrites.
+
+  RRsets larger than a slot are not cached.
+  """
+
+  def __init__(self, capacity: int = 100000, min_ttl: int = 0,
+               max_ttl: int = 86400, slot_size: int = 512, ways: int = 8,
+               stripes: int = 64, name: str | None = None):
+    super().__init__(capacity=capacity, min_ttl=min_ttl, max_ttl=max_ttl)
+    self.owner = name is None
+    if self.owner:
+      buckets = max(1, -(-capacity // ways))
+      self.shm = shared_memory.SharedMemory(
+          create=True,
+          size=(_TABLE_SIZE + stripes * 4
+                + buckets * ways * (4 + slot_size)))
+      _TABLE.pack_into(self.shm.buf, 0, _MAGIC, slot_size, buckets, ways,
+                       stripes)
+    else:
+      self.shm = shared_memory.SharedMemory(name=name)
+      # before 3.13 attaching also registers the block with this
+      # process's resource tracker, which would remove it on exit
+      resource_tracker.unregister(self.shm._name, 'shared_memory')
+      magic, slot_size, buckets, ways, stripes = _TABLE.unpack_from(
+          self.shm.buf, 0)
+      if magic != _MAGIC:
+        raise ValueError(f'{name} is not a shared DNS cache')
+    self.buf = self.shm.buf
+    self.slot_size = slot_size
+    self.buckets = buckets
+    self.ways = ways
+    self.stripes = stripes
+    self.capacity = buckets * ways
+    self._counts = struct.Struct(f'<{stripes}i')
+    # the key hashes of a bucket's slots side by side, so a lookup finds
+    # its way with one unpack; they are hints, the slot has the key
+    self._tags = struct.Struct(f'<{ways}I')
+    self._tags_at = _TABLE_SIZE + stripes * 4
+    self._slots = self._tags_at + buckets * ways * 4
+    # record locks only exclude other processes, threads of this one
+    # are kept apart by the matching thread lock
+    self._lock_path = os.path.join(tempfile.gettempdir(),
+                                   f'{self.shm.name}.lock')
+    self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    self._stripe_locks = [threading.Lock() for _ in range(stripes)]
+
+  @property
+  def name(self) -> str:
+    return self.shm.name
+
+  def __len__(self) -> int:
+    return sum(self._counts.unpack_from(self.buf, _TABLE_SIZE))
+
+  def close(self) -> None:
+    """
+    Detaches from the table; the process that created it also removes
+    it.
+    """
+
+    self.buf = None
+    self.shm.close()
+    os.close(self._lock_fd)
+    if self.owner:
+      self.shm.unlink()
+      try:
+        os.unlink(self._lock_path)
+      except FileNotFoundError:
+        pass
+
+  def _locate(self, data: bytes) -> tuple[int, int]:
+    digest = zlib.crc32(data)
+    return digest, digest % self.buckets
+
+  def _read(self, offset: int) -> tuple[tuple, bytes] | None:
+    """
+    Consistent copy of the slot at `offset`, None when it is empty or
+    being written.
+    """
+
+    buf = self.buf
+    header = _SLOT.unpack_from(buf, offset)
+    seq, _, _, klen, tlen, count, wlen = header
+    if seq & 1 or klen == 0:
+      return None
+    data = bytes(buf[offset + _SLOT.size:
+                     offset + _SLOT.size + klen + tlen + 2 * count + wlen])
+    if _U32.unpack_from(buf, offset)[0] != seq:
+      return None
+    return header, data
+
+  def _get(self, key: CacheKey, now: float) -> RRset | None:
+    data = _key_bytes(key)
+    digest, bucket = self._locate(data)
+    first = bucket * self.ways
+    tags = self._tags.unpack_from(self.buf, self._tags_at + first * 4)
+    if digest not in tags:
+      return None
+    slot = self._read(self._slots
+                      + (first + tags.index(digest)) * self.slot_size)
+    if slot is None:
+      return None
+    (_, slot_digest, expires, klen, tlen, count, _), body = slot
+    if slot_digest != digest or body[:klen] != data or expires <= now:
+      return None
+    return _rrset(body, expires, klen, tlen, count)
+
+  def lookup(self, name: Name, rtype: int, klass: int,
+             partition: bytes = b'') -> CachedAnswer | None:
+    answer = self._chase(name, rtype, klass, partition, time.time())
+    metrics.CACHE_LOOKUPS.inc('miss' if answer is None else 'hit')
+    return answer
+
+  def entries(self) -> Iterator[tuple[CacheKey, RRset]]:
+    """
+    The live entries in table order, read without locking like
+    lookups. Owner names come back lowercased.
+    """
+
+    now = time.time()
+    for index in range(self.buckets * self.ways):
+      slot = self._read(self._slots + index * self.slot_size)
+      if slot is None:
+        continue
+      (_, _, expires, klen, tlen, count, _), body = slot
+      if expires <= now:
+        continue
+      end = _name_end(body)
+      rtype, klass = _KEY.unpack_from(body, end)
+      yield ((Name.from_wire(body[:end]), rtype, klass,
+              body[end + _KEY.size:klen]),
+             _rrset(body, expires, klen, tlen, count))
+
+  def restore(self, entries: Iterable[tuple[CacheKey, RRset]]) -> int:
+    # snapshots are restored before the workers start, so the table is
+    # locked once rather than a stripe per entry
+    with _StripeLock(self, 0, self.stripes):
+      return self._insert(entries, locked=True)
+
+  def _insert(self, rrsets: Iterable[tuple[CacheKey, RRset]],
+              locked: bool = False) -> int:
+    inserted = 0
+    for key, rrset in rrsets:
+      data = _key_bytes(key)
+      target = rrset.target.wire if rrset.target is not None else b''
+      body = (data + target
+              + struct.pack(f'<{rrset.count}H', *rrset.ttl_offsets)
+              + rrset.wire)
+      if _SLOT.size + len(body) > self.slot_size:
+        continue
+      digest, bucket = self._locate(data)
+      if locked:
+        self._put(bucket, digest, data, rrset, len(target), body)
+      else:
+        with self._bucket_lock(bucket):
+          self._put(bucket, digest, data, rrset, len(target), body)
+      inserted += 1
+    return inserted
+
+  def _put(self, bucket: int, digest: int, data: bytes, rrset: RRset,
+           tlen: int, body: bytes) -> None:
+    offset, added = self._choose(bucket, digest, data)
+    self._write(offset, (digest, rrset.expires, len(data), tlen,
+                         rrset.count, len(rrset.wire)), body)
+    self._tag(offset, digest)
+    if added:
+      self._count(bucket, 1)
+
+  def _choose(self, bucket: int, digest: int,
+              data: bytes) -> tuple[int, bool]:
+    """
+    Slot of `bucket` to write `data` to, and whether it was empty.
+    Only called with the bucket locked.
+    """
+
+    buf = self.buf
+    start = self._slots + bucket * self.ways * self.slot_size
+    # the tags usually settle it: the key's own slot, or a free one
+    tags = self._tags.unpack_from(
+        buf, self._tags_at + bucket * self.ways * 4)
+    for tag, added in ((digest, False), (0, True)):
+      if tag in tags:
+        offset = start + tags.index(tag) * self.slot_size
+        seq, slot_digest, _, klen = _SLOT.unpack_from(buf, offset)[:4]
+        if seq & 1:
+          break
+        if added and klen == 0:
+          return offset, True
+        if (not added and slot_digest == digest and bytes(
+            buf[offset + _SLOT.size:offset + _SLOT.size + klen]) == data):
+          return offset, False
+
+    free = None
+    best, best_expires = start, float('inf')
+    for way in range(self.ways):
+      offset = start + way * self.slot_size
+      seq, slot_digest, expires, klen = _SLOT.unpack_from(buf, offset)[:4]
+      if seq & 1:
+        # left half written by a crashed worker
+        best, best_expires = offset, float('-inf')
+      elif klen == 0:
+        if free is None:
+          free = offset
+      elif slot_digest == digest and bytes(
+          buf[offset + _SLOT.size:offset + _SLOT.size + klen]) == data:
+        return offset, False
+      elif expires < best_expires:
+        best, best_expires = offset, expires
+    if free is not None:
+      return free, True
+    return best, False
+
+  def _write(self, offset: int, fields: tuple, body: bytes) -> None:
+    buf = self.buf
+    seq = _U32.unpack_from(buf, offset)[0]
+    if not seq & 1:
+      seq += 1
+      _U32.pack_into(buf, offset, seq)
+    _SLOT.pack_into(buf, offset, seq, *fields)
+    buf[offset + _SLOT.size:offset + _SLOT.size + len(body)] = body
+    _U32.pack_into(buf, offset, (seq + 1) & 0xffffffff)
+
+  def _tag(self, offset: int, digest: int) -> None:
+    index = (offset - self._slots) // self.slot_size
+    _U32.pack_into(self.buf, self._tags_at + index * 4, digest)
+
+  def _count(self, bucket: int, delta: int) -> None:
+    offset = _TABLE_SIZE + (bucket % self.stripes) * 4
+    value = struct.unpack_from('<i', self.buf, offset)[0]
+    struct.pack_into('<i', self.buf, offset, value + delta)
+
+  def _bucket_lock(self, bucket: int) -> '_StripeLock':
+    return _StripeLock(self, bucket % self.stripes)
+
+  def flush(self) -> None:
+    """
+    Empties the table one stripe at a time, lookups keep running.
+    """
+
+    for stripe in range(self.stripes):
+      with _StripeLock(self, stripe):
+        for bucket in range(stripe, self.buckets, self.stripes):
+          start = self._slots + bucket * self.ways * self.slot_size
+          for way in range(self.ways):
+            offset = start + way * self.slot_size
+            if _SLOT.unpack_from(self.buf, offset)[3]:
+              self._write(offset, (0, 0.0, 0, 0, 0, 0), b'')
+              self._tag(offset, 0)
+        struct.pack_into('<i', self.buf, _TABLE_SIZE + stripe * 4, 0)
+
+
+  def remove(self, name: Name, subtree: bool = False) -> int:
+    """
+    Drops every set owned by `name`, or with `subtree` by `name` and
+    the names below it, one stripe at a time like `flush`.
+    """
+
+    removed = 0
+    for stripe in range(self.stripes):
+      with _StripeLock(self, stripe):
+        for bucket in range(stripe, self.buckets, self.stripes):
+          start = self._slots + bucket * self.ways * self.slot_size
+          for way in range(self.ways):
+            offset = start + way * self.slot_size
+            klen = _SLOT.unpack_from(self.buf, offset)[3]
+            if klen == 0:
+              continue
+            key = bytes(self.buf[offset + _SLOT.size:
+                                 offset + _SLOT.size + klen])
+            key = key[:_name_end(key)]
+            if key != name.key and not (
+                subtree and key.endswith(name.key)
+                and Name(key).is_subdomain(name)):
+              continue
+            self._write(offset, (0, 0.0, 0, 0, 0, 0), b'')
+            self._tag(offset, 0)
+            self._count(bucket, -1)
+            removed += 1
+    return removed
+
+
+class _StripeLock:
+  """
+  Holds `count` consecutive stripes from `stripe` on, against threads
+  of this process and against other processes.
+  """
+
+  __slots__ = ('cache', 'stripe', 'count')
+
+  def __init__(self, cache: SharedRRsetCache, stripe: int, count: int = 1):
+    self.cache = cache
+    self.stripe = stripe
+    self.count = count
+
+  def __enter__(self) -> None:
+    for lock in self.cache._stripe_locks[self.stripe:self.stripe + self.count]:
+      lock.acquire()
+    fcntl.lockf(self.cache._lock_fd, fcntl.LOCK_EX, self.count, self.stripe)
+
+  def __exit__(self, *exc) -> None:
+    fcntl.lockf(self.cache._lock_fd, fcntl.LOCK_UN, self.count, self.stripe)
+    for lock in self.cache._stripe_locks[self.stripe:self.stripe + self.count]:
+      lock.release()
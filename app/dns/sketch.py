@@ -0,0 +1,254 @@
+import collections
+import heapq
+import threading
+import time
+from array import array
+from itertools import compress
+
+_MASK64 = (1 << 64) - 1
+
+
+def _hash64(key) -> int:
+  return hash(key) & _MASK64
+
+
+class CountMinSketch:
+  """
+  Fixed-size frequency estimator. Row indexes are derived from one 64
+  bit hash (Kirsch-Mitzenmacher), estimates never undercount.
+  """
+
+  def __init__(self, width: int = 4096, depth: int = 4):
+    self.width = width
+    self.depth = depth
+    self.rows = [array('L', bytes(array('L').itemsize * width))
+                 for _ in range(depth)]
+
+  def add(self, key, count: int = 1) -> int:
+    """
+    Adds `count` to `key` and returns the new estimate.
+    """
+
+    h = hash(key) & _MASK64
+    h1, h2 = h & 0xffffffff, h >> 32
+    width = self.width
+    estimate = -1
+    for row in self.rows:
+      i = h1 % width
+      value = row[i] + count
+      row[i] = value
+      if estimate < 0 or value < estimate:
+        estimate = value
+      h1 += h2
+    return estimate
+
+  def estimate(self, key) -> int:
+    h = _hash64(key)
+    h1, h2 = h & 0xffffffff, h >> 32
+    estimate = -1
+    for row in self.rows:
+      value = row[h1 % self.width]
+      if estimate < 0 or value < estimate:
+        estimate = value
+      h1 += h2
+    return estimate
+
+  def decay(self) -> None:
+    for n, row in enumerate(self.rows):
+      self.rows[n] = array(row.typecode, (v >> 1 for v in row))
+
+  def clear(self) -> None:
+    for row in self.rows:
+      row[:] = array(row.typecode, bytes(row.itemsize * self.width))
+
+  def __sizeof__(self) -> int:
+    return sum(row.itemsize * len(row) for row in self.rows)
+
+
+class TopK:
+  """
+  Heavy hitters on top of a count-min sketch: every key is counted in
+  the sketch, but only keys whose estimate beats the smallest tracked
+  count enter the `capacity` sized table. One-off keys (random
+  subdomains, spoofed sources) never touch the table or its heap.
+  """
+
+  def __init__(self, capacity: int = 100, width: int = 4096,
+               depth: int = 4):
+    self.capacity = capacity
+    self.sketch = CountMinSketch(width, depth)
+    self.counts: dict = {}
+    self._heap: list = []
+
+  def add(self, key, count: int = 1) -> None:
+    estimate = self.sketch.add(key, count)
+    counts = self.counts
+    if key not in counts:
+      if len(counts) >= self.capacity:
+        if estimate <= self._min():
+          return
+        _, evicted = heapq.heappop(self._heap)
+        del counts[evicted]
+    counts[key] = estimate
+    heapq.heappush(self._heap, (estimate, key))
+    if len(self._heap) > 4 * self.capacity:
+      self._rebuild()
+
+  def _min(self) -> int:
+    heap, counts = self._heap, self.counts
+    while counts.get(heap[0][1]) != heap[0][0]:
+      heapq.heappop(heap)
+    return heap[0][0]
+
+  def _rebuild(self) -> None:
+    self._heap = [(c, k) for k, c in self.counts.items()]
+    heapq.heapify(self._heap)
+
+  def estimate(self, key) -> int:
+    return self.sketch.estimate(key)
+
+  def top(self, k: int = 10) -> list[tuple[object, int]]:
+    return heapq.nlargest(k, self.counts.items(), key=lambda i: i[1])
+
+  def decay(self) -> None:
+    self.sketch.decay()
+    self.counts = {k: c >> 1 for k, c in self.counts.items()}
+    self._rebuild()
+
+  def __sizeof__(self) -> int:
+    return self.sketch.__sizeof__() + self.counts.__sizeof__()
+
+
+class HyperLogLog:
+  def __init__(self, p: int = 12):
+    self.p = p
+    self.m = 1 << p
+    self.registers = bytearray(self.m)
+    self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+  def add(self, key) -> None:
+    self.add_hash(_hash64(key))
+
+  def add_hash(self, h: int) -> None:
+    bits = 64 - self.p
+    h &= _MASK64
+    i = h >> bits
+    rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+    if rank > self.registers[i]:
+      self.registers[i] = rank
+
+  def count(self) -> int:
+    registers = self.registers
+    estimate = self.alpha * self.m * self.m / sum(
+        2.0 ** -r for r in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * self.m and zeros > 0:
+      import math
+      estimate = self.m * math.log(self.m / zeros)
+    return int(estimate)
+
+  def clear(self) -> None:
+    self.registers = bytearray(self.m)
+
+
+class HeavyHitters:
+  """
+  Streaming top names, clients and NXDOMAIN names plus unique client
+  and name cardinality, all in fixed memory. The query path only appends
+  to a batch; batches are pre-aggregated with a C-level Counter and
+  folded into the sketches every `batch_size` queries. Counts are halved
+  every `window` seconds so the view follows the current traffic.
+
+  With `sample` > 1 only every sample-th query of a batch feeds the
+  top-K tables (counts are scaled back up), which keeps the per-query
+  cost bounded during floods of unique names or sources. The
+  HyperLogLogs see every distinct key of a batch.
+  """
+
+  def __init__(self, capacity: int = 100, batch_size: int = 1024,
+               window: float = 60.0, width: int = 4096, depth: int = 4,
+               sample: int = 8):
+    self.batch_size = batch_size
+    self.window = window
+    self.sample = sample
+    self.names = TopK(capacity, width, depth)
+    self.clients = TopK(capacity, width, depth)
+    self.nxdomain = TopK(capacity, width, depth)
+    self.unique_clients = HyperLogLog()
+    self.unique_names = HyperLogLog()
+    self.last_unique_clients = 0
+    self.last_unique_names = 0
+
+    self._batch: collections.deque = collections.deque()
+    self._lock = threading.Lock()
+    self._window_start = time.monotonic()
+
+  def observe(self, qname: str, client: str, rcode: int) -> None:
+    batch = self._batch
+    batch.append((qname, client, rcode))
+    if len(batch) >= self.batch_size:
+      self.flush()
+
+  def flush(self) -> None:
+    # the query loop and metrics scrapes both flush; each batch must be
+    # taken by exactly one of them. Observations appended while it is
+    # drained stay queued for the next flush.
+    with self._lock:
+      queued = self._batch
+      popleft = queued.popleft
+      batch = [popleft() for _ in range(len(queued))]
+    if len(batch) == 0:
+      return
+    sample = self.sample
+    qnames, clients, rcodes = zip(*batch)
+    sampled = list(map(str.lower, qnames[::sample]))
+    name_counts = collections.Counter(sampled)
+    client_counts = collections.Counter(clients[::sample])
+    nxdomain_counts = collections.Counter(
+        compress(sampled, map((3).__eq__, rcodes[::sample])))
+    name_keys = set(map(str.lower, qnames))
+    client_keys = set(clients)
+
+    with self._lock:
+      now = time.monotonic()
+      if now - self._window_start >= self.window:
+        self._rotate()
+        self._window_start = now
+
+      for summary, counts in ((self.names, name_counts),
+                              (self.clients, client_counts),
+                              (self.nxdomain, nxdomain_counts)):
+        add = summary.add
+        for key, count in counts.items():
+          add(key, count * sample)
+      for hll, keys in ((self.unique_names, name_keys),
+                        (self.unique_clients, client_keys)):
+        add = hll.add_hash
+        for h in map(hash, keys):
+          add(h)
+
+  def _rotate(self) -> None:
+    for summary in (self.names, self.clients, self.nxdomain):
+      summary.decay()
+    self.last_unique_clients = self.unique_clients.count()
+    self.last_unique_names = self.unique_names.count()
+    self.unique_clients.clear()
+    self.unique_names.clear()
+
+  def estimate(self, qname: str) -> int:
+    self.flush()
+    with self._lock:
+      return self.names.estimate(qname.lower())
+
+  def report(self, k: int = 10) -> dict:
+    self.flush()
+    with self._lock:
+      return {
+          'top_names': self.names.top(k),
+          'top_clients': self.clients.top(k),
+          'top_nxdomain': self.nxdomain.top(k),
+          'unique_clients': max(self.unique_clients.count(),
+                                self.last_unique_clients),
+          'unique_names': max(self.unique_names.count(),
+                              self.last_unique_names),
+      }
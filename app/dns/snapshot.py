@@ -0,0 +1,191 @@
+import argparse
+import gc
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Iterable, Iterator
+
+from app.dns.cache import CacheKey, RRset, RRsetCache
+from app.dns.common import type_name
+from app.dns.name import Name
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DNSCACHE\x00\x03'
+# snapshots with a one-octet partition length
+MAGIC_V2 = b'DNSCACHE\x00\x02'
+# snapshots from before cache partitions, read as the default partition
+MAGIC_V1 = b'DNSCACHE\x00\x01'
+
+# expiry, type, class, owner length, target length, records, wire length,
+# partition length; followed by the owner, the target, the TTL offsets,
+# the records and the partition
+_ENTRY = struct.Struct('<dHHBBHHH')
+_ENTRIES = {MAGIC: _ENTRY, MAGIC_V2: struct.Struct('<dHHBBHHB'),
+            MAGIC_V1: struct.Struct('<dHHBBHH')}
+
+
+def write_snapshot(path: str,
+                   entries: Iterable[tuple[CacheKey, RRset]]) -> int:
+  """
+  Writes `entries` to `path` with their absolute expiry, through a
+  temporary file renamed into place so a crash never leaves a partial
+  snapshot behind. The temporary file is named after the process, as
+  during a handoff the old and the new process both save. Returns the
+  number of entries written.
+
+  :raises OSError: If the snapshot can't be written.
+  :raises struct.error: If an entry does not fit the format.
+  """
+
+  written = 0
+  temporary = f'{path}.{os.getpid()}.tmp'
+  try:
+    with open(temporary, 'wb', buffering=1 << 20) as f:
+      f.write(MAGIC)
+      for (name, rtype, klass, partition), rrset in entries:
+        target = rrset.target.wire if rrset.target is not None else b''
+        f.write(_ENTRY.pack(rrset.expires, rtype, klass, len(name.wire),
+                            len(target), rrset.count, len(rrset.wire),
+                            len(partition)))
+        f.write(name.wire)
+        f.write(target)
+        f.write(struct.pack(f'<{rrset.count}H', *rrset.ttl_offsets))
+        f.write(rrset.wire)
+        f.write(partition)
+        written += 1
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temporary, path)
+  except BaseException:
+    try:
+      os.unlink(temporary)
+    except OSError:
+      pass
+    raise
+  return written
+
+
+def read_snapshot(path: str, now: float | None = None
+                  ) -> Iterator[tuple[CacheKey, RRset]]:
+  """
+  Streams the entries of a snapshot from a memory map, skipping those
+  expired by `now` without copying them. A truncated tail is ignored.
+  Names are built directly rather than interned: they are mostly
+  distinct, and interning millions would only churn the table.
+  """
+
+  if now is None:
+    now = time.time()
+  with open(path, 'rb') as f, \
+      mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+    entry = _ENTRIES.get(buf[:len(MAGIC)])
+    if entry is None:
+      raise ValueError(f'{path} is not a cache snapshot')
+
+    size = len(buf)
+    offset = len(MAGIC)
+    unpack_from = entry.unpack_from
+    while offset + entry.size <= size:
+      (expires, rtype, klass, nlen, tlen, count, wlen,
+       *plen) = unpack_from(buf, offset)
+      start = offset + entry.size
+      end = start + nlen + tlen + 2 * count + wlen
+      offset = end + (plen[0] if plen else 0)
+      if offset > size:
+        logger.warning(f'{path} is truncated')
+        break
+      if expires <= now:
+        continue
+      target = None
+      if tlen:
+        target = Name(buf[start + nlen:start + nlen + tlen])
+      position = start + nlen + tlen
+      yield ((Name(buf[start:start + nlen]), rtype, klass, buf[end:offset]),
+             RRset(buf[position + 2 * count:end],
+                   struct.unpack_from(f'<{count}H', buf, position),
+                   expires, target))
+
+
+def load(cache: RRsetCache, path: str) -> int:
+  """
+  Restores a snapshot into `cache`, returns the number of live entries
+  inserted. A missing snapshot is not an error, an unreadable one is logged.
+  """
+
+  if not os.path.exists(path):
+    return 0
+  start = time.perf_counter()
+  loaded = 0
+  # millions of new objects would trigger a full collection over and
+  # over, each walking everything loaded so far
+  enabled = gc.isenabled()
+  gc.disable()
+  try:
+    loaded = cache.restore(read_snapshot(path))
+  except (OSError, ValueError) as e:
+    logger.error(f'Could not load cache snapshot {path}: {e}')
+  finally:
+    if enabled:
+      gc.enable()
+  # the entries hold no cycles and live until evicted: keep later
+  # collections from walking them at all
+  gc.freeze()
+  logger.info(f'Loaded {loaded} cache entries from {path} in '
+              f'{time.perf_counter() - start:.2f}s')
+  return loaded
+
+
+class Snapshotter:
+  """
+  Saves `cache` to `path` every `interval` seconds from a background
+  thread, and one last time when stopped.
+  """
+
+  def __init__(self, cache: RRsetCache, path: str, interval: float = 300.0):
+    self.cache = cache
+    self.path = path
+    self.interval = interval
+    self._stopping = threading.Event()
+    self._thread = threading.Thread(target=self._run, name='cache-snapshot',
+                                    daemon=True)
+
+  def start(self) -> None:
+    if self.interval > 0:
+      self._thread.start()
+
+  def save(self) -> int:
+    start = time.perf_counter()
+    try:
+      written = write_snapshot(self.path, self.cache.entries())
+    except (OSError, struct.error) as e:
+      logger.error(f'Could not save cache snapshot {self.path}: {e}')
+      return 0
+    logger.info(f'Saved {written} cache entries to {self.path} in '
+                f'{time.perf_counter() - start:.2f}s')
+    return written
+
+  def stop(self) -> None:
+    self._stopping.set()
+    if self._thread.is_alive():
+      self._thread.join()
+    self.save()
+
+  def _run(self) -> None:
+    while not self._stopping.wait(self.interval):
+      self.save()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Dumps cache snapshots.')
+  parser.add_argument('file')
+  args = parser.parse_args()
+
+  now = time.time()
+  for (name, rtype, klass, partition), rrset in read_snapshot(args.file, now):
+    view = f' partition={partition.hex()}' if partition else ''
+    print(f'{str(name) or "."} {type_name(rtype)} {klass} '
+          f'records={rrset.count} ttl={int(rrset.expires - now)}{view}')
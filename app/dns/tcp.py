@@ -0,0 +1,193 @@
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+from app.dns.common import _Address
+
+logger = logging.getLogger(__name__)
+
+
+def recv_exact(sock: socket.socket, length: int) -> bytes | None:
+  buf = bytearray()
+  while len(buf) < length:
+    chunk = sock.recv(length - len(buf))
+    if not chunk:
+      return None
+    buf += chunk
+  return bytes(buf)
+
+
+def recv_frame(sock: socket.socket) -> bytes | None:
+  """
+  Reads one length-prefixed DNS message (RFC 1035 4.2.2), None on EOF.
+  """
+
+  prefix = recv_exact(sock, 2)
+  if prefix is None:
+    return None
+  return recv_exact(sock, struct.unpack('!H', prefix)[0])
+
+
+def frame(data: bytes) -> bytes:
+  return struct.pack('!H', len(data)) + data
+
+
+class _Waiter:
+  __slots__ = ('event', 'result', 'conn', 'qid')
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.result: bytes | None = None
+    self.conn: 'TCPConnection | None' = None
+    self.qid = 0
+
+  def set(self, result: bytes | None) -> None:
+    self.result = result
+    self.event.set()
+
+  def wait(self, timeout: float) -> bytes | None:
+    """
+    The answer, None when it did not come within `timeout`; the query is
+    then given up and its ID freed on the connection.
+    """
+
+    if not self.event.wait(max(0, timeout)) and self.conn is not None:
+      self.conn.cancel(self)
+    return self.result
+
+
+class TCPConnection:
+  """
+  Persistent connection to an upstream carrying pipelined queries
+  (RFC 7766). Each query gets an ID unique on the connection and a
+  reader thread hands answers to their waiters by ID, in whatever order
+  they arrive.
+  """
+
+  def __init__(self, address: _Address, timeout: float = 2.0):
+    self.address = address
+    self.sock = socket.create_connection(address, timeout=timeout)
+    self.sock.settimeout(None)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.closed = False
+    self.pending: dict[int, _Waiter] = {}
+    self._lock = threading.Lock()
+    self._reader = threading.Thread(
+        target=self._read, name=f'tcp-{address[0]}:{address[1]}', daemon=True)
+    self._reader.start()
+
+  def submit(self, data: bytes) -> _Waiter:
+    waiter = _Waiter()
+    with self._lock:
+      if self.closed or len(self.pending) >= 0xFFFF:
+        waiter.set(None)
+        return waiter
+      qid = random.randint(0x0000, 0xFFFF)
+      while qid in self.pending:
+        qid = random.randint(0x0000, 0xFFFF)
+      self.pending[qid] = waiter
+      waiter.conn = self
+      waiter.qid = qid
+      try:
+        self.sock.sendall(frame(struct.pack('!H', qid) + data[2:]))
+      except OSError as e:
+        logger.debug(f'TCP send to {self.address} failed: {e}')
+        del self.pending[qid]
+        waiter.set(None)
+        self._close()
+    return waiter
+
+  def cancel(self, waiter: _Waiter) -> None:
+    """
+    Forgets a query whose answer is no longer awaited, so an upstream
+    dropping queries doesn't leave the connection looking busy.
+    """
+
+    with self._lock:
+      if self.pending.get(waiter.qid) is waiter:
+        del self.pending[waiter.qid]
+
+  def _read(self) -> None:
+    try:
+      while True:
+        buf = recv_frame(self.sock)
+        if buf is None or len(buf) < 12:
+          break
+        qid = struct.unpack('!H', buf[:2])[0]
+        with self._lock:
+          waiter = self.pending.pop(qid, None)
+        if waiter is not None:
+          waiter.set(buf)
+    except OSError as e:
+      logger.debug(f'TCP read from {self.address} failed: {e}')
+    with self._lock:
+      self._close()
+
+  def _close(self) -> None:
+    if self.closed:
+      return
+    self.closed = True
+    try:
+      self.sock.close()
+    except OSError:
+      pass
+    for waiter in self.pending.values():
+      waiter.set(None)
+    self.pending.clear()
+
+
+class TCPPool:
+  """
+  Small pool of persistent connections to one upstream. Queries go to
+  the connection with the fewest outstanding queries, a new connection
+  is only opened while the pool is below `size`.
+  """
+
+  def __init__(self, address: _Address, size: int = 2, timeout: float = 2.0):
+    self.address = address
+    self.size = size
+    self.timeout = timeout
+    self.connections: list[TCPConnection] = []
+    self._lock = threading.Lock()
+
+  def _connection(self, timeout: float) -> TCPConnection:
+    with self._lock:
+      self.connections = [c for c in self.connections if not c.closed]
+      idle = [c for c in self.connections if len(c.pending) == 0]
+      if idle:
+        return idle[0]
+      if len(self.connections) < self.size:
+        conn = TCPConnection(self.address, timeout=timeout)
+        self.connections.append(conn)
+        return conn
+      return min(self.connections, key=lambda c: len(c.pending))
+
+  def submit(self, data: bytes, deadline: float | None = None) -> _Waiter:
+    """
+    Sends `data` on a pooled connection. A new connection may take until
+    `deadline` (a time.monotonic() value) to set up, and at most the
+    pool's timeout.
+    """
+
+    timeout = self.timeout
+    if deadline is not None:
+      timeout = min(timeout, deadline - time.monotonic())
+    try:
+      if timeout <= 0:
+        raise socket.timeout('Deadline passed before connecting')
+      return self._connection(timeout).submit(data)
+    except OSError as e:
+      logger.warning(f'TCP connect to {self.address} failed: {e}')
+      waiter = _Waiter()
+      waiter.set(None)
+      return waiter
+
+  def close(self) -> None:
+    with self._lock:
+      for conn in self.connections:
+        with conn._lock:
+          conn._close()
+      self.connections = []
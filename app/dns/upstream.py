@@ -0,0 +1,316 @@
+import collections
+import logging
+import random
+import selectors
+import socket
+import struct
+import time
+
+from app.dns import metrics
+from app.dns.common import _Address
+from app.dns.exceptions import UpstreamError
+from app.dns.tcp import TCPPool
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamServer:
+  """
+  Round trip time bookkeeping for one upstream, RTO computed as in
+  RFC 6298 plus a p95 of recent samples used as the hedging delay.
+  Also holds the TCP connection pool and remembers which questions this
+  upstream answered truncated, so those go straight to TCP next time.
+  """
+
+  def __init__(self, address: _Address, initial_rto: float = 0.3,
+               min_rto: float = 0.02, max_rto: float = 2.0,
+               tcp_connections: int = 2, remember: int = 4096):
+    self.address = address
+    self.tcp = TCPPool(address, size=tcp_connections)
+    self.remember = remember
+    self._truncated: collections.OrderedDict = collections.OrderedDict()
+    self.initial_rto = initial_rto
+    self.min_rto = min_rto
+    self.max_rto = max_rto
+    self.srtt: float | None = None
+    self.rttvar: float = 0.0
+    self.timeouts = 0
+    self._samples: collections.deque = collections.deque(maxlen=256)
+    self._p95: float | None = None
+    self._since_p95 = 0
+
+  def __repr__(self) -> str:
+    return f'{self.address[0]}:{self.address[1]}'
+
+  def rto(self) -> float:
+    if self.srtt is None:
+      return self.initial_rto
+    return min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+  def p95(self) -> float:
+    if len(self._samples) < 20:
+      return self.rto()
+    if self._p95 is None or self._since_p95 >= 32:
+      values = sorted(self._samples)
+      self._p95 = values[int(len(values) * 0.95) - 1]
+      self._since_p95 = 0
+    return max(self.min_rto, self._p95)
+
+  def observe(self, rtt: float) -> None:
+    if self.srtt is None:
+      self.srtt = rtt
+      self.rttvar = rtt / 2
+    else:
+      self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+      self.srtt = 0.875 * self.srtt + 0.125 * rtt
+    self._samples.append(rtt)
+    self._since_p95 += 1
+    metrics.UPSTREAM_RTT.observe(rtt, self.address)
+
+  def needs_tcp(self, question: bytes) -> bool:
+    if question in self._truncated:
+      self._truncated.move_to_end(question)
+      return True
+    return False
+
+  def truncated(self, question: bytes) -> None:
+    self._truncated[question] = True
+    self._truncated.move_to_end(question)
+    if len(self._truncated) > self.remember:
+      self._truncated.popitem(last=False)
+
+  def timeout(self) -> None:
+    self.timeouts += 1
+    self.srtt = min(self.max_rto, self.rto() * 2)
+    metrics.UPSTREAM_ERRORS.inc(self.address, 'timeout')
+
+
+def _question_end(data: bytes) -> int:
+  """
+  Offset past the first question of the message `data`. Query names we
+  send are never compressed.
+  """
+
+  i = 12
+  while i < len(data) and data[i]:
+    i += data[i] + 1
+  return i + 5
+
+
+class _Exchange:
+  """
+  State of one query being resolved upstream: the copies in flight,
+  when the next copy is due and the outcome.
+  """
+
+  __slots__ = ('data', 'servers', 'attempt', 'next_send', 'result',
+               'server')
+
+  def __init__(self, data: bytes, servers: list[UpstreamServer], now: float):
+    self.data = data
+    self.servers = servers
+    self.attempt = 0
+    self.next_send = now
+    self.result: bytes | UpstreamError | None = None
+    self.server: UpstreamServer | None = None
+
+  @property
+  def question(self) -> bytes:
+    return self.data[12:].lower()
+
+  def matches(self, buf: bytes) -> bool:
+    """
+    Whether `buf` carries this query's question section; the ID alone is
+    only 16 bits for an off-path spoofer to guess (RFC 5452 9.1).
+    """
+
+    end = _question_end(self.data)
+    return (buf[4:6] == self.data[4:6]
+            and buf[12:end].lower() == self.data[12:end].lower())
+
+  @property
+  def truncated(self) -> bool:
+    return isinstance(self.result, bytes) and bool(self.result[2] & 0x02)
+
+
+class UpstreamPool:
+  """
+  Sends queries to upstream resolvers with a per-query deadline.
+
+  The first copy goes to the fastest server. If no answer arrives the
+  query is sent again, to the next server when there is one: first
+  after the p95 RTT of the server tried (a hedge), then after an RTO
+  that doubles with every attempt. Earlier copies stay outstanding, and
+  the first valid answer from any of them wins.
+
+  Several queries can be resolved at once by `exchange_many`, which
+  multiplexes all of them over one selector so the total latency is
+  that of the slowest query rather than the sum.
+
+  Truncated answers are retried over TCP on the upstream's pooled,
+  pipelined connections; questions an upstream answered truncated
+  before skip UDP altogether.
+  """
+
+  def __init__(self, servers: list[_Address], attempts: int = 3,
+               timeout: float = 2.0, hedge: bool = True,
+               parallelism: int = 8, **kwargs):
+    self.servers = [UpstreamServer(address, **kwargs) for address in servers]
+    self.attempts = attempts
+    self.timeout = timeout
+    self.hedge = hedge
+    self.parallelism = parallelism
+
+  def _ordered(self) -> list[UpstreamServer]:
+    return sorted(self.servers, key=lambda s: (s.srtt or 0, s.timeouts))
+
+  def exchange(self, data: bytes, deadline: float | None = None,
+               size: int = 512) -> bytes:
+    res = self.exchange_many([data], deadline=deadline, size=size)[0]
+    if isinstance(res, UpstreamError):
+      raise res
+    return res
+
+  def exchange_many(self, queries: list[bytes], deadline: float | None = None,
+                    size: int = 512) -> list[bytes | UpstreamError]:
+    """
+    Resolves `queries` concurrently, at most `parallelism` at a time.
+    Results are returned in order, an UpstreamError in place of every
+    query that got no answer before the deadline.
+    """
+
+    now = time.monotonic()
+    if deadline is None:
+      deadline = now + self.timeout
+    servers = self._ordered()
+    exchanges = [_Exchange(data, servers, now) for data in queries]
+    over_tcp = [ex for ex in exchanges if servers[0].needs_tcp(ex.question)]
+    for ex in over_tcp:
+      ex.server = servers[0]
+      metrics.UPSTREAM_TCP.inc('remembered')
+    waiting = collections.deque(ex for ex in exchanges if ex.server is None)
+    active: list[_Exchange] = []
+    selector = selectors.DefaultSelector()
+    pending: dict[socket.socket, tuple[_Exchange, UpstreamServer, float, int]] = {}
+
+    try:
+      while now < deadline and (waiting or active):
+        while waiting and len(active) < self.parallelism:
+          ex = waiting.popleft()
+          ex.next_send = now
+          active.append(ex)
+
+        wait_until = deadline
+        for ex in active:
+          if ex.attempt < self.attempts and now >= ex.next_send:
+            self._send(selector, pending, ex, now)
+          if ex.attempt < self.attempts:
+            wait_until = min(wait_until, ex.next_send)
+
+        for key, _ in selector.select(max(0, wait_until - now)):
+          ex = self._receive(selector, pending, key.fileobj, size)
+          if ex is not None:
+            active.remove(ex)
+        now = time.monotonic()
+
+      for _, server, _, _ in pending.values():
+        server.timeout()
+
+      for ex in exchanges:
+        if ex.truncated:
+          ex.server.truncated(ex.question)
+          metrics.UPSTREAM_TCP.inc('truncated')
+          over_tcp.append(ex)
+      if over_tcp:
+        self._exchange_tcp(over_tcp, deadline)
+
+      for ex in exchanges:
+        if ex.result is None:
+          ex.result = UpstreamError(
+              f'No answer from {", ".join(map(repr, servers))} '
+              'before deadline')
+      return [ex.result for ex in exchanges]
+    finally:
+      for sock in pending:
+        selector.unregister(sock)
+        sock.close()
+      selector.close()
+
+  def _send(self, selector: selectors.BaseSelector, pending: dict,
+            ex: _Exchange, now: float) -> None:
+    attempt = ex.attempt
+    server = ex.servers[attempt % len(ex.servers)]
+    if attempt == 0 and self.hedge and len(ex.servers) > 1:
+      ex.next_send = now + server.p95()
+    else:
+      ex.next_send = now + server.rto() * (2 ** attempt)
+    ex.attempt += 1
+    if attempt > 0:
+      metrics.UPSTREAM_RETRIES.inc('sent')
+
+    qid = random.randint(0x0000, 0xFFFF)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      sock.setblocking(False)
+      sock.connect(server.address)
+      sock.send(struct.pack('!H', qid) + ex.data[2:])
+    except OSError as e:
+      sock.close()
+      metrics.UPSTREAM_ERRORS.inc(server.address, 'send')
+      logger.warning(f'Sending to {server!r} failed: {e}')
+      return
+    selector.register(sock, selectors.EVENT_READ)
+    pending[sock] = (ex, server, now, qid)
+
+  def _receive(self, selector: selectors.BaseSelector, pending: dict,
+               sock: socket.socket, size: int = 512) -> _Exchange | None:
+    """
+    Reads an answer, returns the exchange it completed if any. Copies
+    of a completed exchange that are still in flight are abandoned.
+    """
+
+    ex, server, sent, qid = pending[sock]
+    try:
+      buf = sock.recv(size)
+    except OSError as e:
+      metrics.UPSTREAM_ERRORS.inc(server.address, 'receive')
+      logger.debug(f'Receiving from {server!r} failed: {e}')
+      return None
+    if (len(buf) < 12 or struct.unpack('!H', buf[:2])[0] != qid
+       or not ex.matches(buf)):
+      metrics.UPSTREAM_ERRORS.inc(server.address, 'mismatch')
+      return None
+
+    server.observe(time.monotonic() - sent)
+    if server is not ex.servers[0]:
+      metrics.UPSTREAM_RETRIES.inc('won')
+    ex.result = ex.data[:2] + buf[2:]
+    ex.server = server
+
+    for other in [s for s, p in pending.items() if p[0] is ex]:
+      selector.unregister(other)
+      other.close()
+      del pending[other]
+    return ex
+
+  def _exchange_tcp(self, exchanges: list[_Exchange], deadline: float) -> None:
+    """
+    Pipelines `exchanges` over the TCP pools of the servers they were
+    assigned to. A query lost to a closed connection is submitted once
+    more on a fresh one; if TCP fails a truncated UDP answer is kept.
+    """
+
+    waiters = [(ex, ex.server.tcp.submit(ex.data, deadline))
+               for ex in exchanges]
+    for ex, waiter in waiters:
+      buf = waiter.wait(deadline - time.monotonic())
+      if buf is None and time.monotonic() < deadline:
+        buf = ex.server.tcp.submit(ex.data, deadline).wait(
+            deadline - time.monotonic())
+      if buf is None:
+        metrics.UPSTREAM_ERRORS.inc(ex.server.address, 'tcp')
+        continue
+      if not ex.matches(buf):
+        metrics.UPSTREAM_ERRORS.inc(ex.server.address, 'mismatch')
+        continue
+      ex.result = ex.data[:2] + buf[2:]
@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+
+from app.dns.acl import Acl
+from app.dns.common import ResponseCode
+from app.dns.exceptions import FormatError
+from app.dns.message import Message
+from app.dns.name import Name
+from app.dns.zone import Zone, load_zone
+
+logger = logging.getLogger(__name__)
+
+
+class View:
+  """
+  What a set of clients sees: the clients are those `match` allows,
+  `zones` are answered authoritatively, other names are resolved
+  upstream for the clients `recursion` allows and refused for the
+  rest. Upstream answers are cached in the view's own partition of the
+  cache, so views never see each other's entries.
+  """
+
+  def __init__(self, name: str, match: Acl, recursion: Acl,
+               zones: list[Zone] | None = None):
+    self.name = name
+    self.match = match
+    self.recursion = recursion
+    self.zones: dict[Name, Zone] = {zone.origin: zone
+                                    for zone in zones or []}
+    self.partition = name.encode('utf-8') if name != 'default' else b''
+
+  def __repr__(self) -> str:
+    return f'View({self.name}, {len(self.zones)} zones)'
+
+  def zone(self, name: Name) -> Zone | None:
+    """
+    Closest enclosing zone of `name`.
+    """
+
+    if not self.zones:
+      return None
+    for suffix in name.suffixes():
+      zone = self.zones.get(suffix)
+      if zone is not None:
+        return zone
+    return None
+
+  def answer(self, message: Message) -> Message | None:
+    """
+    Authoritative response to `message` when its question falls in one
+    of the view's zones, None when it has to be resolved.
+    """
+
+    if len(message.queries) != 1 or message.validate() != ResponseCode.NO_ERROR:
+      return None
+    query = message.queries[0]
+    zone = self.zone(query.name)
+    if zone is None:
+      return None
+
+    rcode, answers, authorities = zone.answer(query.name, query.type)
+    return message.local_response(rcode, answers, authorities,
+                                  authoritative=True)
+
+
+class ViewTable:
+  """
+  The views in order; a client is served by the first view matching
+  it. A query from a client no view matches is refused.
+  """
+
+  def __init__(self, views: list[View]):
+    self.views = views
+
+  def __len__(self) -> int:
+    return len(self.views)
+
+  def select(self, address: str) -> View | None:
+    for view in self.views:
+      if view.match.allows(address):
+        return view
+    return None
+
+  @classmethod
+  def default(cls) -> 'ViewTable':
+    """
+    The single view of a server without --views: everyone resolves.
+    """
+
+    anyone = Acl(['any'])
+    return cls([View('default', anyone, anyone)])
+
+
+def load_views(path: str) -> ViewTable:
+  """
+  Reads the views from a JSON file:
+
+    {"acls": {"internal": ["10.0.0.0/8", "!10.99.0.0/16"]},
+     "views": [{"name": "internal",
+                "match-clients": ["internal", "localhost"],
+                "allow-recursion": ["any"],
+                "zones": {"corp.example": "corp.example.zone"}},
+               {"name": "external",
+                "match-clients": ["any"],
+                "allow-recursion": ["none"],
+                "zones": {"example.com": ["@ SOA ns1 hostmaster 1 ...",
+                                          "www 300 A 192.0.2.10"]}}]}
+
+  Zones are zone file paths, relative to the JSON file, or inline
+  lines. "allow-recursion" defaults to the view's clients.
+
+  :raises ValueError: If the file or a zone in it is invalid.
+  """
+
+  with open(path) as f:
+    config = json.load(f)
+  if not isinstance(config, dict):
+    raise ValueError(f'{path} must hold a JSON object')
+  directory = os.path.dirname(os.path.abspath(path))
+  acls = config.get('acls', {})
+  views = []
+  seen = set()
+  for entry in config.get('views', []):
+    name = entry.get('name')
+    if not name or name in seen:
+      raise ValueError(f'Views need distinct names, got {name!r}')
+    seen.add(name)
+    clients = entry.get('match-clients', ['any'])
+    zones = []
+    for origin, source in entry.get('zones', {}).items():
+      try:
+        zones.append(load_zone(origin, source, directory))
+      except (OSError, FormatError) as e:
+        raise ValueError(f'Zone {origin} of view {name}: {e}')
+    views.append(View(name, Acl(clients, acls),
+                      Acl(entry.get('allow-recursion', clients), acls),
+                      zones))
+  if not views:
+    raise ValueError(f'{path} defines no views')
+  return ViewTable(views)
+
+
+def describe(table: ViewTable) -> str:
+  return ', '.join(
+      f'{view.name} ({len(view.match)} prefixes, {len(view.zones)} zones, '
+      f'{sum(len(zone) for zone in view.zones.values())} records)'
+      for view in table.views)
+
@@ -0,0 +1,233 @@
+import logging
+import os
+import shlex
+from typing import Iterable
+
+from app.dns.cache import MAX_CHAIN
+from app.dns.common import RType, ResponseCode
+from app.dns.exceptions import FormatError
+from app.dns.name import Name
+from app.dns.rdata import RDATA
+from app.dns.record import ResourceRecord
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 3600
+
+# presentation fields of the types zone data may hold, in order;
+# 'strings' takes the rest of the line, one character string per word
+FIELDS: dict[int, tuple[tuple[str, str], ...]] = {
+    RType.A.value: (('data', 'address'),),
+    RType.AAAA.value: (('data', 'address'),),
+    RType.CNAME.value: (('data', 'name'),),
+    RType.NS.value: (('data', 'name'),),
+    RType.PTR.value: (('data', 'name'),),
+    RType.MX.value: (('preference', 'int'), ('exchange', 'name')),
+    RType.SRV.value: (('priority', 'int'), ('weight', 'int'), ('port', 'int'),
+                      ('target', 'name')),
+    RType.SOA.value: (('mname', 'name'), ('rname', 'name'), ('serial', 'int'),
+                      ('refresh', 'int'), ('retry', 'int'),
+                      ('expire', 'int'), ('minimum', 'int')),
+    RType.TXT.value: (('data', 'strings'),),
+}
+
+
+def absolute(name: str, origin: Name) -> Name:
+  """
+  `name` as written in zone data: '@' is the origin, names without a
+  trailing dot are relative to it.
+  """
+
+  if name == '@':
+    return origin
+  if name.endswith('.'):
+    return Name.from_text(name)
+  if origin.is_root:
+    return Name.from_text(name)
+  return Name.from_text(f'{name}.{origin}')
+
+
+def parse_record(words: list[str], origin: Name, ttl: int,
+                 owner: Name | None = None) -> ResourceRecord:
+  """
+  Record from the words of a zone file line: `owner [ttl] [IN] type
+  rdata...`. `owner` is used instead when the line leaves it out (the
+  caller passes it when the line started with a blank).
+
+  :raises FormatError: If the line can't be parsed.
+  """
+
+  words = list(words)
+  if owner is None:
+    owner = absolute(words.pop(0), origin)
+  if words and words[0].isdigit():
+    ttl = int(words.pop(0))
+  if words and words[0].upper() == 'IN':
+    words.pop(0)
+  if not words:
+    raise FormatError('Missing record type')
+  name = words.pop(0).upper()
+  if not RType.name_exists(name):
+    raise FormatError(f'Unknown record type {name}')
+  rtype = RType[name].value
+  fields = FIELDS.get(rtype)
+  if fields is None:
+    raise FormatError(f'{name} records are not supported in zone data')
+
+  codec, _ = RDATA.get_callable(rtype)
+  values = {}
+  strings = None
+  for field, kind in fields:
+    if kind == 'strings':
+      strings, words = words, []
+      continue
+    if not words:
+      raise FormatError(f'{name} record is missing its {field}')
+    word = words.pop(0)
+    if kind == 'int':
+      if not word.isdigit():
+        raise FormatError(f'{name} {field} must be a number: {word}')
+      values[field] = int(word)
+    elif kind == 'name':
+      values[field] = absolute(word, origin)
+    else:
+      values[field] = word
+  if words:
+    raise FormatError(f'Trailing data in {name} record: {" ".join(words)}')
+  try:
+    if strings is not None:
+      rdata = codec(b''.join(codec.encode(data=value) for value in strings))
+    else:
+      rdata = RDATA.factory(rtype, **values)
+  except (OSError, ValueError, UnicodeError) as e:
+    raise FormatError(f'Invalid {name} record: {e}')
+  return ResourceRecord(name=owner, type=rtype, klass=1, ttl=ttl,
+                        rdlength=len(rdata), rdata=rdata)
+
+
+def parse_zone(origin: Name, lines: Iterable[str],
+               source: str = '<zone>') -> list[ResourceRecord]:
+  """
+  Records of zone file `lines`, with $ORIGIN, $TTL, comments and
+  owners carried over from the previous line.
+
+  :raises FormatError: Naming the line that could not be parsed.
+  """
+
+  records = []
+  ttl = DEFAULT_TTL
+  owner = None
+  for number, line in enumerate(lines, 1):
+    try:
+      lexer = shlex.shlex(line, posix=True)
+      lexer.whitespace_split = True
+      lexer.commenters = ';'
+      words = list(lexer)
+      if not words:
+        continue
+      if words[0].upper() == '$ORIGIN':
+        origin = absolute(words[1], origin)
+        continue
+      if words[0].upper() == '$TTL':
+        ttl = int(words[1])
+        continue
+      record = parse_record(words, origin, ttl,
+                            owner if line[:1].isspace() else None)
+    except (FormatError, ValueError, IndexError) as e:
+      raise FormatError(f'{source}:{number}: {e}')
+    owner = record.name
+    records.append(record)
+  return records
+
+
+def load_zone(origin: str, source: str | list[str],
+              directory: str = '.') -> 'Zone':
+  """
+  Zone `origin` from a zone file path (relative to `directory`) or
+  from a list of lines.
+  """
+
+  name = Name.from_text(origin)
+  if isinstance(source, str):
+    path = os.path.join(directory, source)
+    with open(path) as f:
+      return Zone(name, parse_zone(name, f, path))
+  return Zone(name, parse_zone(name, source, origin))
+
+
+class Zone:
+  """
+  Authoritative data for the names at and below `origin`. Answers are
+  exact: a name with no records but names below it (an empty
+  non-terminal) exists and gets NODATA, any other name NXDOMAIN, both
+  with the zone's SOA as the negative TTL (RFC 2308). CNAMEs are
+  followed while they stay inside the zone.
+  """
+
+  def __init__(self, origin: Name, records: list[ResourceRecord]):
+    self.origin = origin
+    self.rrsets: dict[tuple[Name, int], list[ResourceRecord]] = {}
+    # every name of the zone, empty non-terminals included, with the
+    # types it has records of
+    self.names: dict[Name, list[int]] = {origin: []}
+    self.soa: ResourceRecord | None = None
+    for record in records:
+      if not record.name.is_subdomain(origin):
+        raise FormatError(f'{record.name} is outside the zone {origin}')
+      rrset = self.rrsets.setdefault((record.name, record.type), [])
+      if not rrset:
+        for name in record.name.suffixes():
+          if name in self.names:
+            break
+          self.names[name] = []
+        self.names[record.name].append(record.type)
+      rrset.append(record)
+      if record.type == RType.SOA.value and record.name == origin:
+        self.soa = record
+
+  def __len__(self) -> int:
+    return sum(len(rrset) for rrset in self.rrsets.values())
+
+  def __repr__(self) -> str:
+    return f'Zone({self.origin}, {len(self)} records)'
+
+  def answer(self, name: Name, rtype: int
+             ) -> tuple[ResponseCode, list[ResourceRecord],
+                        list[ResourceRecord]]:
+    """
+    The rcode, answer and authority records for a question about a
+    name in this zone.
+    """
+
+    answers = []
+    for _ in range(MAX_CHAIN):
+      if rtype == 255:
+        found = [record for owned in self.names.get(name, ())
+                 for record in self.rrsets[(name, owned)]]
+      else:
+        found = self.rrsets.get((name, rtype), [])
+      if found:
+        return ResponseCode.NO_ERROR, answers + found, []
+      cname = self.rrsets.get((name, RType.CNAME.value))
+      if cname is None:
+        break
+      answers += cname
+      name = Name.from_wire(cname[0].rdata.wire)
+      if not name.is_subdomain(self.origin):
+        # the client resolves the rest of the chain
+        return ResponseCode.NO_ERROR, answers, []
+
+    # after a CNAME the rcode is that of the last name (RFC 6604)
+    rcode = ResponseCode.NO_ERROR
+    if name not in self.names:
+      rcode = ResponseCode.NAME_ERROR
+    return rcode, answers, self._negative()
+
+  def _negative(self) -> list[ResourceRecord]:
+    soa = self.soa
+    if soa is None:
+      return []
+    record = ResourceRecord(name=soa.name, type=soa.type, klass=soa.klass,
+                            ttl=min(soa.ttl, soa.rdata.minimum),
+                            rdlength=soa.rdlength, rdata=soa.rdata)
+    return [record]
@@ -1,9 +1,37 @@
 import argparse
+import os
+import select
+import signal
 import socket
 import logging
+import sys
+import threading
+import time
+from typing import Callable
 from app.dns.message import Message
-from app.dns.exceptions import DNSError
+from app.dns.exceptions import (DNSError, DNSServerFailure, FormatError,
+                                RefuseError)
 from app.dns.common import setUpRootLogger
+from app.dns.log import log_query, set_log_level, dropped_records
+from app.dns.dnstap import TapWriter
+from app.dns import metrics
+from app.dns.profiling import StageTimer, ProfilerControl
+from app.dns.sketch import HeavyHitters
+from app.dns.rrl import (Action, ResponseRateLimiter, client_prefix,
+                         truncated_response)
+from app.dns.scheduler import FairQueue
+from app.dns.upstream import UpstreamPool
+from app.dns.cache import RRsetCache
+from app.dns.shared_cache import SharedRRsetCache
+from app.dns.ecs import SubnetCache
+from app.dns.nsec import NsecCache
+from app.dns import snapshot
+from app.dns.handoff import HandoffListener, take_over
+from app.dns.control import ControlServer
+from app.dns.name import Name
+from app.dns.rpz import load_policy
+from app.dns.views import ViewTable, describe, load_views
+from app.dns.frontends import DoHServer, DoTServer, create_tls_context
 
 setUpRootLogger()
 logger = logging.getLogger(__name__)
@@ -15,44 +43,498 @@ class DNSServer:
   # address = ('0.0.0.0', 2053)
 
   def __init__(self):
-    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.handle_arguments()
-    self.sock.bind(self.address)
+    set_log_level(self.arg.log_level)
+    self.worker = 0
+    self.draining = False
+    self.drain_deadline: float | None = None
+    self.cache = None
+    self.takeover = None
+    if self.arg.handoff_socket is not None:
+      if self.arg.workers > 1:
+        raise SystemExit('--handoff-socket requires a single worker')
+      # before loading the snapshot: the running server saves one first
+      self.takeover = take_over(self.arg.handoff_socket)
+    sockets = self.takeover.sockets if self.takeover is not None else {}
+    # read before forking so a bad file stops the server, not each worker
+    self.views = ViewTable.default()
+    if self.arg.views is not None:
+      try:
+        self.views = load_views(self.arg.views)
+      except (OSError, ValueError) as e:
+        raise SystemExit(f'Could not load --views: {e}')
+      logger.info(f'Views: {describe(self.views)}')
+    self.policy = None
+    if self.arg.rpz is not None:
+      try:
+        self.policy = load_policy(self.arg.rpz)
+      except (OSError, FormatError) as e:
+        raise SystemExit(f'Could not load --rpz: {e}')
+    self.snapshots = None
+    if self.arg.cache_size > 0:
+      if self.arg.workers > 1:
+        self.cache = SharedRRsetCache(capacity=self.arg.cache_size,
+                                      max_ttl=self.arg.cache_max_ttl)
+      else:
+        self.cache = RRsetCache(capacity=self.arg.cache_size,
+                                max_ttl=self.arg.cache_max_ttl)
+      if self.arg.cache_snapshot is not None:
+        snapshot.load(self.cache, self.arg.cache_snapshot)
+        self.snapshots = snapshot.Snapshotter(
+            self.cache, self.arg.cache_snapshot,
+            interval=self.arg.cache_snapshot_interval)
+    if self.arg.workers > 1:
+      self._run_workers()
+    elif self.snapshots is not None:
+      self.snapshots.start()
+
+    self.sock = sockets.get('udp')
+    if self.sock is None:
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      if self.arg.workers > 1:
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      self.sock.bind(self.address)
+    self.tap = None
+    if self.arg.dnstap_dir is not None:
+      filename = 'dns.tap'
+      if self.arg.workers > 1:
+        filename = f'dns.{self.worker}.tap'
+      self.tap = TapWriter(self.arg.dnstap_dir, filename=filename)
+      metrics.DROPPED_RECORDS.set_function(
+          lambda: {('dnstap',): self.tap.dropped})
+    metrics.DROPPED_RECORDS.set_function(
+        lambda: {('log',): dropped_records()})
+    self.stages = StageTimer(every=self.arg.stage_sample)
+    metrics.STAGE_DURATION.set_function(self.stages.metric_values)
+    self.profiler = ProfilerControl(self.arg.profile_dir,
+                                    window=self.arg.profile_window)
+    self.profiler.install()
+    self.heavy_hitters = HeavyHitters()
+    metrics.register_page('/top', self.heavy_hitters.report)
+    self.rrl = None
+    if self.arg.rrl_rate > 0:
+      self.rrl = ResponseRateLimiter(rate=self.arg.rrl_rate,
+                                     burst=self.arg.rrl_burst,
+                                     slip=self.arg.rrl_slip)
+    self.queue = FairQueue(capacity=self.arg.queue_size,
+                           per_client=self.arg.queue_per_client)
+    metrics.QUEUE_DEPTH.set_function(lambda: len(self.queue))
+    if self.cache is not None:
+      metrics.CACHE_ENTRIES.set_function(lambda: len(self.cache))
+    self.subnets = None
+    if self.arg.ecs:
+      # per process: tailored answers are short lived and rarely shared
+      self.subnets = SubnetCache(capacity=self.arg.ecs_cache_size,
+                                 max_ttl=self.arg.cache_max_ttl)
+      metrics.ECS_ENTRIES.set_function(lambda: len(self.subnets))
+    self.nsec = None
+    if self.arg.nsec_cache_size > 0:
+      self.nsec = NsecCache(capacity=self.arg.nsec_cache_size)
+      metrics.NSEC_RANGES.set_function(lambda: len(self.nsec))
+    self.listeners: dict[str, socket.socket] = {'udp': self.sock}
+    self.metrics_server = None
+    if self.arg.metrics_port is not None:
+      # every worker has its own registry, on consecutive ports
+      self.metrics_server = metrics.serve(
+          (self.address[0], self.arg.metrics_port + self.worker),
+          sock=sockets.get('metrics'))
+      self.listeners['metrics'] = self.metrics_server.socket
     logger.info(f'Listening on {self.address[0]}:{self.address[1]}')
+    self.frontends: list[DoTServer | DoHServer] = []
+    self._start_frontends(sockets)
+    # name -> callback reloading it, for the control channel's reload
+    self.reloaders: dict[str, Callable[[], str]] = {}
+    if self.arg.views is not None:
+      self.reloaders['views'] = self._reload_views
+    if self.policy is not None:
+      self.reloaders['rpz'] = self._reload_policy
+      metrics.POLICY_RULES.set_function(lambda: len(self.policy))
+      metrics.POLICY_BYTES.set_function(lambda: self.policy.memory())
+    self.control = None
+    if self.arg.control_socket is not None:
+      path = self.arg.control_socket
+      if self.arg.workers > 1:
+        path = f'{path}.{self.worker}'
+      self.control = ControlServer(path)
+      self._register_commands(self.control)
+      self.control.start()
+    self.handoff = None
+    if self.arg.handoff_socket is not None:
+      self.handoff = HandoffListener(
+          self.arg.handoff_socket, self.listeners, on_handoff=self.stop,
+          prepare=self.snapshots.save if self.snapshots else None)
+
+  def _run_workers(self) -> None:
+    """
+    Forks --workers processes which each bind the UDP port with
+    SO_REUSEPORT, so the kernel spreads clients over them, and share
+    the cache through shared memory. Returns in the workers with
+    `worker` set; the parent stays behind to restart workers that die
+    and removes the shared cache once they have all been stopped.
+    """
+
+    children: dict[int, int] = {}
+    stopping = False
+
+    def spawn(index: int) -> bool:
+      pid = os.fork()
+      if pid == 0:
+        self.worker = index
+        self.snapshots = None
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # until the worker's ProfilerControl takes them over
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        return True
+      children[pid] = index
+      return False
+
+    def stop(*_) -> None:
+      nonlocal stopping
+      stopping = True
+      for pid in children:
+        os.kill(pid, signal.SIGTERM)
+
+    def forward(signum: int, _) -> None:
+      # profiling requests sent to the parent go to every worker, the
+      # parent itself serves no queries
+      for pid in list(children):
+        try:
+          os.kill(pid, signum)
+        except ProcessLookupError:
+          pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+    for index in range(self.arg.workers):
+      if spawn(index):
+        return
+    logger.info(f'Started {self.arg.workers} workers')
+    # the parent holds the shared cache too, so it takes the snapshots
+    if self.snapshots is not None:
+      self.snapshots.start()
+
+    while children:
+      try:
+        pid, status = os.wait()
+      except ChildProcessError:
+        break
+      index = children.pop(pid)
+      if stopping:
+        continue
+      logger.warning(f'Worker {index} exited with status '
+                     f'{os.waitstatus_to_exitcode(status)}, restarting')
+      time.sleep(1)
+      if not stopping and spawn(index):
+        return
+
+    if self.snapshots is not None:
+      self.snapshots.stop()
+    if self.cache is not None:
+      self.cache.close()
+    sys.exit(0)
+
+  def _start_frontends(self, sockets: dict[str, socket.socket]) -> None:
+    if self.arg.dot_port is None and self.arg.doh_port is None:
+      return
+    if self.worker != 0:
+      return
+    if self.arg.tls_cert is None or self.arg.tls_key is None:
+      raise SystemExit('--tls-cert and --tls-key are required for DoT/DoH')
+
+    if self.arg.dot_port is not None:
+      context = create_tls_context(self.arg.tls_cert, self.arg.tls_key,
+                                   alpn=['dot'])
+      dot = DoTServer((self.address[0], self.arg.dot_port), context,
+                      self.submit, max_connections=self.arg.max_connections,
+                      idle_timeout=self.arg.idle_timeout,
+                      sock=sockets.get('dot'))
+      dot.start()
+      self.frontends.append(dot)
+      self.listeners['dot'] = dot.sock
+
+    if self.arg.doh_port is not None:
+      context = create_tls_context(self.arg.tls_cert, self.arg.tls_key,
+                                   alpn=['http/1.1'])
+      doh = DoHServer((self.address[0], self.arg.doh_port), context,
+                      self.submit, max_connections=self.arg.max_connections,
+                      idle_timeout=self.arg.idle_timeout,
+                      query_timeout=self.arg.upstream_deadline + 1,
+                      sock=sockets.get('doh'))
+      doh.start()
+      self.frontends.append(doh)
+      self.listeners['doh'] = doh.socket
 
   def main(self) -> None:
-    resolver = self.arg.resolver if 'resolver' in self.arg else None
+    resolver = None
+    if self.arg.resolver:
+      resolver = UpstreamPool(self.arg.resolver,
+                              attempts=self.arg.upstream_attempts,
+                              timeout=self.arg.upstream_deadline,
+                              hedge=not self.arg.no_hedge)
+    target = self.arg.queue_target / 1000
+    signal.signal(signal.SIGTERM, self.stop)
+    signal.signal(signal.SIGINT, self.stop)
+    receiver = threading.Thread(target=self.receive, name='receiver',
+                                daemon=True)
+    receiver.start()
+    if self.takeover is not None:
+      self.takeover.ready()
+      self.takeover = None
+    if self.handoff is not None:
+      self.handoff.start()
+
     while True:
-      buf, source = self.sock.recvfrom(512)
-      if len(buf) == 0:
+      item = self.queue.get(timeout=1.0)
+      if item is None:
+        if receiver.is_alive():
+          continue
+        break
+      if (self.drain_deadline is not None
+         and time.monotonic() > self.drain_deadline):
+        left = len(self.queue) + 1
+        metrics.DROPPED.inc('drain', amount=left)
+        logger.warning(f'Drain deadline passed, dropping {left} queries')
         break
+      buf, source, arrival, transport, reply = item
+
+      start = time.perf_counter()
+      sojourn = start - arrival
+      metrics.QUEUE_SOJOURN.observe(sojourn)
+      if sojourn > target:
+        self._shed(buf, source, reply, start, transport)
+        continue
 
+      sample = self.stages.sample(start=arrival)
+      sample.mark('receive')
+      message = None
       try:
-        message: Message = Message.from_bytes(buf)
+        try:
+          message: Message = Message.from_bytes(buf)
+        except Exception as e:
+          # crafted packets must cost one FORMERR, never the loop
+          metrics.PARSE_FAILURES.inc()
+          if isinstance(e, DNSError):
+            raise
+          raise FormatError(f'Malformed query from {source}: {e!r}') from e
+        sample.mark('parse')
 
-        response = message.create_response(resolver=resolver)
+        view = self.views.select(source[0])
+        if view is None:
+          raise RefuseError(f'No view matches {source[0]}')
+        response = view.answer(message)
+        if response is None:
+          if not view.recursion.allows(source[0]):
+            raise RefuseError(f'Recursion not allowed for {source[0]}')
+          if self.policy is not None:
+            response = self.policy.respond(message)
+        if response is None and self.nsec is not None:
+          response = self.nsec.respond(message, view.partition)
+        if response is None:
+          response = message.create_response(
+              resolver=resolver, sample=sample,
+              deadline=time.monotonic() + self.arg.upstream_deadline - sojourn,
+              cache=self.cache, partition=view.partition,
+              subnets=self.subnets, client=source[0], nsec=self.nsec)
+        sample.mark('resolve')
 
         res = response.serialize()
-        self.sock.sendto(res, source)
-      except socket.timeout:
-        break
+        # only stream transports carry answers of any size
+        if reply is None and len(res) > message.udp_payload_size():
+          metrics.TRUNCATED.inc()
+          response = response.truncated()
+          res = response.serialize()
+        sample.mark('serialize')
+        self._reply(res, source, reply)
+        sample.mark('send')
+        if self.rrl is not None and reply is None:
+          self.rrl.account(source[0], response.header.flags.rcode)
+        self._record_query(source, message, response, start, transport)
       except DNSError as e:
-        logger.exception(e)
-        self._create_error_response(e, buf, source)
+        logger.debug(f'{source}: {e!r}')
+        self._create_error_response(e, buf, source, reply, start, transport,
+                                    message)
       except Exception as e:
         logger.exception(e)
+        self._create_error_response(DNSServerFailure(), buf, source, reply,
+                                    start, transport, message)
+
+    self.queue.close()
+    if self.tap is not None:
+      self.tap.close()
+    if self.snapshots is not None:
+      self.snapshots.stop()
+    if self.handoff is not None:
+      self.handoff.close()
+    if self.control is not None:
+      self.control.close()
+
+  def stop(self, *_) -> None:
+    """
+    Starts a graceful exit, on SIGTERM/SIGINT or once the sockets were
+    handed to a new process: reading stops, queries already received
+    are answered until --drain-timeout, then the process exits through
+    the normal shutdown path (final cache snapshot included).
+    """
+
+    if self.draining:
+      return
+    logger.info('Draining')
+    self.draining = True
+    self.drain_deadline = time.monotonic() + self.arg.drain_timeout
+    for frontend in self.frontends:
+      frontend.stop()
+    if self.metrics_server is not None:
+      threading.Thread(target=self.metrics_server.shutdown,
+                       daemon=True).start()
+
+  def receive(self) -> None:
+    """
+    Receive loop feeding the fair queue. Only cheap work happens here:
+    rate limiting on the raw datagram and the per-client enqueue.
+
+    Reads never block, the loop waits in select() instead: after a
+    handoff another process reads the same socket and may take the
+    datagram that woke this one, and a drain must be noticed promptly.
+    """
+
+    while not self.draining:
+      try:
+        buf, source = self.sock.recvfrom(512, socket.MSG_DONTWAIT)
+      except BlockingIOError:
+        select.select([self.sock], [], [], 0.5)
+        continue
+      except OSError as e:
+        logger.error(f'Receive failed: {e}')
         break
+      if self.tap is not None:
+        # before any checks, the queries limited or shed are those
+        # most worth having on record
+        self.tap.query(buf, source)
+      if len(buf) < 12:
+        # not even a header, nothing to answer
+        metrics.PARSE_FAILURES.inc()
+        metrics.DROPPED.inc('malformed')
+        continue
+      arrival = time.perf_counter()
+
+      if self.rrl is not None and not self._rate_limit(buf, source):
+        continue
+      self.submit(buf, source, 'udp', None, arrival)
+    self.queue.close()
+
+  def submit(self, buf: bytes, source: any, transport: str,
+             reply: Callable[[bytes], None] | None,
+             arrival: float | None = None) -> bool:
+    """
+    Hands a query to the processing loop. `reply` delivers the answer
+    for stream transports, UDP answers (reply None) go out on the
+    server socket.
+    """
+
+    if arrival is None:
+      arrival = time.perf_counter()
+    if self.tap is not None and reply is not None:
+      # UDP queries were tapped on receipt
+      self.tap.query(buf, source)
+    if not self.queue.put(client_prefix(source[0]),
+                          (buf, source, arrival, transport, reply)):
+      metrics.DROPPED.inc('queue-full')
+      return False
+    return True
+
+  def _reply(self, res: bytes, source: any,
+             reply: Callable[[bytes], None] | None) -> None:
+    if reply is None:
+      self.sock.sendto(res, source)
+    else:
+      reply(res)
+    if self.tap is not None:
+      self.tap.response(res, source)
+
+  def _shed(self, buf: bytes, source: any,
+            reply: Callable[[bytes], None] | None, start: float,
+            transport: str) -> None:
+    policy = self.arg.shed_policy
+    metrics.SHED.inc(policy)
+    if policy == 'drop':
+      metrics.DROPPED.inc('shed')
+      return
+
+    e = RefuseError() if policy == 'refused' else DNSServerFailure()
+    try:
+      self._create_error_response(e, buf, source, reply, start, transport)
+    except Exception as e:
+      logger.debug(f'Could not shed {source}: {e}')
+
+  def _rate_limit(self, buf: bytes, source: any) -> bool:
+    """
+    Applies response rate limiting to a raw datagram, returns whether it
+    should be processed.
+    """
+
+    action = self.rrl.check(buf, source[0])
+    if action is Action.ALLOW:
+      return True
+
+    metrics.RRL_ACTIONS.inc(action.name.lower())
+    if action is Action.SLIP:
+      res = truncated_response(buf)
+      self.sock.sendto(res, source)
+      if self.tap is not None:
+        self.tap.response(res, source)
+    else:
+      metrics.DROPPED.inc('rrl')
+    return False
 
-  def _create_error_response(self, e: DNSError, buf: bytes,
-                             source: any) -> None:
+  def _record_query(self, source: any, message: Message | None,
+                    response: Message, start: float,
+                    transport: str = 'udp') -> None:
+    """
+    Accounts for an answered query, whatever its rcode. `message` is
+    None when the query could not be parsed.
+    """
+
+    elapsed = time.perf_counter() - start
+    qname, qtype = '-', 0
+    if message is not None and len(message.queries) > 0:
+      qname, qtype = str(message.queries[0].name), message.queries[0].type
+    rcode = response.header.flags.rcode
+    metrics.QUERIES.inc(qtype, rcode, transport)
+    metrics.LATENCY.observe(elapsed, transport)
+    self.heavy_hitters.observe(qname, source[0], rcode)
+    log_query(source, qname, qtype, rcode, elapsed, cache=response.cache)
+
+  def _create_error_response(self, e: DNSError | DNSServerFailure, buf: bytes,
+                             source: any,
+                             reply: Callable[[bytes], None] | None = None,
+                             start: float | None = None,
+                             transport: str = 'udp',
+                             message: Message | None = None) -> None:
     from app.dns.header import Header
+    if len(buf) < 12:
+      metrics.DROPPED.inc('malformed')
+      return
     header = Header.from_bytes(buf)
+    header.flags.qr = 1
     header.flags.rcode = e.rcode.value
+    header.qdcount = 0
     header.ancount = 0
     header.nscount = 0
     header.arcount = 0
     response = Message(header=header)
-    self.sock.sendto(response.serialize(), source)
+    if self.rrl is not None and reply is None:
+      self.rrl.account(source[0], e.rcode.value)
+    try:
+      self._reply(response.serialize(), source, reply)
+    except OSError as e:
+      logger.debug(f'Could not answer {source}: {e}')
+      return
+    if start is not None:
+      self._record_query(source, message, response, start, transport)
 
   def handle_arguments(self):
     parser = argparse.ArgumentParser(
@@ -63,11 +545,366 @@ class DNSServer:
     parser.add_argument(
       "--resolver",
       type=self._parse_address,
+      action="append",
+      required=False,
+      help="The resolver address in the format <ip>:<port>, may be "
+           "given more than once",
+    )
+
+    parser.add_argument(
+      "--upstream-deadline",
+      type=float,
+      default=2.0,
+      help="Seconds a query may take including upstream retries",
+    )
+
+    parser.add_argument(
+      "--upstream-attempts",
+      type=int,
+      default=3,
+      help="Copies of a query sent upstream before giving up",
+    )
+
+    parser.add_argument(
+      "--cache-size",
+      type=int,
+      default=100000,
+      help="Maximum RRsets kept in the answer cache (0 disables it)",
+    )
+
+    parser.add_argument(
+      "--cache-max-ttl",
+      type=int,
+      default=86400,
+      help="Cap in seconds on how long an RRset stays cached",
+    )
+
+    parser.add_argument(
+      "--nsec-cache-size",
+      type=int,
+      default=0,
+      help="Cache up to this many NSEC ranges of validated negative "
+           "answers and answer names inside them locally (RFC 8198); "
+           "needs a validating upstream",
+    )
+
+    parser.add_argument(
+      "--ecs",
+      action="store_true",
+      help="Send the client's /24 or /56 upstream (EDNS Client Subnet) "
+           "and cache answers per the subnet they were given for",
+    )
+
+    parser.add_argument(
+      "--ecs-cache-size",
+      type=int,
+      default=20000,
+      help="Maximum number of RRsets cached for client subnets, apart "
+           "from --cache-size",
+    )
+
+    parser.add_argument(
+      "--cache-snapshot",
+      required=False,
+      help="File the cache is saved to periodically and on shutdown, "
+           "and restored from at startup",
+    )
+
+    parser.add_argument(
+      "--cache-snapshot-interval",
+      type=float,
+      default=300.0,
+      help="Seconds between cache snapshots (0 only saves on shutdown)",
+    )
+
+    parser.add_argument(
+      "--handoff-socket",
+      required=False,
+      help="Unix socket path: a server started with the same path takes "
+           "over the listening sockets of the running one, which then "
+           "drains and exits",
+    )
+
+    parser.add_argument(
+      "--drain-timeout",
+      type=float,
+      default=5.0,
+      help="Seconds left to answer received queries when stopping",
+    )
+
+    parser.add_argument(
+      "--views",
+      required=False,
+      help="JSON file of client ACLs and views (split horizon): which "
+           "zones each view serves and who may resolve through it",
+    )
+
+    parser.add_argument(
+      "--rpz",
+      required=False,
+      help="Response policy file: names to answer NXDOMAIN, NODATA or "
+           "with local records instead of resolving them",
+    )
+
+    parser.add_argument(
+      "--control-socket",
+      required=False,
+      help="Unix socket for runtime commands (python -m app.dns.control "
+           "SOCKET help); with several workers each gets SOCKET.N",
+    )
+
+    parser.add_argument(
+      "--workers",
+      type=int,
+      default=1,
+      help="Worker processes sharing the port and a shared-memory cache",
+    )
+
+    parser.add_argument(
+      "--no-hedge",
+      action="store_true",
+      help="Wait a full RTO instead of the p95 RTT before sending a "
+           "second copy to another upstream",
+    )
+
+    parser.add_argument(
+      "--log-level",
+      type=lambda level: logging.getLevelName(level.upper()),
+      choices=[logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR],
+      default=logging.INFO,
+      help="Logging level (debug, info, warning, error)",
+    )
+
+    parser.add_argument(
+      "--dnstap-dir",
+      required=False,
+      help="Directory receiving the binary query/response log",
+    )
+
+    parser.add_argument(
+      "--metrics-port",
+      type=int,
+      required=False,
+      help="Port of the local Prometheus metrics endpoint",
+    )
+
+    parser.add_argument(
+      "--rrl-rate",
+      type=float,
+      default=0,
+      help="Responses per second allowed per client prefix and "
+           "response category (0 disables rate limiting)",
+    )
+
+    parser.add_argument(
+      "--rrl-burst",
+      type=float,
+      required=False,
+      help="Bucket size for rate limiting, defaults to the rate",
+    )
+
+    parser.add_argument(
+      "--rrl-slip",
+      type=int,
+      default=2,
+      help="Answer every Nth rate limited query with TC=1 instead of "
+           "dropping it (0 never slips)",
+    )
+
+    parser.add_argument(
+      "--dot-port",
+      type=int,
+      required=False,
+      help="Port for DNS over TLS (usually 853)",
+    )
+
+    parser.add_argument(
+      "--doh-port",
+      type=int,
+      required=False,
+      help="Port for DNS over HTTPS (usually 443), served at /dns-query",
+    )
+
+    parser.add_argument(
+      "--tls-cert",
+      required=False,
+      help="PEM certificate chain for DoT/DoH",
+    )
+
+    parser.add_argument(
+      "--tls-key",
       required=False,
-      help="The resolver address in the format <ip>:<port>",
+      help="PEM private key for DoT/DoH",
+    )
+
+    parser.add_argument(
+      "--max-connections",
+      type=int,
+      default=512,
+      help="Maximum concurrent connections per DoT/DoH listener",
+    )
+
+    parser.add_argument(
+      "--idle-timeout",
+      type=float,
+      default=30.0,
+      help="Seconds an idle DoT/DoH connection is kept open",
+    )
+
+    parser.add_argument(
+      "--queue-size",
+      type=int,
+      default=4096,
+      help="Maximum number of queries waiting to be processed",
+    )
+
+    parser.add_argument(
+      "--queue-per-client",
+      type=int,
+      default=256,
+      help="Maximum number of waiting queries per client prefix",
+    )
+
+    parser.add_argument(
+      "--queue-target",
+      type=float,
+      default=100,
+      help="Queue delay in milliseconds after which queries are shed",
+    )
+
+    parser.add_argument(
+      "--shed-policy",
+      choices=['drop', 'refused', 'servfail'],
+      default='refused',
+      help="How queries are shed once the queue delay exceeds the target",
+    )
+
+    parser.add_argument(
+      "--stage-sample",
+      type=int,
+      default=100,
+      help="Time the stages of 1 in N queries (0 disables)",
+    )
+
+    parser.add_argument(
+      "--profile-dir",
+      default='profiles',
+      help="Directory receiving cProfile (SIGUSR1) and tracemalloc "
+           "(SIGUSR2) results",
+    )
+
+    parser.add_argument(
+      "--profile-window",
+      type=float,
+      default=30.0,
+      help="Seconds a profiler runs once started",
     )
     self.arg = parser.parse_args()
 
+  def _reload_views(self) -> str:
+    """
+    Reads --views again; the new table replaces the old one in a single
+    assignment, so a query sees either one. A broken file keeps the old.
+    """
+
+    try:
+      views = load_views(self.arg.views)
+    except OSError as e:
+      raise ValueError(str(e))
+    self.views = views
+    return describe(views)
+
+  def _reload_policy(self) -> str:
+    """
+    Reads --rpz again into a new index, swapped in when complete; until
+    then and on errors the old rules keep applying.
+    """
+
+    try:
+      policy = load_policy(self.arg.rpz)
+    except (OSError, FormatError) as e:
+      raise ValueError(str(e))
+    self.policy = policy
+    return policy.describe()
+
+  def _register_commands(self, control: ControlServer) -> None:
+    def name(args: list[str]) -> Name:
+      if len(args) != 1:
+        raise ValueError('expected one domain name')
+      try:
+        return Name.from_text(args[0])
+      except FormatError as e:
+        raise ValueError(str(e))
+
+    def caches() -> list['RRsetCache | NsecCache']:
+      # answers tailored to client subnets and the NSEC ranges go with
+      # the shared answers
+      found = [self.cache] if self.cache is not None else []
+      if self.subnets is not None:
+        found.append(self.subnets.cache)
+      if self.nsec is not None:
+        found.append(self.nsec)
+      if not found:
+        raise ValueError('the cache is disabled')
+      return found
+
+    def flush(args: list[str]) -> str:
+      if not args:
+        for each in caches():
+          each.flush()
+        return 'flushed the cache'
+      removed = sum(each.remove(name(args)) for each in caches())
+      return f'removed {removed} sets'
+
+    def flushtree(args: list[str]) -> str:
+      removed = sum(each.remove(name(args), subtree=True) for each in caches())
+      return f'removed {removed} sets'
+
+    def reload(args: list[str]) -> str:
+      targets = args or list(self.reloaders)
+      if not targets:
+        return 'nothing to reload'
+      for target in targets:
+        if target not in self.reloaders:
+          raise ValueError(f'cannot reload {target!r}, '
+                           f'known: {", ".join(self.reloaders) or "none"}')
+      return '\n'.join(f'{target}: {self.reloaders[target]()}'
+                       for target in targets)
+
+    def loglevel(args: list[str]) -> str:
+      level = logging.getLevelName(args[0].upper()) if len(args) == 1 else None
+      if not isinstance(level, int):
+        raise ValueError('expected debug, info, warning or error')
+      set_log_level(level)
+      return f'log level {logging.getLevelName(level).lower()}'
+
+    def querylog(args: list[str]) -> str:
+      if args not in (['on'], ['off']):
+        raise ValueError('expected on or off')
+      logging.getLogger('app.query').setLevel(
+          logging.INFO if args[0] == 'on' else logging.WARNING)
+      return f'query logging {args[0]}'
+
+    def trace(args: list[str]) -> str:
+      if len(args) != 1 or not args[0].isdigit():
+        raise ValueError('expected N to time 1 in N queries, 0 to stop')
+      self.stages.every = int(args[0])
+      return f'timing stages of 1 in {args[0]} queries'
+
+    control.register('stats', lambda args: metrics.registry.render(),
+                     'Dump the metrics of this process')
+    control.register('flush', flush,
+                     'flush [NAME]: empty the cache, or drop the sets of NAME')
+    control.register('flushtree', flushtree,
+                     'flushtree NAME: drop the sets of NAME and below')
+    control.register('reload', reload,
+                     'reload [WHAT...]: reload zones and policy data')
+    control.register('loglevel', loglevel,
+                     'loglevel LEVEL: debug, info, warning or error')
+    control.register('querylog', querylog, 'querylog on|off')
+    control.register('trace', trace,
+                     'trace N: time the stages of 1 in N queries, 0 stops')
+
   def _parse_address(self, address: str) -> tuple[str, int]:
     """
     Parses the address string and returns a tuple of (ip, port).
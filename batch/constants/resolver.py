@@ -1,14 +1,21 @@
 import socket
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from app.models.answer import Answer
 from app.models.message import Message
 
 
 class Resolver:
-  def __init__(self, resolver):
+  def __init__(self, resolver, timeout=0.5, attempts=3, deadline=2.0,
+               parallelism=8):
     self.ip = resolver[0]
     self.port = resolver[1]
+    self.timeout = timeout
+    self.attempts = attempts
+    self.deadline = deadline
+    self.parallelism = parallelism
     if resolver:
       self.resolver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
@@ -19,9 +26,15 @@ class Resolver:
     answers = []
     print("forward_questions", f"There are {len(questions)} to forward")
 
-    for question in questions:
-      new_message = Message(dns_message.header, [question], [])
-      sub_request_response = self._forward(new_message.to_bytes())
+    requests = [
+        Message(dns_message.header, [question], []).to_bytes()
+        for question in questions
+    ]
+    # one socket per question so the answers can't cross
+    with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+      responses = list(executor.map(self._forward_on_own_socket, requests))
+
+    for question, sub_request_response in zip(questions, responses):
       sub_response_message = Message.from_bytes(sub_request_response)
       print("forward_questions", f"Received message {sub_response_message}")
       if len(sub_response_message.answers) > 0:
@@ -39,12 +52,38 @@ class Resolver:
       answers.append(Answer(question.name))
     return answers
 
-  def _forward(self, message: bytes) -> bytes:
+  def _forward_on_own_socket(self, message: bytes) -> bytes:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+      return self._forward(message, sock)
+
+  def _forward(self, message: bytes, sock=None) -> bytes:
+    sock = sock or self.resolver_socket
+    deadline = time.monotonic() + self.deadline
+    timeout = self.timeout
     try:
-      self.resolver_socket.sendto(message, (self.ip, self.port))
-      buf, source = self.resolver_socket.recvfrom(512)
-      return buf
+      for _ in range(self.attempts):
+        sock.sendto(message, (self.ip, self.port))
+        try:
+          return self._receive(sock, message[:2], deadline, timeout)
+        except socket.timeout:
+          timeout *= 2
+          if time.monotonic() >= deadline:
+            break
+      raise socket.timeout("no answer before deadline")
     except Exception as e:
       raise RuntimeError(
           f"Unable to forward request to server: {e}", (self.ip, self.port)
       )
+
+  def _receive(self, sock, query_id: bytes, deadline: float,
+               timeout: float) -> bytes:
+    attempt_deadline = min(deadline, time.monotonic() + timeout)
+    while True:
+      remaining = attempt_deadline - time.monotonic()
+      if remaining <= 0:
+        raise socket.timeout("timed out")
+      sock.settimeout(remaining)
+      buf, source = sock.recvfrom(512)
+      # late answers to an earlier copy share the ID, stale ones don't
+      if buf[:2] == query_id:
+        return buf
@@ -0,0 +1,45 @@
+import ipaddress
+import random
+
+import pytest
+
+from app.dns.acl import Acl, PrefixTree
+
+
+def test_prefix_tree_matches_the_longest_prefix():
+  rng = random.Random(7)
+  tree = PrefixTree(32)
+  prefixes = {}
+  for _ in range(500):
+    length = rng.randint(0, 32)
+    network = ipaddress.ip_network((rng.getrandbits(32), length),
+                                   strict=False)
+    prefixes[network] = len(prefixes)
+    tree.insert(int(network.network_address), length, prefixes[network])
+  assert len(tree) == len(prefixes)
+
+  for _ in range(2000):
+    address = ipaddress.ip_address(rng.getrandbits(32))
+    matches = [network for network in prefixes if address in network]
+    expected = (prefixes[max(matches, key=lambda n: n.prefixlen)]
+                if matches else None)
+    assert tree.lookup(int(address)) == expected
+
+
+def test_acl_negation_and_names():
+  named = {'office': ['10.0.0.0/8', '!10.6.0.0/16'], 'all': ['office', '::1']}
+  acl = Acl(['all', '!10.0.0.1'], named)
+  assert acl.allows('10.1.2.3')
+  assert not acl.allows('10.6.2.3')
+  assert not acl.allows('10.0.0.1')
+  assert acl.allows('::1')
+  assert acl.allows('::ffff:10.1.2.3')
+  assert not acl.allows('192.0.2.1')
+  assert not Acl(['none']).allows('127.0.0.1')
+
+
+def test_acl_rejects_bad_elements():
+  with pytest.raises(ValueError):
+    Acl(['nowhere'])
+  with pytest.raises(ValueError):
+    Acl(['loop'], {'loop': ['loop']})
@@ -0,0 +1,107 @@
+import struct
+import time
+
+from app.dns.cache import RRset, RRsetCache
+from app.dns.name import Name
+from app.dns.record import ResourceRecord
+
+
+def record(name: str, rtype: int, ttl: int, rdata: str) -> ResourceRecord:
+  return ResourceRecord(name=Name.from_text(name), type=rtype, klass=1, ttl=ttl, rdlength=0,
+                        rdata=rdata)
+
+
+def ttls(rrset: RRset, wire: bytes) -> list[int]:
+  return [struct.unpack_from('!I', wire, offset)[0]
+          for offset in rrset.ttl_offsets]
+
+
+def test_render_patches_every_ttl():
+  cache = RRsetCache()
+  name = Name.from_text('example.com')
+  cache.store(name, 1, 1, [record('example.com', 1, 300, '192.0.2.1'),
+                           record('example.com', 1, 60, '192.0.2.2')])
+  [(_, rrset)] = cache.entries()
+  assert rrset.count == 2
+
+  wire = rrset.render(rrset.expires - 42.5)
+  assert ttls(rrset, wire) == [42, 42]
+  # only the TTLs differ from the stored records
+  assert wire.replace(struct.pack('!I', 42), struct.pack('!I', 60)) \
+      == b''.join(bytes(record('example.com', 1, 60, address))
+                  for address in ('192.0.2.1', '192.0.2.2'))
+  assert ttls(rrset, rrset.render(rrset.expires + 10)) == [0, 0]
+
+
+def test_lookup_chases_cnames():
+  cache = RRsetCache()
+  cache.store(Name.from_text('www.example.com'), 1, 1, [
+      record('www.example.com', 5, 300, 'edge.example.net'),
+      record('EDGE.example.net', 1, 300, '192.0.2.7'),
+  ])
+  answer = cache.lookup(Name.from_text('WWW.example.com'), 1, 1)
+  assert answer is not None and answer.count == 2
+  assert answer.wire.startswith(Name.from_text('www.example.com').wire)
+  assert cache.lookup(Name.from_text('edge.example.net'), 1, 1).count == 1
+  # the chain has no AAAA set at its end
+  assert cache.lookup(Name.from_text('www.example.com'), 28, 1) is None
+  assert cache.lookup(Name.from_text('www.example.com'), 5, 1).count == 1
+
+
+def test_store_keeps_only_the_question_chain():
+  cache = RRsetCache()
+  cache.store(Name.from_text('www.example.com'), 1, 1, [
+      record('www.example.com', 1, 300, '192.0.2.1'),
+      record('bank.example', 1, 300, '192.0.2.66'),
+      record('www.example.com', 28, 300, '2001:db8::1'),
+  ])
+  assert [(str(name), rtype) for (name, rtype, _, _), _ in cache.entries()] \
+      == [('www.example.com', 1)]
+
+
+def test_zero_ttl_and_expired_sets_are_not_served():
+  cache = RRsetCache()
+  name = Name.from_text('example.com')
+  cache.store(name, 1, 1, [record('example.com', 1, 0, '192.0.2.1')])
+  assert len(cache) == 0
+  cache.restore([((name, 1, 1, b""), RRset(b'', (), time.time() - 1))])
+  assert cache.lookup(name, 1, 1) is None
+
+
+def test_lru_eviction():
+  cache = RRsetCache(capacity=2)
+  names = [Name.from_text(f'{label}.example.com') for label in 'abc']
+  for name in names[:2]:
+    cache.store(name, 1, 1, [record(str(name), 1, 300, '192.0.2.1')])
+  # a hit makes 'a' the most recently used
+  assert cache.lookup(names[0], 1, 1) is not None
+  cache.store(names[2], 1, 1, [record(str(names[2]), 1, 300, '192.0.2.1')])
+  assert cache.lookup(names[1], 1, 1) is None
+  assert cache.lookup(names[0], 1, 1) is not None
+  assert cache.lookup(names[2], 1, 1) is not None
+
+
+def test_remove_name_and_subtree():
+  cache = RRsetCache()
+  for owner in ('example.com', 'www.example.com', 'a.b.example.com',
+                'badexample.com', 'example.org'):
+    name = Name.from_text(owner)
+    for rtype, rdata in ((1, '192.0.2.1'), (28, '2001:db8::1')):
+      cache.store(name, rtype, 1, [record(owner, rtype, 300, rdata)])
+  assert len(cache) == 10
+
+  assert cache.remove(Name.from_text('WWW.example.com')) == 2
+  assert cache.lookup(Name.from_text('www.example.com'), 1, 1) is None
+  assert cache.remove(Name.from_text('example.com'), subtree=True) == 4
+  assert sorted(str(name) for (name, _, _, _), _ in cache.entries()) == [
+      'badexample.com', 'badexample.com', 'example.org', 'example.org']
+
+
+def test_partitions_are_separate():
+  cache = RRsetCache()
+  name = Name.from_text('example.com')
+  cache.store(name, 1, 1, [record('example.com', 1, 300, '192.0.2.1')],
+              b'internal')
+  assert cache.lookup(name, 1, 1) is None
+  assert cache.lookup(name, 1, 1, b'internal') is not None
+  assert cache.remove(name) == 1
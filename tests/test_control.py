@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from app.dns.control import ControlServer, send_command
+
+
+@pytest.fixture
+def control(tmp_path):
+  control = ControlServer(str(tmp_path / 'control.sock'))
+  yield control
+  control.close()
+
+
+def test_execute(control):
+  def echo(args):
+    if not args:
+      raise ValueError('nothing to echo')
+    return ' '.join(args)
+
+  control.register('echo', echo, 'echo WORDS')
+  assert control.execute('echo a  b') == 'a b\n'
+  assert control.execute('ECHO x') == 'x\n'
+  assert control.execute('echo') == 'error: nothing to echo\n'
+  assert control.execute('nope').startswith('error: unknown command')
+  assert control.execute('  ') == 'error: empty command\n'
+  assert 'echo WORDS' in control.execute('help')
+
+
+def test_socket_round_trip(control):
+  control.register('ping', lambda args: 'pong', 'ping')
+  control.start()
+  assert send_command(control.path, 'ping') == 'pong\n'
+
+
+def test_close_leaves_a_rebound_path_alone(tmp_path):
+  path = str(tmp_path / 'control.sock')
+  old = ControlServer(path)
+  new = ControlServer(path)
+  old.close()
+  assert os.path.exists(path)
+  new.close()
+  assert not os.path.exists(path)
+
+
+def test_socket_is_private_from_the_start(tmp_path):
+  umask = os.umask(0)
+  try:
+    control = ControlServer(str(tmp_path / 'control.sock'))
+  finally:
+    os.umask(umask)
+  try:
+    assert os.stat(control.path).st_mode & 0o777 == 0o600
+  finally:
+    control.close()
+  assert os.umask(umask) == umask
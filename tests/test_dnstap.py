@@ -0,0 +1,26 @@
+from app.dns.dnstap import (CLIENT_QUERY, CLIENT_RESPONSE, TapWriter,
+                            read_records)
+
+
+def test_records_round_trip(tmp_path):
+  writer = TapWriter(str(tmp_path), flush_interval=0.01)
+  writer.query(b'query', ('192.0.2.1', 5353))
+  writer.response(b'response', ('2001:db8::1', 53))
+  writer.close()
+  assert (writer.captured, writer.written, writer.dropped) == (2, 2, 0)
+
+  query, response = read_records(str(tmp_path / 'dns.tap'))
+  assert (query.kind, query.address, query.port, query.payload) \
+      == (CLIENT_QUERY, '192.0.2.1', 5353, b'query')
+  assert (response.kind, response.address, response.payload) \
+      == (CLIENT_RESPONSE, '2001:db8::1', b'response')
+
+
+def test_full_ring_and_failed_writes_count_as_dropped(tmp_path):
+  # the log path is taken, every write fails
+  (tmp_path / 'dns.tap').mkdir()
+  writer = TapWriter(str(tmp_path), capacity=3, flush_interval=60)
+  for i in range(5):
+    writer.query(b'query', ('192.0.2.1', 5353))
+  writer.close()
+  assert (writer.captured, writer.written, writer.dropped) == (3, 0, 5)
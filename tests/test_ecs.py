@@ -0,0 +1,51 @@
+from app.dns.ecs import ClientSubnet, SubnetCache
+from app.dns.name import Name
+from app.dns.rdata import RDATA
+from app.dns.record import ResourceRecord
+from tests.test_cache import record
+
+
+def test_client_subnet_is_truncated():
+  subnet = ClientSubnet.from_address('192.0.2.77')
+  assert (subnet.family, subnet.source) == (1, 24)
+  assert subnet.option() == bytes.fromhex('00011800c00002')
+  assert subnet.network(20) == bytes.fromhex('c00000')
+  assert subnet.network(0) == b''
+  assert ClientSubnet.from_address('::ffff:192.0.2.77').family == 1
+  v6 = ClientSubnet.from_address('2001:db8:1:2::1')
+  assert v6.option() == bytes.fromhex('0002380020010db8000100')
+
+
+def opt(value: bytes) -> ResourceRecord:
+  rdata = RDATA.factory(41, options=[(8, value)])
+  return ResourceRecord(name=Name.from_text('.'), type=41, klass=512, ttl=0,
+                        rdlength=len(rdata), rdata=rdata)
+
+
+def test_scope_of_the_echoed_option():
+  subnet = ClientSubnet.from_address('192.0.2.77')
+  assert subnet.scope([]) == 0
+  assert subnet.scope([opt(bytes.fromhex('00011810c00002'))]) == 16
+  # longer than what was sent, or for another network
+  assert subnet.scope([opt(bytes.fromhex('00011820c00002'))]) == 24
+  assert subnet.scope([opt(bytes.fromhex('00011800c00003'))]) == 24
+
+
+def test_most_specific_scope_wins():
+  cache = SubnetCache()
+  name = Name.from_text('cdn.example')
+  here = ClientSubnet.from_address('192.0.2.77')
+  cache.store(name, 1, 1, [record('cdn.example', 1, 60, '10.0.0.16')], b'',
+              here, 16)
+  cache.store(name, 1, 1, [record('cdn.example', 1, 60, '10.0.0.24')], b'',
+              here, 24)
+
+  neighbour = ClientSubnet.from_address('192.0.2.1')
+  assert cache.lookup(name, 1, 1, b'', neighbour).wire.endswith(
+      bytes([10, 0, 0, 24]))
+  nearby = ClientSubnet.from_address('192.0.9.1')
+  assert cache.lookup(name, 1, 1, b'', nearby).wire.endswith(
+      bytes([10, 0, 0, 16]))
+  assert cache.lookup(name, 1, 1, b'',
+                      ClientSubnet.from_address('198.51.100.1')) is None
+  assert cache.lookup(name, 1, 1, b'internal', neighbour) is None
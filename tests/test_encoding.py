@@ -0,0 +1,73 @@
+import pytest
+
+from app.dns.encoding import Encoding
+from app.dns.exceptions import FormatError
+
+HEADER = bytes(12)
+
+
+def labels(*parts: bytes) -> bytes:
+  return b''.join(bytes([len(part)]) + part for part in parts)
+
+
+def test_expand_name_rejects_pointer_to_itself():
+  data = HEADER + b'\xc0\x0c'
+  with pytest.raises(FormatError):
+    Encoding.expand_name(data, 12)
+
+
+def test_expand_name_rejects_forward_pointer():
+  # a -> pointer to b, b -> pointer back to a: the forward hop is refused
+  data = HEADER + labels(b'a') + b'\xc0\x10' + labels(b'b') + b'\xc0\x0c'
+  with pytest.raises(FormatError):
+    Encoding.expand_name(data, 12)
+
+
+def test_expand_name_rejects_long_name():
+  data = HEADER + labels(*[b'x' * 63] * 5) + b'\x00'
+  with pytest.raises(FormatError):
+    Encoding.expand_name(data, 12)
+
+
+@pytest.mark.parametrize('names', [None, {}])
+def test_expand_name_rejects_long_name_through_pointer(names):
+  suffix = labels(*[b'x' * 63] * 3) + b'\x00'
+  prefix_at = 12 + len(suffix)
+  data = HEADER + suffix + labels(b'y' * 63) + b'\xc0\x0c'
+  if names is not None:
+    Encoding.expand_name(data, 12, names)
+  with pytest.raises(FormatError):
+    Encoding.expand_name(data, prefix_at, names)
+
+
+def test_expand_name_truncated():
+  with pytest.raises(FormatError):
+    Encoding.expand_name(HEADER + labels(b'abc'), 12)
+  with pytest.raises(FormatError):
+    Encoding.expand_name(HEADER + b'\xc0', 12)
+
+
+def test_suffix_memoization_gives_identical_names():
+  first = labels(b'www', b'Example', b'com') + b'\x00'
+  data = (HEADER + first
+          + labels(b'mail') + b'\xc0\x10'
+          + labels(b'ftp') + b'\xc0\x18'
+          + b'\xc0\x0c')
+  offsets = [12]
+  offsets.append(offsets[-1] + len(first))
+  offsets.append(offsets[-1] + 7)
+  offsets.append(offsets[-1] + 6)
+
+  plain = [Encoding.expand_name(data, offset) for offset in offsets]
+  names: dict[int, bytes] = {}
+  memoized = [Encoding.expand_name(data, offset, names)
+              for offset in offsets]
+  assert memoized == plain
+  assert plain[1][0] == labels(b'mail', b'Example', b'com') + b'\x00'
+  assert plain[2][0] == labels(b'ftp', b'com') + b'\x00'
+  # the suffixes pointed at are cached by their offset
+  assert names[16] == labels(b'Example', b'com') + b'\x00'
+  assert names[24] == labels(b'com') + b'\x00'
+  # and answer again from the cache the same way
+  assert [Encoding.expand_name(data, offset, names)
+          for offset in offsets] == plain
@@ -0,0 +1,37 @@
+import socket
+import types
+
+import pytest
+
+from app.dns.frontends import _DoHHandler
+
+
+def serve(request: bytes) -> bytes:
+  server = types.SimpleNamespace(path='/dns-query', transport='https',
+                                 query_timeout=1.0,
+                                 submit=lambda *args: False)
+  ours, theirs = socket.socketpair()
+  with ours, theirs:
+    theirs.sendall(request)
+    theirs.shutdown(socket.SHUT_WR)
+    _DoHHandler(ours, ('192.0.2.1', 443), server)
+    ours.close()
+    chunks = []
+    while chunk := theirs.recv(65536):
+      chunks.append(chunk)
+  return b''.join(chunks)
+
+
+# a request of its own in the body, which must never be served
+SMUGGLED = b'GET /dns-query?dns=AAAB HTTP/1.1\r\nHost: x\r\n\r\n'
+
+
+@pytest.mark.parametrize('headers', [
+    b'Content-Type: text/plain\r\nContent-Length: %d\r\n' % len(SMUGGLED),
+    b'Content-Type: application/dns-message\r\nContent-Length: 70000\r\n',
+])
+def test_rejected_post_bodies_close_the_connection(headers):
+  reply = serve(b'POST /dns-query HTTP/1.1\r\nHost: x\r\n' + headers
+                + b'\r\n' + SMUGGLED)
+  assert reply.count(b'HTTP/1.1 ') == 1
+  assert b'Connection: close' in reply
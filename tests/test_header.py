@@ -0,0 +1,46 @@
+import pytest
+
+from app.dns.common import ResponseCode
+from app.dns.header import Header, HeaderFlags
+from app.dns.message import Message
+from tests.test_views import query
+
+
+@pytest.mark.parametrize('flags', [0x0120, 0x0110, 0x0130])
+def test_ad_and_cd_queries_round_trip(flags):
+  message = query('www.example.com')
+  message.header.flags = HeaderFlags.from_bytes(flags)
+  parsed = Message.from_bytes(bytes(message))
+  assert int(parsed.header.flags) == flags
+  assert parsed.header.flags.ad == flags >> 5 & 1
+  assert parsed.header.flags.cd == flags >> 4 & 1
+  assert parsed.validate() == ResponseCode.NO_ERROR
+
+
+def test_reserved_bit_is_a_format_error():
+  header = Header.from_bytes(bytes.fromhex('123401400001000000000000'))
+  assert header.validate() == ResponseCode.FORMAT_ERROR
+
+
+def test_flag_fields_round_trip():
+  flags = HeaderFlags(qr=1, opcode=2, aa=1, tc=0, rd=1, ra=1, rcode=3)
+  assert int(flags) == 0x9583
+  parsed = HeaderFlags.from_bytes(int(flags))
+  assert (parsed.qr, parsed.opcode, parsed.aa, parsed.tc, parsed.rd,
+          parsed.ra, parsed.z, parsed.rcode) == (1, 2, 1, 0, 1, 1, 0, 3)
+
+  # setting a field leaves the others alone
+  parsed.tc = 1
+  parsed.rcode = 0
+  assert int(parsed) == 0x9780
+  assert bytes(parsed) == b'\x97\x80'
+
+
+def test_header_round_trips_and_has_no_dict():
+  data = bytes.fromhex('beef01000001000200030004')
+  header = Header.from_bytes(data)
+  assert (header.id, header.qdcount, header.ancount, header.nscount,
+          header.arcount) == (0xbeef, 1, 2, 3, 4)
+  assert bytes(header) == data
+  assert not hasattr(header, '__dict__')
+  assert not hasattr(header.flags, '__dict__')
@@ -0,0 +1,32 @@
+import gc
+import threading
+
+from app.dns.metrics import Counter, Histogram
+
+
+def run_threads(target, count: int = 20) -> None:
+  threads = [threading.Thread(target=target) for _ in range(count)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  del threads
+  gc.collect()
+
+
+def test_shards_of_exited_threads_are_folded():
+  counter = Counter('test_total', 'Test.', labels=('kind',))
+  histogram = Histogram('test_seconds', 'Test.', buckets=(0.1, 1.0))
+  counter.inc('main')
+
+  def work():
+    counter.inc('thread')
+    counter.inc('thread', amount=2)
+    histogram.observe(0.5)
+
+  run_threads(work)
+  assert counter.collect() == {('main',): 1, ('thread',): 60}
+  assert histogram.collect() == {(): [0, 20, 0, 10.0]}
+  # the base shard and the main thread's
+  assert len(counter._shards) == 2
+  assert len(histogram._shards) == 1
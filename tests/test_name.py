@@ -0,0 +1,43 @@
+import pytest
+
+from app.dns.exceptions import FormatError
+from app.dns.name import ROOT, Name
+
+
+def test_names_are_interned_and_compare_without_case():
+  name = Name.from_text('www.example.com')
+  assert Name.from_wire(name.wire) is name
+  upper = Name.from_text('WWW.Example.COM')
+  assert upper is not name
+  assert upper == name and hash(upper) == hash(name)
+  assert upper.key == name.wire
+  # the case as received is kept for the wire
+  assert str(upper) == 'WWW.Example.COM'
+  assert Name.from_text('www.example.com.') is name
+  assert Name.from_text('.') is ROOT
+
+
+def test_is_subdomain():
+  example = Name.from_text('example.com')
+  assert Name.from_text('a.b.EXAMPLE.com').is_subdomain(example)
+  assert example.is_subdomain(example)
+  assert example.is_subdomain(ROOT)
+  # a label boundary, not a string suffix
+  assert not Name.from_text('badexample.com').is_subdomain(example)
+  assert not example.is_subdomain(Name.from_text('www.example.com'))
+
+
+def test_suffixes_and_parent():
+  name = Name.from_text('a.example.com')
+  assert [str(suffix) for suffix in name.suffixes()] \
+      == ['a.example.com', 'example.com', 'com', '']
+  assert name.parent() == Name.from_text('example.com')
+  assert ROOT.parent() is None
+  assert len(name) == 3
+
+
+@pytest.mark.parametrize('text', ['a..example', 'x' * 64 + '.example',
+                                  '.'.join(['x' * 63] * 4)])
+def test_invalid_names(text):
+  with pytest.raises(FormatError):
+    Name.from_text(text)
@@ -0,0 +1,74 @@
+from app.dns.common import ResponseCode
+from app.dns.name import Name
+from app.dns.nsec import NsecCache
+from app.dns.rdata import RDATA
+from app.dns.record import ResourceRecord
+from tests.test_views import query
+
+# example.com: a, b (an empty non-terminal above c.b), a delegation to
+# sub, and z
+CHAIN = [('example.com', 'a.example.com', [2, 6, 46, 47, 48]),
+         ('a.example.com', 'c.b.example.com', [1, 46, 47]),
+         ('c.b.example.com', 'sub.example.com', [1, 46, 47]),
+         ('sub.example.com', 'z.example.com', [2, 47]),
+         ('z.example.com', 'example.com', [1, 46, 47])]
+
+
+def rr(name: str, rtype: int, ttl: int, **fields) -> ResourceRecord:
+  rdata = RDATA.factory(rtype, **fields)
+  return ResourceRecord(name=Name.from_text(name), type=rtype, klass=1,
+                        ttl=ttl, rdlength=len(rdata), rdata=rdata)
+
+
+def negative(*nsecs, ad: int = 1):
+  soa = rr('example.com', 6, 3600, mname='ns.example.com',
+           rname='hostmaster.example.com', serial=1, refresh=2, retry=3,
+           expire=4, minimum=300)
+  response = query('x.example.com').local_response(
+      ResponseCode.NAME_ERROR, authorities=[soa] + [
+          rr(owner, 47, 3600, next_name=next_name, types=types)
+          for owner, next_name, types in nsecs])
+  response.header.flags.ad = ad
+  return response
+
+
+def rcode(cache: NsecCache, name: str, rtype: int = 1) -> int | None:
+  message = query(name)
+  message.queries[0].type = rtype
+  response = cache.respond(message)
+  return None if response is None else response.header.flags.rcode
+
+
+def test_synthesizes_from_cached_ranges():
+  cache = NsecCache()
+  assert cache.learn(negative(*CHAIN, ad=0)) == 0
+  assert cache.learn(negative(*CHAIN)) == 5
+
+  assert rcode(cache, 'x.example.com') == 3
+  assert rcode(cache, 'random123.example.com') == 3
+  response = cache.respond(query('x.example.com'))
+  assert response.authorities[0].type == 6
+  assert response.authorities[0].ttl <= 300
+
+  assert rcode(cache, 'a.example.com', 28) == 0
+  assert rcode(cache, 'a.example.com', 1) is None
+  assert rcode(cache, 'b.example.com') == 0
+  # below the delegation the parent zone proves nothing
+  assert rcode(cache, 'www.sub.example.com') is None
+  assert rcode(cache, 'example.org') is None
+
+
+def test_needs_the_wildcard_denied():
+  cache = NsecCache()
+  cache.learn(negative(CHAIN[3]))
+  assert rcode(cache, 'x.example.com') is None
+  cache.learn(negative(CHAIN[0]))
+  assert rcode(cache, 'x.example.com') == 3
+
+
+def test_capacity_and_flush():
+  cache = NsecCache(capacity=3)
+  assert cache.learn(negative(*CHAIN)) == 0
+  assert cache.learn(negative(*CHAIN[:3])) == 3
+  assert cache.remove(Name.from_text('www.example.com')) == 3
+  assert len(cache) == 0
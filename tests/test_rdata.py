@@ -0,0 +1,52 @@
+import struct
+
+from app.dns.common import RType
+from app.dns.message import Message
+from app.dns.rdata import RDATA, RDATA_A, RDATA_MX
+from app.dns.record import ResourceRecord
+
+OWNER = b'\x07example\x03com\x00'
+
+
+def response(*records: bytes) -> Message:
+  # the question names example.com at offset 12, for pointers
+  header = bytes.fromhex('12348180') + struct.pack('!HHHH', 1, len(records),
+                                                    0, 0)
+  question = OWNER + struct.pack('!HH', 1, 1)
+  return Message.from_bytes(header + question + b''.join(records))
+
+
+def rr(owner: bytes, rtype: int, rdata: bytes) -> bytes:
+  return owner + struct.pack('!HHIH', rtype, 1, 60, len(rdata)) + rdata
+
+
+def test_registry_dispatches_by_type():
+  assert RDATA.get_callable(RType.A.value) == (RDATA_A, 1)
+  assert RDATA.get_callable(RType.MX.value)[0] is RDATA_MX
+  assert RDATA.get_callable(65280)[0] is RDATA
+  rdata = RDATA.factory(RType.MX.value, preference=10,
+                        exchange='mail.example.com')
+  assert isinstance(rdata, RDATA_MX)
+  assert rdata.to_text() == '10 mail.example.com.'
+
+
+def test_unknown_types_stay_opaque():
+  # a record of a type without a codec, then one that has a codec
+  opaque = b'\xc0\x0c\x00\x01\x02'
+  message = response(rr(b'\xc0\x0c', 65280, opaque),
+                     rr(b'\xc0\x0c', 1, bytes([192, 0, 2, 1])))
+  unknown, address = message.answers
+  assert type(unknown.rdata) is RDATA
+  # not read as a compressed name, kept byte for byte
+  assert unknown.rdata.wire == opaque
+  assert unknown.rdata.to_text() == '\\# 5 c00c000102'
+  assert address.rdata.data == '192.0.2.1'
+  assert bytes(unknown).endswith(struct.pack('!H', 5) + opaque)
+
+
+def test_compressed_names_are_expanded():
+  record, = response(rr(b'\xc0\x0c', 15, b'\x00\x0a\x04mail\xc0\x0c')).answers
+  assert record.rdata.wire == b'\x00\x0a\x04mail\x07example\x03com\x00'
+  assert record.rdata.exchange == 'mail.example.com'
+  assert ResourceRecord(name='example.com', type=15, klass=1, ttl=60,
+                        rdlength=0, rdata=record.rdata).rdata == record.rdata
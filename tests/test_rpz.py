@@ -0,0 +1,109 @@
+import pytest
+
+from app.dns.exceptions import FormatError
+from app.dns.name import Name
+from app.dns.rpz import Action, load_policy
+from tests.test_views import query
+
+RULES = '''# feed
+ads.example
+Tracker.Example.
+*.wild.example
+ok.wild.example PASSTHRU
+nodata.example NODATA
+login.example CNAME *.
+portal.example A 192.0.2.1
+portal.example A 192.0.2.2
+0.0.0.0 hosts.example
+127.0.0.1 localhost ; skipped
+'''
+
+
+@pytest.fixture
+def policy(tmp_path):
+  path = tmp_path / 'rules.txt'
+  path.write_text(RULES)
+  return load_policy(str(path))
+
+
+def action(policy, name: str) -> Action | None:
+  found = policy.match(Name.from_text(name))
+  return found and found[0]
+
+
+def test_rules_match_names_and_subtrees(policy):
+  assert action(policy, 'ads.example') == Action.NXDOMAIN
+  assert action(policy, 'www.ads.example') is None
+  assert action(policy, 'TRACKER.example') == Action.NXDOMAIN
+  assert action(policy, 'hosts.example') == Action.NXDOMAIN
+  assert action(policy, 'localhost') is None
+  assert action(policy, 'wild.example') is None
+  assert action(policy, 'a.b.wild.example') == Action.NXDOMAIN
+  # the exact rule beats the wildcard, but not below it
+  assert action(policy, 'ok.wild.example') == Action.PASSTHRU
+  assert action(policy, 'x.ok.wild.example') == Action.NXDOMAIN
+  assert action(policy, 'login.example') == Action.NODATA
+  assert len(policy) == 8
+
+
+def test_responses(policy):
+  assert policy.respond(query('ads.example')).header.flags.rcode == 3
+  assert policy.respond(query('ok.wild.example')) is None
+  assert policy.respond(query('example.org')) is None
+
+  response = policy.respond(query('nodata.example'))
+  assert (response.header.flags.rcode, response.answers) == (0, [])
+  response = policy.respond(query('portal.example'))
+  assert [record.rdata.data for record in response.answers] \
+      == ['192.0.2.1', '192.0.2.2']
+  assert response.answers[0].name == Name.from_text('portal.example')
+
+
+def test_bad_rules_name_the_line(tmp_path):
+  path = tmp_path / 'rules.txt'
+  path.write_text('ok.example\nbad.example A nowhere\n')
+  with pytest.raises(FormatError, match='bad.example'):
+    load_policy(str(path))
+
+
+HOSTS = '''# Title: StevenBlack/hosts
+#
+# ===============================================================
+
+127.0.0.1 localhost
+127.0.0.1 localhost.localdomain
+127.0.0.1 local
+255.255.255.255 broadcasthost
+::1 localhost
+::1 ip6-localhost
+::1 ip6-loopback
+fe80::1%lo0 localhost
+ff00::0 ip6-localnet
+ff00::0 ip6-mcastprefix
+ff02::1 ip6-allnodes
+ff02::2 ip6-allrouters
+ff02::3 ip6-allhosts
+0.0.0.0 0.0.0.0
+
+# Custom host records are listed here.
+
+# End of custom host records.
+0.0.0.0 ad.example
+0.0.0.0 a.example b.example\t# two names
+127.0.0.1 loop.example
+192.0.2.7 other.example
+plain.example \t
+'''
+
+
+def test_hosts_files(tmp_path):
+  path = tmp_path / 'hosts'
+  path.write_text(HOSTS)
+  policy = load_policy(str(path))
+  for name in ('ad.example', 'a.example', 'b.example', 'loop.example',
+               'other.example', 'plain.example'):
+    assert action(policy, name) == Action.NXDOMAIN, name
+  for name in ('localhost', 'localhost.localdomain', 'broadcasthost',
+               'ip6-allnodes'):
+    assert action(policy, name) is None, name
+  assert len(policy) == 6
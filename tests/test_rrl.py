@@ -0,0 +1,50 @@
+from app.dns.rrl import (Action, ResponseRateLimiter, question_key,
+                         truncated_response)
+from tests.test_views import query
+
+QUERY = bytes(query('www.example.com'))
+# the qname and qtype
+KEY = QUERY[12:-2]
+
+
+def test_question_key():
+  assert question_key(QUERY) == KEY
+  assert question_key(bytes(query('WWW.Example.com'))) == KEY
+  # responses, empty questions and compressed qnames are not keyed
+  assert question_key(QUERY[:2] + b'\x81' + QUERY[3:]) is None
+  assert question_key(QUERY[:4] + b'\x00\x00' + QUERY[6:]) is None
+  assert question_key(QUERY[:12] + b'\xc0\x0c\x00\x01\x00\x01') is None
+
+
+def test_over_the_rate_slips_and_drops():
+  rrl = ResponseRateLimiter(rate=0.001, burst=3, slip=2)
+  actions = [rrl.check(QUERY, '192.0.2.1') for _ in range(7)]
+  assert actions[:3] == [Action.ALLOW] * 3
+  # every second limited response slips a truncated answer through
+  assert actions[3:] == [Action.DROP, Action.SLIP] * 2
+  assert (rrl.allowed, rrl.slipped, rrl.dropped) == (3, 2, 2)
+
+  # the same /24 shares the bucket, another network and name do not
+  assert rrl.check(QUERY, '192.0.2.200') != Action.ALLOW
+  assert rrl.check(QUERY, '198.51.100.1') == Action.ALLOW
+  assert rrl.check(bytes(query('example.org')), '192.0.2.1') \
+      == Action.ALLOW
+
+
+def test_errors_limit_the_prefix():
+  rrl = ResponseRateLimiter(rate=0.001, burst=2, slip=0)
+  for _ in range(3):
+    rrl.account('2001:db8::1', 3)
+  # NXDOMAIN debt limits every question from the /56
+  assert rrl.check(QUERY, '2001:db8::2') == Action.DROP
+  assert rrl.check(QUERY, '2001:db8:1::1') == Action.ALLOW
+  rrl.account('2001:db8:1::1', 0)
+  assert rrl.check(QUERY, '2001:db8:1::1') == Action.ALLOW
+
+
+def test_truncated_response_echoes_the_question():
+  response = truncated_response(QUERY)
+  assert response[:2] == QUERY[:2]
+  assert response[2] & 0x82 == 0x82
+  assert response[4:6] == b'\x00\x01' and response[6:12] == bytes(6)
+  assert response[12:] == QUERY[12:]
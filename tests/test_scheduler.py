@@ -0,0 +1,37 @@
+import threading
+
+from app.dns.scheduler import FairQueue
+
+
+def test_clients_are_served_round_robin():
+  queue = FairQueue()
+  for i in range(4):
+    queue.put('noisy', f'n{i}')
+  queue.put('quiet', 'q0')
+  queue.put('other', 'o0')
+  assert [queue.get(0) for _ in range(6)] \
+      == ['n0', 'q0', 'o0', 'n1', 'n2', 'n3']
+  assert queue.clients() == 0
+  assert queue.get(0) is None
+
+
+def test_full_queues_reject():
+  queue = FairQueue(capacity=4, per_client=2)
+  assert queue.put('a', 1) and queue.put('a', 2)
+  # the client's share is used up, not the queue
+  assert not queue.put('a', 3)
+  assert queue.put('b', 1) and queue.put('c', 1)
+  assert not queue.put('d', 1)
+  assert (len(queue), queue.rejected) == (4, 2)
+  queue.get(0)
+  assert queue.put('d', 1)
+
+
+def test_close_wakes_getters():
+  queue = FairQueue()
+  results = []
+  thread = threading.Thread(target=lambda: results.append(queue.get()))
+  thread.start()
+  queue.close()
+  thread.join(1)
+  assert results == [None]
@@ -0,0 +1,84 @@
+from multiprocessing import resource_tracker
+
+import pytest
+
+from app.dns.name import Name
+from app.dns.record import ResourceRecord
+from app.dns.shared_cache import SharedRRsetCache
+
+
+def record(name: str, ttl: int, address: str = '192.0.2.1') -> ResourceRecord:
+  return ResourceRecord(name=Name.from_text(name), type=1, klass=1, ttl=ttl, rdlength=4,
+                        rdata=address)
+
+
+@pytest.fixture
+def cache():
+  cache = SharedRRsetCache(capacity=8, ways=8, stripes=4)
+  yield cache
+  cache.close()
+
+
+def test_insert_and_lookup(cache):
+  name = Name.from_text('www.example.com')
+  cache.store(name, 1, 1, [record('www.example.com', 300),
+                           record('www.example.com', 300, '192.0.2.2')])
+  assert len(cache) == 1
+  answer = cache.lookup(Name.from_text('WWW.Example.com'), 1, 1)
+  assert answer is not None and answer.count == 2
+  assert cache.lookup(name, 28, 1) is None
+  assert cache.lookup(Name.from_text('example.com'), 1, 1) is None
+
+
+def test_replacing_a_set_keeps_one_entry(cache):
+  name = Name.from_text('www.example.com')
+  for address in ('192.0.2.1', '192.0.2.2'):
+    cache.store(name, 1, 1, [record('www.example.com', 300, address)])
+  assert len(cache) == 1
+  [(_, rrset)] = cache.entries()
+  assert rrset.wire.endswith(bytes([192, 0, 2, 2]))
+
+
+def test_eviction_replaces_the_soonest_to_expire(cache):
+  assert cache.buckets == 1 and cache.capacity == 8
+  names = [Name.from_text(f'n{i}.example.com') for i in range(9)]
+  for i, name in enumerate(names[:8]):
+    cache.store(name, 1, 1, [record(str(name), 1000 - i)])
+  cache.store(names[8], 1, 1, [record(str(names[8]), 1000)])
+  assert len(cache) == 8
+  assert cache.lookup(names[7], 1, 1) is None
+  for name in names[:7] + names[8:]:
+    assert cache.lookup(name, 1, 1) is not None
+
+
+def test_attached_cache_sees_entries_and_flush(cache):
+  name = Name.from_text('www.example.com')
+  cache.store(name, 1, 1, [record('www.example.com', 300)])
+  other = SharedRRsetCache(name=cache.name)
+  try:
+    assert other.lookup(name, 1, 1).count == 1
+    other.flush()
+    assert cache.lookup(name, 1, 1) is None
+    assert len(cache) == 0
+  finally:
+    other.close()
+    # attaching dropped the creator's registration with this process's
+    # resource tracker, restore it for the unlink on close
+    resource_tracker.register(cache.shm._name, 'shared_memory')
+
+
+def test_oversized_sets_are_not_cached(cache):
+  name = Name.from_text('big.example.com')
+  records = [record('big.example.com', 300, f'192.0.2.{i}')
+             for i in range(40)]
+  cache.store(name, 1, 1, records)
+  assert len(cache) == 0
+
+
+def test_remove_subtree(cache):
+  for owner in ('example.com', 'www.example.com', 'badexample.com'):
+    cache.store(Name.from_text(owner), 1, 1, [record(owner, 300)])
+  assert cache.remove(Name.from_text('www.example.com')) == 1
+  assert cache.remove(Name.from_text('example.com'), subtree=True) == 1
+  assert len(cache) == 1
+  assert cache.lookup(Name.from_text('badexample.com'), 1, 1) is not None
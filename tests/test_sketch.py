@@ -0,0 +1,44 @@
+import threading
+
+from app.dns.sketch import CountMinSketch, HeavyHitters, TopK
+
+
+def test_sketch_never_undercounts():
+  sketch = CountMinSketch(width=64, depth=4)
+  for i in range(1000):
+    sketch.add(f'name{i % 100}')
+  assert all(sketch.estimate(f'name{i}') >= 10 for i in range(100))
+
+
+def test_top_k_keeps_the_heaviest():
+  top = TopK(capacity=3)
+  for i in range(50):
+    top.add(f'rare{i}')
+  for name, count in (('a', 30), ('b', 20), ('c', 10)):
+    top.add(name, count)
+  assert [name for name, _ in top.top(3)] == ['a', 'b', 'c']
+
+
+def test_no_observation_is_lost_to_concurrent_flushes():
+  hitters = HeavyHitters(batch_size=64, sample=1)
+  stopping = threading.Event()
+
+  def scrape():
+    while not stopping.is_set():
+      hitters.flush()
+
+  def observe():
+    for _ in range(5000):
+      hitters.observe('www.example.com', '192.0.2.1', 0)
+
+  scraper = threading.Thread(target=scrape)
+  scraper.start()
+  threads = [threading.Thread(target=observe) for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  stopping.set()
+  scraper.join()
+  assert hitters.estimate('WWW.example.com') == 20000
+  assert hitters.report()['top_clients'] == [('192.0.2.1', 20000)]
@@ -0,0 +1,85 @@
+import os
+import struct
+import time
+
+from app.dns import snapshot
+from app.dns.cache import RRset, RRsetCache
+from app.dns.name import Name
+from app.dns.record import ResourceRecord
+
+
+def filled_cache() -> RRsetCache:
+  cache = RRsetCache()
+  for owner, partition in (('www.example.com', b''),
+                           ('www.example.com', b'v' * 300),
+                           ('mail.example.com', b'internal')):
+    name = Name.from_text(owner)
+    cache.store(name, 1, 1, [ResourceRecord(name=name, type=1, klass=1,
+                                            ttl=300, rdlength=4,
+                                            rdata='192.0.2.1')], partition)
+  return cache
+
+
+def test_write_and_read(tmp_path):
+  path = str(tmp_path / 'cache.snap')
+  cache = filled_cache()
+  assert snapshot.write_snapshot(path, cache.entries()) == 3
+  # the temporary file is gone
+  assert os.listdir(tmp_path) == ['cache.snap']
+
+  restored = RRsetCache()
+  assert snapshot.load(restored, path) == 3
+  for (key, rrset), (loaded_key, loaded) in zip(cache.entries(),
+                                                restored.entries()):
+    assert loaded_key == key
+    assert (bytes(loaded.wire), loaded.ttl_offsets, loaded.expires) \
+        == (rrset.wire, rrset.ttl_offsets, rrset.expires)
+  assert restored.lookup(Name.from_text('mail.example.com'), 1, 1,
+                         b'internal') is not None
+
+
+def test_expired_entries_are_skipped(tmp_path):
+  path = str(tmp_path / 'cache.snap')
+  cache = filled_cache()
+  snapshot.write_snapshot(path, cache.entries())
+  later = time.time() + 301
+  assert list(snapshot.read_snapshot(path, later)) == []
+  assert len(list(snapshot.read_snapshot(path))) == 3
+
+
+def test_reads_v2_snapshots(tmp_path):
+  path = tmp_path / 'cache.snap'
+  name = Name.from_text('example.com')
+  wire = bytes(ResourceRecord(name=name, type=1, klass=1, ttl=300,
+                              rdlength=4, rdata='192.0.2.1'))
+  expires = time.time() + 60
+  path.write_bytes(snapshot.MAGIC_V2
+                   + struct.pack('<dHHBBHHB', expires, 1, 1, len(name.wire),
+                                 0, 1, len(wire), 2)
+                   + name.wire + struct.pack('<H', len(name.wire) + 4)
+                   + wire + b'v1')
+  (key, rrset), = snapshot.read_snapshot(str(path))
+  assert key == (name, 1, 1, b'v1')
+  assert (bytes(rrset.wire), rrset.expires) == (wire, expires)
+
+
+def test_truncated_and_foreign_files(tmp_path):
+  path = str(tmp_path / 'cache.snap')
+  snapshot.write_snapshot(path, filled_cache().entries())
+  with open(path, 'r+b') as f:
+    f.truncate(os.path.getsize(path) - 1)
+  assert len(list(snapshot.read_snapshot(path))) == 2
+
+  with open(path, 'wb') as f:
+    f.write(b'not a snapshot')
+  cache = RRsetCache()
+  assert snapshot.load(cache, path) == 0
+
+
+def test_save_survives_bad_entries(tmp_path):
+  path = str(tmp_path / 'cache.snap')
+  cache = RRsetCache()
+  cache.restore([((Name.from_text('example.com'), 1, 1, b'x' * 70000),
+                  RRset(b'', (), time.time() + 60))])
+  assert snapshot.Snapshotter(cache, path).save() == 0
+  assert os.listdir(tmp_path) == []
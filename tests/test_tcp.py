@@ -0,0 +1,30 @@
+import socket
+import time
+
+from app.dns.tcp import TCPPool
+
+QUERY = bytes.fromhex('123401000001000000000000') + b'\x00\x00\x01\x00\x01'
+
+
+def test_given_up_queries_free_the_connection():
+  # an upstream accepting queries and never answering them
+  listener = socket.create_server(('127.0.0.1', 0))
+  pool = TCPPool(listener.getsockname(), size=1)
+  try:
+    waiter = pool.submit(QUERY, time.monotonic() + 1)
+    assert waiter.wait(0.05) is None
+    conn, = pool.connections
+    assert conn.pending == {}
+    assert not conn.closed
+  finally:
+    pool.close()
+    listener.close()
+
+
+def test_connect_respects_the_deadline():
+  pool = TCPPool(('192.0.2.1', 53))
+  started = time.monotonic()
+  assert pool.submit(QUERY, started - 1).wait(1) is None
+  assert pool.submit(QUERY, started + 0.1).wait(1) is None
+  assert time.monotonic() - started < 1
+  assert pool.connections == []
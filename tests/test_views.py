@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from app.dns.common import ResponseCode
+from app.dns.message import Message
+from app.dns.name import Name
+from app.dns.views import load_views
+from app.dns.zone import load_zone
+
+ZONE = ['$TTL 300',
+        '@ SOA ns1 hostmaster 1 7200 900 1209600 60',
+        '  NS ns1',
+        'ns1 A 192.0.2.1',
+        'www CNAME web',
+        'web A 192.0.2.10',
+        'a.b TXT "one two" three']
+
+
+def test_zone_answers():
+  zone = load_zone('example.com', ZONE)
+  rcode, answers, authorities = zone.answer(
+      Name.from_text('www.example.com'), 1)
+  assert rcode == ResponseCode.NO_ERROR
+  assert [record.type for record in answers] == [5, 1]
+  assert authorities == []
+
+  # an empty non-terminal exists, a sibling does not
+  rcode, answers, authorities = zone.answer(Name.from_text('b.example.com'), 1)
+  assert (rcode, answers) == (ResponseCode.NO_ERROR, [])
+  assert authorities[0].ttl == 60
+  rcode, _, _ = zone.answer(Name.from_text('c.example.com'), 1)
+  assert rcode == ResponseCode.NAME_ERROR
+
+
+def query(name: str) -> Message:
+  header = bytes.fromhex('123401000001000000000000')
+  qname = b''.join(bytes([len(label)]) + label.encode()
+                   for label in name.split('.')) + b'\x00'
+  return Message.from_bytes(header + qname + b'\x00\x01\x00\x01')
+
+
+def test_views_split_the_horizon(tmp_path):
+  path = tmp_path / 'views.json'
+  path.write_text(json.dumps({
+      'acls': {'inside': ['10.0.0.0/8']},
+      'views': [{'name': 'internal', 'match-clients': ['inside'],
+                 'zones': {'example.com': ZONE}},
+                {'name': 'external', 'allow-recursion': ['none']}]}))
+  table = load_views(str(path))
+
+  internal = table.select('10.1.1.1')
+  external = table.select('192.0.2.99')
+  assert (internal.name, external.name) == ('internal', 'external')
+  assert internal.partition != external.partition
+  assert internal.recursion.allows('10.1.1.1')
+  assert not external.recursion.allows('192.0.2.99')
+
+  response = internal.answer(query('web.example.com'))
+  assert response.header.flags.aa == 1
+  assert response.answers[0].rdata.data == '192.0.2.10'
+  assert internal.answer(query('example.org')) is None
+  assert external.answer(query('web.example.com')) is None
+
+
+def test_bad_views_are_rejected(tmp_path):
+  path = tmp_path / 'views.json'
+  path.write_text(json.dumps({'views': [{'name': 'v', 'zones': {
+      'example.com': ['www IN A not-an-address']}}]}))
+  with pytest.raises(ValueError):
+    load_views(str(path))